@@ -0,0 +1,155 @@
+import logging
+import pickle
+import struct
+import sys
+import time
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+# Limiti per annuncio: tengono limitata la memoria occupata da ogni annuncio in sospeso
+MAX_FOTO = 30
+MAX_TITOLO = 120
+MAX_DESCRIZIONE = 800
+MAX_LOCALITA = 80
+MAX_NOME = 64
+# Prezzo massimo accettato (un miliardo di euro), ben dentro il campo int64 dell'intestazione
+MAX_PREZZO_CENTESIMI = 10 ** 11
+
+# Formato binario: intestazione (versione, message_id, user_id, inviato_il, prezzo in
+# centesimi o -1 se assente) seguita da user_name, title, description, location e dai
+# file_id delle foto, in UTF-8 e separati da NUL: una sola encode e una sola decode
+VERSIONE_FORMATO = 1
+_INTESTAZIONE = struct.Struct('<Bqqdq')
+# Campi del vecchio formato pickle (__getstate__ con il prezzo in euro come float)
+_CAMPI_V0 = ('message_id', 'user_id', 'user_name', 'inviato_il', 'photos',
+             'title', 'description', 'location', 'price')
+
+
+def in_centesimi(prezzo) -> Optional[int]:
+    """Prezzo in euro (numero o testo, con virgola o punto) in centesimi; None se non valido.
+
+    Sono non validi anche i prezzi negativi e quelli oltre MAX_PREZZO_CENTESIMI.
+    """
+    if prezzo is None:
+        return None
+    try:
+        valore = float(str(prezzo).replace(',', '.')) if isinstance(prezzo, str) else float(prezzo)
+        centesimi = round(valore * 100)
+    except (ValueError, OverflowError):
+        return None
+    if valore < 0 or centesimi > MAX_PREZZO_CENTESIMI:
+        return None
+    return centesimi
+
+
+def formatta_prezzo(centesimi: Optional[int]) -> str:
+    if centesimi is None:
+        return "prezzo non indicato"
+    return f"€{centesimi // 100}.{centesimi % 100:02d}"
+
+
+class PendingAd:
+    """Annuncio inviato ai moderatori, dalla scheda di moderazione fino alla pubblicazione.
+
+    Il prezzo è in centesimi (`price` lo restituisce in euro per catalogo e ricerche).
+    `to_bytes`/`from_bytes` usano un formato binario versionato, usato anche da
+    pickle: database e snapshot della persistenza salvano lo stesso formato. I testi
+    delle schede sono generati alla prima richiesta con `testo` e restano sul record,
+    che dopo la creazione non cambia più (tranne il message_id, che non compare nei testi).
+    """
+
+    __slots__ = ('message_id', 'user_id', 'user_name', 'inviato_il', 'photos',
+                 'title', 'description', 'location', 'prezzo_centesimi', '_testi')
+
+    def __init__(self, message_id: int, user_id: int, user_name: str, photos,
+                 title: str, description: str, location: str, price,
+                 inviato_il: Optional[float] = None):
+        self.message_id = message_id
+        self.user_id = user_id
+        self.user_name = _senza_nul(user_name[:MAX_NOME])
+        self.inviato_il = time.time() if inviato_il is None else inviato_il
+        # Il wizard rifiuta già testi e album oltre i limiti: qui si taglia solo
+        # per difesa, e lo si registra
+        self.photos = tuple(_limita(photos, MAX_FOTO, 'photos', message_id))
+        self.title = _senza_nul(_limita(title, MAX_TITOLO, 'title', message_id))
+        self.description = _senza_nul(_limita(description, MAX_DESCRIZIONE, 'description', message_id))
+        self.location = _senza_nul(_limita(location, MAX_LOCALITA, 'location', message_id))
+        self.prezzo_centesimi = in_centesimi(price)
+        self._testi: Optional[dict] = None
+
+    @property
+    def price(self) -> Optional[float]:
+        return None if self.prezzo_centesimi is None else self.prezzo_centesimi / 100
+
+    def testo(self, genera: Callable[['PendingAd'], str]) -> str:
+        """Testo prodotto da `genera(self)`: calcolato la prima volta, poi riletto dal record."""
+        testi = self._testi
+        if testi is None:
+            testi = self._testi = {}
+        testo = testi.get(genera)
+        if testo is None:
+            testo = testi[genera] = genera(self)
+        return testo
+
+    def to_bytes(self) -> bytes:
+        prezzo = -1 if self.prezzo_centesimi is None else self.prezzo_centesimi
+        testi = '\0'.join((self.user_name, self.title, self.description, self.location) + self.photos)
+        return (_INTESTAZIONE.pack(VERSIONE_FORMATO, self.message_id, self.user_id, self.inviato_il, prezzo)
+                + testi.encode())
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> 'PendingAd':
+        if data[:1] == b'\x80':
+            # Righe salvate con pickle prima del formato binario
+            return pickle.loads(data)
+        versione, message_id, user_id, inviato_il, prezzo = _INTESTAZIONE.unpack_from(data)
+        if versione != VERSIONE_FORMATO:
+            raise ValueError(f"formato dell'annuncio non supportato: versione {versione}")
+        ad = cls.__new__(cls)
+        ad.message_id = message_id
+        ad.user_id = user_id
+        ad.inviato_il = inviato_il
+        ad.user_name, ad.title, ad.description, ad.location, *photos = \
+            data[_INTESTAZIONE.size:].decode().split('\0')
+        ad.photos = tuple(photos)
+        ad.prezzo_centesimi = None if prezzo < 0 else prezzo
+        ad._testi = None
+        return ad
+
+    def __reduce__(self):
+        return _da_bytes, (self.to_bytes(),)
+
+    def __setstate__(self, state):
+        # Solo per gli annunci serializzati con il vecchio formato pickle
+        valori = dict(zip(_CAMPI_V0, state))
+        for campo in self.__slots__[:-2]:
+            setattr(self, campo, valori[campo])
+        self.prezzo_centesimi = in_centesimi(valori['price'])
+        self._testi = None
+
+    def memoria(self) -> int:
+        """Byte occupati dal record, comprese le stringhe, le foto e i testi generati."""
+        totale = sys.getsizeof(self) + sys.getsizeof(self.photos)
+        totale += sum(sys.getsizeof(file_id) for file_id in self.photos)
+        for campo in ('user_name', 'title', 'description', 'location', 'prezzo_centesimi'):
+            totale += sys.getsizeof(getattr(self, campo))
+        if self._testi:
+            totale += sys.getsizeof(self._testi) + sum(sys.getsizeof(t) for t in self._testi.values())
+        return totale
+
+
+def _limita(valore, massimo: int, campo: str, message_id: int):
+    if len(valore) <= massimo:
+        return valore
+    logger.warning(f"Annuncio {message_id}: {campo} tagliato da {len(valore)} a {massimo}")
+    return valore[:massimo]
+
+
+def _senza_nul(testo: str) -> str:
+    # NUL separa i testi nel formato binario
+    return testo.replace('\0', '') if '\0' in testo else testo
+
+
+def _da_bytes(data: bytes) -> PendingAd:
+    return PendingAd.from_bytes(data)
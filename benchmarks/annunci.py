@@ -0,0 +1,98 @@
+"""Memoria e serializzazione del record PendingAd contro il vecchio dict con pickle.
+
+Il dict è quello che `conferma_annuncio` costruiva per ogni annuncio, con il prezzo
+in float e il testo della scheda di moderazione già generato dentro. Per ognuno dei
+due misura la memoria per annuncio (tracemalloc, su `--annunci` annunci tenuti in
+vita insieme), i byte serializzati e quanti annunci al secondo vengono serializzati
+e deserializzati: pickle per il dict, `to_bytes`/`from_bytes` per il record.
+
+Uso: python benchmarks/annunci.py [--annunci 20000] [--ripetizioni 5]
+"""
+import argparse
+import os
+import pickle
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from ad_record import PendingAd  # noqa: E402
+
+DESCRIZIONE = "Libri in ottime condizioni, qualche segno d'uso sulle copertine. " * 3
+
+
+def campi(i: int) -> tuple:
+    return (1_000_000 + i, 10_000 + i, f"Utente {i % 997}",
+            [f"AgACAgQAAxkBAAI{i:08d}{n}" for n in range(3)],
+            f"Lotto di {i % 50} libri di fantascienza", DESCRIZIONE + str(i), 'Milano', 25.5 + i % 100)
+
+
+def come_dict(i: int) -> dict:
+    message_id, user_id, user_name, photos, title, description, location, price = campi(i)
+    return {
+        'user_id': user_id,
+        'user_name': user_name,
+        'photos': photos,
+        'title': title,
+        'description': description,
+        'location': location,
+        'price': price,
+        'moderation_card_text': (
+            f"🚨 **NUOVO ANNUNCIO DA APPROVARE!** 🚨\n\n**Da Utente:** {user_name}\n\n"
+            f" **Articolo:** {title}\n **Descrizione:** {description}\n"
+            f" **Località:** {location}\n **Prezzo:** €{price:.2f}\n\n"
+            f"Approvazione richiesta. Cosa vuoi fare?"),
+    }
+
+
+def come_record(i: int) -> PendingAd:
+    return PendingAd(*campi(i))
+
+
+def memoria(costruisci, n: int) -> float:
+    tracemalloc.start()
+    inizio = tracemalloc.get_traced_memory()[0]
+    annunci = [costruisci(i) for i in range(n)]
+    fine = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del annunci
+    return (fine - inizio) / n
+
+
+def throughput(annunci: list, serializza, deserializza, ripetizioni: int) -> tuple[float, float, float]:
+    migliore_s = migliore_d = float('inf')
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        dati = [serializza(ad) for ad in annunci]
+        migliore_s = min(migliore_s, time.perf_counter() - inizio)
+        inizio = time.perf_counter()
+        for d in dati:
+            deserializza(d)
+        migliore_d = min(migliore_d, time.perf_counter() - inizio)
+    byte = sum(map(len, dati)) / len(dati)
+    return len(annunci) / migliore_s, len(annunci) / migliore_d, byte
+
+
+def principale(args) -> None:
+    n = args.annunci
+    print(f"{n} annunci")
+    for nome, costruisci, serializza, deserializza in (
+            ('dict + pickle', come_dict,
+             lambda ad: pickle.dumps(ad, protocol=pickle.HIGHEST_PROTOCOL), pickle.loads),
+            ('PendingAd', come_record, PendingAd.to_bytes, PendingAd.from_bytes)):
+        byte_in_memoria = memoria(costruisci, n)
+        annunci = [costruisci(i) for i in range(n)]
+        scritture, letture, byte = throughput(annunci, serializza, deserializza, args.ripetizioni)
+        print(f"{nome:>14}: {byte_in_memoria:6.0f} B in memoria, {byte:5.0f} B serializzato, "
+              f"{scritture / 1000:6.0f}k serializzazioni/s, {letture / 1000:6.0f}k deserializzazioni/s")
+    ad = come_record(0)
+    assert PendingAd.from_bytes(ad.to_bytes()).to_bytes() == ad.to_bytes()
+    assert pickle.loads(pickle.dumps(ad)).to_bytes() == ad.to_bytes()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--annunci', type=int, default=20000)
+    parser.add_argument('--ripetizioni', type=int, default=5)
+    principale(parser.parse_args())
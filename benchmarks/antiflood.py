@@ -0,0 +1,62 @@
+"""Costo dell'anti-flood in ingresso.
+
+Misura in microsecondi per aggiornamento `FloodLimiter.valuta` con molti utenti
+normali e un utente che invia a raffica, quanti aggiornamenti dell'utente
+molesto passano, e la memoria occupata per utente attivo.
+
+Uso: python benchmarks/antiflood.py [--utenti 100000] [--aggiornamenti 500000]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from flood_limiter import FloodLimiter, leggi_limiti  # noqa: E402
+
+MOLESTO = 1
+
+
+def messaggio(utente: int, testo: str = 'ciao') -> dict:
+    return {'update_id': 1, 'message': {
+        'message_id': 1, 'date': 0, 'text': testo,
+        'chat': {'id': utente, 'type': 'private'}, 'from': {'id': utente, 'is_bot': False}}}
+
+
+def principale(args) -> None:
+    limitatore = FloodLimiter(limiti_comandi=leggi_limiti('nuovo_annuncio=0.05/3,inline=2/20'),
+                              max_utenti=args.utenti)
+    aggiornamenti = []
+    for i in range(args.aggiornamenti):
+        # Un aggiornamento su dieci è dell'utente molesto, gli altri di utenti a caso
+        utente = MOLESTO if i % 10 == 0 else random.randrange(2, args.utenti)
+        aggiornamenti.append(messaggio(utente, '/nuovo_annuncio' if i % 97 == 0 else 'ciao'))
+
+    inizio = time.perf_counter()
+    esiti = [limitatore.valuta(data) for data in aggiornamenti]
+    trascorso = time.perf_counter() - inizio
+    passati_molesto = sum(1 for data, esito in zip(aggiornamenti, esiti)
+                          if esito is None and data['message']['from']['id'] == MOLESTO)
+    print(f"valuta: {trascorso / len(aggiornamenti) * 1e6:.2f} µs per aggiornamento "
+          f"({len(aggiornamenti) / trascorso:,.0f} al secondo)")
+    print(f"utente molesto: {passati_molesto} passati su {args.aggiornamenti // 10} in {trascorso:.2f}s")
+    print(f"statistiche: {limitatore.statistiche()}")
+
+    tracemalloc.start()
+    vuoto = FloodLimiter(max_utenti=args.utenti)
+    prima = tracemalloc.get_traced_memory()[0]
+    for utente in range(args.utenti):
+        vuoto.valuta(messaggio(utente + 2))
+    occupata = tracemalloc.get_traced_memory()[0] - prima
+    tracemalloc.stop()
+    print(f"memoria: {occupata / args.utenti:.0f} byte per utente attivo ({args.utenti} utenti)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--utenti', type=int, default=100_000)
+    parser.add_argument('--aggiornamenti', type=int, default=500_000)
+    principale(parser.parse_args())
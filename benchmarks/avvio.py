@@ -0,0 +1,116 @@
+"""Tempi di avvio del bot, dal lancio del processo alla prima richiesta servita.
+
+Avvia `main.py` in un processo separato contro il finto server Bot API (con
+`--latenza` secondi per chiamata, come da un host lontano da Telegram) e misura
+dal lancio del processo:
+
+- la prima risposta 200 su `/` (il controllo di UptimeRobot);
+- il primo aggiornamento accettato su `/webhook` (prima il bot risponde 503);
+- la fine dell'avvio, con webhook e comandi controllati.
+
+Il bot viene avviato più volte sullo stesso database e sullo stesso finto server:
+al primo avvio webhook e comandi vanno impostati, ai successivi sono invariati e
+non vengono reinviati. Con `--catalogo` il database contiene già quel numero di
+annunci pubblicati, da ricaricare a ogni avvio.
+
+Uso: python benchmarks/avvio.py [--avvii 3] [--latenza 0.1] [--catalogo 20000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from catalog import AdCatalog, CatalogAd  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+RADICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+METODI_CONFIGURAZIONE = ('getWebhookInfo', 'setWebhook', 'setMyCommands')
+
+
+def prepara_catalogo(path: str, annunci: int) -> None:
+    catalogo = AdCatalog()
+    catalogo.apri(path)
+    for i in range(annunci):
+        catalogo.aggiungi(CatalogAd(i + 1, i % 500, f"Utente {i % 500}", f"Lotto {i} di libri usati",
+                                    "Libri in buone condizioni, spedizione possibile", "Milano", (10 + i % 90) * 100))
+
+
+async def attendi(sessione: aiohttp.ClientSession, metodo: str, url: str, **kwargs) -> None:
+    while True:
+        try:
+            async with sessione.request(metodo, url, **kwargs) as risposta:
+                if risposta.status == 200:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.005)
+
+
+async def avvia(api: FakeBotApi, porta: int, ambiente: dict) -> dict:
+    api.azzera()
+    base = f"http://127.0.0.1:{porta}"
+    tempi = {}
+    inizio = time.perf_counter()
+    processo = await asyncio.create_subprocess_exec(
+        sys.executable, 'main.py', cwd=RADICE, env=ambiente,
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        async with aiohttp.ClientSession() as sessione:
+            await attendi(sessione, 'GET', f"{base}/")
+            tempi['health check'] = time.perf_counter() - inizio
+            aggiornamento = {'update_id': int(time.time() * 1000), 'message': {
+                'message_id': 1, 'date': int(time.time()), 'text': '/start',
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+                'chat': {'id': 10, 'type': 'private'}, 'from': {'id': 10, 'is_bot': False, 'first_name': 'A'}}}
+            await attendi(sessione, 'POST', f"{base}/webhook", json=aggiornamento)
+            tempi['primo aggiornamento'] = time.perf_counter() - inizio
+            while True:
+                async with sessione.get(f"{base}/stato") as risposta:
+                    avvio = (await risposta.json())['avvio']
+                if 'completato' in avvio:
+                    break
+                await asyncio.sleep(0.005)
+            tempi['avvio completato'] = time.perf_counter() - inizio
+            tempi['interno'] = avvio
+    finally:
+        processo.kill()
+        await processo.wait()
+    tempi['chiamate'] = {m: n for m, n in api.conteggi().items() if m in METODI_CONFIGURAZIONE}
+    return tempi
+
+
+async def principale(args) -> None:
+    api = FakeBotApi(latenza=args.latenza)
+    url_api = await api.start(args.porta_api)
+    with tempfile.TemporaryDirectory() as cartella:
+        database = os.path.join(cartella, 'bot.db')
+        if args.catalogo:
+            prepara_catalogo(database, args.catalogo)
+        ambiente = dict(
+            os.environ, TELEGRAM_BOT_TOKEN='123:abc', GROUP_CHAT_ID='-100', TOPIC_MESSAGE_THREAD_ID='7',
+            MODERATION_CHAT_ID='-200', BASE_URL='http://127.0.0.1', PORT=str(args.porta),
+            DATABASE_PATH=database, TELEGRAM_API_BASE_URL=url_api)
+        print(f"latenza Bot API {args.latenza * 1000:.0f} ms, catalogo {args.catalogo} annunci")
+        for n in range(args.avvii):
+            tempi = await avvia(api, args.porta, ambiente)
+            print(f"avvio {n + 1}: / dopo {tempi['health check']:.2f}s, primo aggiornamento dopo "
+                  f"{tempi['primo aggiornamento']:.2f}s, completato dopo {tempi['avvio completato']:.2f}s "
+                  f"(webhook {tempi['interno']['webhook']}, comandi {tempi['interno']['comandi']}, "
+                  f"chiamate {tempi['chiamate']})")
+    await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--avvii', type=int, default=3)
+    parser.add_argument('--latenza', type=float, default=0.1)
+    parser.add_argument('--catalogo', type=int, default=20000)
+    parser.add_argument('--porta', type=int, default=18090)
+    parser.add_argument('--porta-api', type=int, default=18091)
+    asyncio.run(principale(parser.parse_args()))
@@ -0,0 +1,97 @@
+"""Costo del confronto tra un annuncio approvato e le ricerche salvate.
+
+Per ogni numero di ricerche misura `SavedSearches.corrispondenze` contro il
+confronto ingenuo (verifica di ogni ricerca, una per una) su annunci casuali e
+riporta il tempo medio e p99 per approvazione e quante ricerche corrispondono.
+Il vocabolario è di qualche migliaio di parole con frequenze alla Zipf, come
+in un catalogo vero: il costo dell'indice dipende dall'annuncio e dal numero di
+utenti da avvisare, non dal numero totale di ricerche.
+
+Uso: python benchmarks/avvisi.py [--ricerche 1000 10000 50000] [--annunci 200]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from catalog import CatalogAd, parole  # noqa: E402
+from catalogo import LOCALITA  # noqa: E402
+from saved_searches import SavedSearches  # noqa: E402
+
+SILLABE = ['ba', 'be', 'bi', 'ca', 'co', 'da', 'de', 'fi', 'la', 'le', 'li', 'ma', 'mo', 'na',
+           'no', 'pa', 'pe', 'ra', 'ri', 'sa', 'se', 'ta', 'to', 'va', 'vi', 'za']
+random.seed(0)
+VOCABOLARIO = sorted({''.join(random.choices(SILLABE, k=random.randint(3, 4))) for _ in range(5000)})
+PESI = [1 / (i + 1) for i in range(len(VOCABOLARIO))]
+
+
+def parola() -> str:
+    return random.choices(VOCABOLARIO, PESI)[0]
+
+
+def annuncio(id: int) -> CatalogAd:
+    return CatalogAd(id, id, 'Utente', f"{parola()} {parola()}",
+                     ' '.join(parola() for _ in range(20)), random.choice(LOCALITA),
+                     random.randint(100, 50_000))
+
+
+def ricerca_casuale() -> str:
+    # Chi salva una ricerca cerca qualcosa di preciso: parole distribuite su tutto il vocabolario
+    pezzi = [random.choice(VOCABOLARIO)]
+    if random.random() < 0.3:
+        pezzi.append(random.choice(VOCABOLARIO))
+    if random.random() < 0.5:
+        pezzi.append('@' + random.choice(LOCALITA).lower())
+    if random.random() < 0.4:
+        pezzi.append(f"<{random.randint(10, 300)}")
+    if random.random() < 0.02:
+        # Solo località o solo prezzo
+        pezzi = [pezzi[-1]]
+    return ' '.join(pezzi)
+
+
+def percentile(valori: list[float], p: float) -> float:
+    return sorted(valori)[min(len(valori) - 1, int(len(valori) * p))]
+
+
+def misura(n: int, annunci: int) -> None:
+    random.seed(n)
+    ricerche = SavedSearches(max_per_utente=n)
+
+    async def riempi() -> None:
+        for i in range(n):
+            await ricerche.aggiungi(i, ricerca_casuale())
+    asyncio.run(riempi())
+    tutte = list(ricerche._per_id.values())
+    campione = [annuncio(i) for i in range(1, annunci + 1)]
+
+    tempi_indice, tempi_ingenuo, trovate = [], [], 0
+    for ad in campione:
+        inizio = time.perf_counter()
+        risultato = ricerche.corrispondenze(ad.title, ad.description, ad.location, ad.price)
+        tempi_indice.append(time.perf_counter() - inizio)
+
+        inizio = time.perf_counter()
+        parole_localita = parole(ad.location)
+        parole_testo = parole(f"{ad.title} {ad.description}") | parole_localita
+        ingenuo = {r.user_id for r in tutte if r.corrisponde(parole_testo, parole_localita, ad.price)}
+        tempi_ingenuo.append(time.perf_counter() - inizio)
+
+        assert ingenuo == set(risultato), (ad.title, ingenuo ^ set(risultato))
+        trovate += len(risultato)
+    print(f"{n:>7} ricerche: indice media {sum(tempi_indice) / annunci * 1000:6.2f} ms "
+          f"p99 {percentile(tempi_indice, 0.99) * 1000:6.2f} ms | ingenuo media "
+          f"{sum(tempi_ingenuo) / annunci * 1000:7.2f} ms | {trovate / annunci:7.1f} utenti avvisati per annuncio")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--ricerche', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--annunci', type=int, default=200)
+    args = parser.parse_args()
+    for n in args.ricerche:
+        misura(n, args.annunci)
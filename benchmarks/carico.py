@@ -0,0 +1,314 @@
+"""Prova di carico end-to-end: main.py sotto un flusso di aggiornamenti sintetici.
+
+Avvia `main.py` in un processo separato contro il finto server Bot API (con
+latenza, errori e 429 configurabili) e per `--durata` secondi gli invia su
+`/webhook`:
+
+- `--utenti` utenti che compilano annunci completi con /nuovo_annuncio, uno dopo
+  l'altro: accettazione del readme, un album, titolo, descrizione, località,
+  prezzo e conferma (con il wizard scelto da `--wizard`);
+- il clic di un moderatore su Approva per ogni annuncio arrivato in moderazione;
+- `--rumore` messaggi al secondo nel gruppo degli annunci, che il bot ignora;
+- `--start` comandi /start al secondo da utenti sempre diversi.
+
+Come Telegram, ogni aggiornamento rifiutato (503, 500) viene ritentato. Alla fine
+riporta aggiornamenti al secondo, latenza del webhook (p50/p99, dalla prima
+consegna al 200) per tipo, chiamate alla Bot API per metodo e picco di memoria
+del processo. Con `--risultati` li scrive anche in JSON, per confrontare le
+versioni di main.py.
+
+Gli scheduler degli invii hanno limiti alti, per misurare il bot e non i limiti
+di Telegram: con `--limiti-reali` restano quelli di default.
+
+Uso: python benchmarks/carico.py [--durata 30] [--utenti 20] [--latenza 0.05] [--risultati carico.json]
+"""
+import argparse
+import asyncio
+import io
+import itertools
+import json
+import os
+import random
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+RADICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+GRUPPO = -100
+MODERATORI = -200
+MODERATORE = 1
+FOTO = 12
+LIMITI_ALTI = {'OUTBOX_GLOBAL_RATE': '1000', 'OUTBOX_CHAT_RATE': '100',
+               'OUTBOX_GROUP_RATE_PER_MINUTE': '60000', 'PUBLISH_PER_MINUTE': '6000'}
+
+
+def percentile(valori: list[float], p: float) -> float:
+    if not valori:
+        return 0.0
+    ordinati = sorted(valori)
+    return ordinati[min(len(ordinati) - 1, int(len(ordinati) * p))]
+
+
+def prepara_foto(api: FakeBotApi) -> None:
+    """Foto vere da scaricare per le impronte, se Pillow è installato."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return
+    for n in range(FOTO):
+        immagine = Image.new('RGB', (400, 300), (n * 20 % 256, 90, 160))
+        for x in range(0, 400, 40):
+            immagine.paste((x % 256, n * 30 % 256, 40), (x, (n * 25) % 300, x + 20, 300))
+        dati = io.BytesIO()
+        immagine.save(dati, 'JPEG')
+        api.file[f"photos/foto{n}.jpg"] = dati.getvalue()
+
+
+class Generatore:
+    def __init__(self, sessione: aiohttp.ClientSession, base: str, api: FakeBotApi, wizard: str):
+        self.sessione = sessione
+        self.base = base
+        self.api = api
+        self.wizard = wizard
+        self.update_id = itertools.count(1)
+        self.message_id = itertools.count(1)
+        self.utenti = itertools.count(100000)
+        self.latenze: dict[str, list[float]] = defaultdict(list)
+        self.esiti: Counter = Counter()
+        self.annunci = 0
+        self.approvati = 0
+        # Schede di moderazione viste sulla finta Bot API: user_id -> message_id
+        self._schede: dict[int, int] = {}
+        self._letti = 0
+
+    async def consegna(self, tipo: str, campo: str, contenuto: dict) -> None:
+        aggiornamento = {'update_id': next(self.update_id), campo: contenuto}
+        inizio = time.perf_counter()
+        while True:
+            try:
+                async with self.sessione.post(f"{self.base}/webhook", json=aggiornamento) as risposta:
+                    self.esiti[risposta.status] += 1
+                    if risposta.status == 200:
+                        break
+            except aiohttp.ClientError as e:
+                self.esiti[type(e).__name__] += 1
+            await asyncio.sleep(0.05)
+        self.latenze[tipo].append(time.perf_counter() - inizio)
+
+    def messaggio(self, utente: int, chat: int = None, **campi) -> dict:
+        chat = chat or utente
+        return {'message_id': next(self.message_id), 'date': int(time.time()),
+                'chat': {'id': chat, 'type': 'private' if chat > 0 else 'supergroup'},
+                'from': {'id': utente, 'is_bot': False, 'first_name': f"U{utente}"}, **campi}
+
+    async def testo(self, tipo: str, utente: int, testo: str, chat: int = None) -> None:
+        campi = {'text': testo}
+        if testo.startswith('/'):
+            campi['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(testo.split()[0])}]
+        await self.consegna(tipo, 'message', self.messaggio(utente, chat, **campi))
+
+    async def pulsante(self, tipo: str, utente: int, dati: str, message_id: int, chat: int = None) -> None:
+        chat = chat or utente
+        await self.consegna(tipo, 'callback_query', {
+            'id': str(next(self.message_id)), 'chat_instance': '1', 'data': dati,
+            'from': {'id': utente, 'is_bot': False, 'first_name': f"U{utente}"},
+            'message': {'message_id': message_id, 'date': int(time.time()), 'text': '',
+                        'chat': {'id': chat, 'type': 'private' if chat > 0 else 'supergroup'}}})
+
+    async def annuncio(self, pausa: float) -> None:
+        utente = next(self.utenti)
+        scheda = 1
+        await self.testo('conversazione', utente, '/nuovo_annuncio')
+        await asyncio.sleep(pausa)
+        await self.pulsante('conversazione', utente, 'accetta_readme', scheda)
+        album = str(next(self.message_id))
+        for n in random.sample(range(FOTO), 3):
+            await self.consegna('album', 'message', self.messaggio(utente, media_group_id=album, photo=[
+                {'file_id': f"foto{n}", 'file_unique_id': f"ufoto{n}", 'width': 400, 'height': 300}]))
+        await asyncio.sleep(pausa)
+        if self.wizard == 'messaggi':
+            await self.testo('conversazione', utente, '✅ Fatto')
+        for testo in (f"Lotto {utente} di libri", 'Libri usati in buono stato', 'Milano', '25.50'):
+            await asyncio.sleep(pausa)
+            await self.testo('conversazione', utente, testo)
+        await asyncio.sleep(pausa)
+        if self.wizard == 'messaggi':
+            await self.testo('conversazione', utente, 'Si')
+        else:
+            await self.pulsante('conversazione', utente, 'bozza_invia', scheda)
+        self.annunci += 1
+        asyncio.ensure_future(self.approva(utente))
+
+    async def approva(self, utente: int) -> None:
+        """Clic di un moderatore su Approva, appena la scheda arriva in moderazione."""
+        for _ in range(200):
+            self._leggi_schede()
+            message_id = self._schede.pop(utente, None)
+            if message_id is not None:
+                await self.pulsante('moderazione', MODERATORE, f"approve_{utente}", message_id, MODERATORI)
+                self.approvati += 1
+                return
+            await asyncio.sleep(0.05)
+
+    def _leggi_schede(self) -> None:
+        chiamate = self.api.chiamate
+        for _, metodo, parametri in chiamate[self._letti:]:
+            tastiera = parametri.get('reply_markup')
+            if metodo == 'editMessageReplyMarkup' and isinstance(tastiera, dict):
+                for riga in tastiera.get('inline_keyboard', []):
+                    for bottone in riga:
+                        if bottone.get('callback_data', '').startswith('approve_'):
+                            self._schede[int(bottone['callback_data'][8:])] = int(parametri['message_id'])
+        self._letti = len(chiamate)
+
+    async def utente(self, fine: float, pausa: float) -> None:
+        while time.monotonic() < fine:
+            await self.annuncio(pausa)
+
+    async def a_ritmo(self, fine: float, al_secondo: float, invio) -> None:
+        if al_secondo <= 0:
+            return
+        prossimo = time.monotonic()
+        in_corso = set()
+        while prossimo < fine:
+            task = asyncio.ensure_future(invio())
+            in_corso.add(task)
+            task.add_done_callback(in_corso.discard)
+            prossimo += 1 / al_secondo
+            await asyncio.sleep(max(0.0, prossimo - time.monotonic()))
+        await asyncio.gather(*in_corso)
+
+    async def rumore(self) -> None:
+        await self.testo('rumore', random.randrange(2, 5000), 'qualcuno ha ancora quel divano?', GRUPPO)
+
+    async def start(self) -> None:
+        await self.testo('start', next(self.utenti), '/start')
+
+
+def picco_memoria(pid: int) -> int:
+    """Picco di memoria residente del processo in KB (VmHWM), 0 se non disponibile."""
+    try:
+        with open(f"/proc/{pid}/status") as file:
+            for riga in file:
+                if riga.startswith('VmHWM:'):
+                    return int(riga.split()[1])
+    except OSError:
+        pass
+    return 0
+
+
+def versione() -> str:
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=RADICE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'sconosciuta'
+
+
+async def principale(args) -> None:
+    api = FakeBotApi(latenza=args.latenza, errori=args.errori, flood=args.flood)
+    prepara_foto(api)
+    url_api = await api.start(args.porta_api)
+    base = f"http://127.0.0.1:{args.porta}"
+    with tempfile.TemporaryDirectory() as cartella:
+        ambiente = dict(
+            os.environ, TELEGRAM_BOT_TOKEN='123:abc', GROUP_CHAT_ID=str(GRUPPO), TOPIC_MESSAGE_THREAD_ID='7',
+            MODERATION_CHAT_ID=str(MODERATORI), BASE_URL='http://127.0.0.1', PORT=str(args.porta),
+            DATABASE_PATH=os.path.join(cartella, 'bot.db'), TELEGRAM_API_BASE_URL=url_api,
+            WIZARD_MODE=args.wizard, ALBUM_DEBOUNCE='0.2', WORKER_PROCESSES=str(args.worker),
+            **({} if args.limiti_reali else LIMITI_ALTI))
+        processo = await asyncio.create_subprocess_exec(
+            sys.executable, 'main.py', cwd=RADICE, env=ambiente,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        try:
+            async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as sessione:
+                while True:
+                    try:
+                        async with sessione.get(f"{base}/stato") as risposta:
+                            if 'completato' in (await risposta.json())['avvio']:
+                                break
+                    except aiohttp.ClientError:
+                        pass
+                    await asyncio.sleep(0.01)
+                api.azzera()
+                generatore = Generatore(sessione, base, api, args.wizard)
+                inizio = time.perf_counter()
+                fine = time.monotonic() + args.durata
+                await asyncio.gather(
+                    *(generatore.utente(fine, args.pausa) for _ in range(args.utenti)),
+                    generatore.a_ritmo(fine, args.rumore, generatore.rumore),
+                    generatore.a_ritmo(fine, args.start, generatore.start))
+                # Le ultime approvazioni e gli invii ancora in coda
+                await asyncio.sleep(2)
+                trascorso = time.perf_counter() - inizio
+                async with sessione.get(f"{base}/stato") as risposta:
+                    stato = await risposta.json()
+            # Con più worker conta la somma dei picchi di supervisore e worker
+            worker = stato['worker'] if isinstance(stato.get('worker'), list) else []
+            memoria = picco_memoria(processo.pid) + sum(picco_memoria(w['pid']) for w in worker)
+        finally:
+            if processo.returncode is None:
+                processo.send_signal(signal.SIGTERM)
+                await processo.wait()
+    await api.stop()
+    memoria = memoria or resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    aggiornamenti = sum(len(v) for v in generatore.latenze.values())
+    risultati = {
+        'versione': versione(),
+        'parametri': vars(args),
+        'durata': trascorso,
+        'aggiornamenti': aggiornamenti,
+        'aggiornamenti_al_secondo': aggiornamenti / trascorso,
+        'annunci': generatore.annunci,
+        'approvati': generatore.approvati,
+        'latenza': {tipo: {'n': len(v), 'p50': percentile(v, 0.5), 'p99': percentile(v, 0.99)}
+                    for tipo, v in sorted(generatore.latenze.items())},
+        'risposte_webhook': {str(k): n for k, n in generatore.esiti.items()},
+        'chiamate_api': dict(api.conteggi().most_common()),
+        'picco_memoria_kb': memoria,
+        'ritardo_massimo_loop': max((s or {}).get('loop', {}).get('ritardo_massimo', 0)
+                                    for s in [w['stato'] for w in worker] or [stato]),
+    }
+    print(f"versione {risultati['versione']}, wizard {args.wizard}, {args.worker} worker, {args.utenti} utenti, "
+          f"latenza Bot API {args.latenza * 1000:.0f} ms")
+    print(f"{aggiornamenti} aggiornamenti in {trascorso:.1f}s: {risultati['aggiornamenti_al_secondo']:.0f}/s, "
+          f"{generatore.annunci} annunci, {generatore.approvati} approvati")
+    for tipo, valori in risultati['latenza'].items():
+        print(f"  {tipo:14} {valori['n']:6}  p50 {valori['p50'] * 1000:7.1f} ms  p99 {valori['p99'] * 1000:7.1f} ms")
+    print(f"risposte del webhook: {risultati['risposte_webhook']}")
+    print(f"chiamate alla Bot API: {risultati['chiamate_api']}")
+    print(f"picco di memoria: {memoria / 1024:.1f} MB, ritardo massimo del loop: "
+          f"{risultati['ritardo_massimo_loop'] * 1000:.0f} ms")
+    if args.risultati:
+        with open(args.risultati, 'w', encoding='utf-8') as file:
+            json.dump(risultati, file, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--durata', type=float, default=30)
+    parser.add_argument('--utenti', type=int, default=20)
+    parser.add_argument('--pausa', type=float, default=0.05, help="secondi tra due passi di un utente")
+    parser.add_argument('--rumore', type=float, default=20, help="messaggi al secondo nel gruppo")
+    parser.add_argument('--start', type=float, default=5, help="/start al secondo")
+    parser.add_argument('--wizard', choices=('messaggi', 'scheda'), default='messaggi')
+    parser.add_argument('--latenza', type=float, default=0.05)
+    parser.add_argument('--errori', type=float, default=0.0)
+    parser.add_argument('--flood', type=float, default=0.0, help="probabilità di un 429 su ogni invio")
+    parser.add_argument('--worker', type=int, default=1, help="processi worker (WORKER_PROCESSES)")
+    parser.add_argument('--limiti-reali', action='store_true')
+    parser.add_argument('--risultati', help="file JSON in cui scrivere i risultati")
+    parser.add_argument('--porta', type=int, default=18096)
+    parser.add_argument('--porta-api', type=int, default=18097)
+    asyncio.run(principale(parser.parse_args()))
@@ -0,0 +1,134 @@
+"""Latenza delle ricerche nel catalogo al crescere degli annunci approvati.
+
+Per ogni dimensione genera un catalogo su SQLite, misura la ricostruzione degli
+indici all'avvio (`AdCatalog.apri`) e il costo di un inserimento, poi esegue
+ricerche casuali (prefissi, filtri per località, intervalli di prezzo e query
+vuote come l'apertura del menu inline) e riporta p50, p99 e massimo.
+
+Prima verifica con degli assert che i prezzi restino centesimi interi: filtri al
+centesimo esatto, ricostruzione dal database e migrazione della vecchia colonna in euro.
+
+Uso: python benchmarks/catalogo.py [--dimensioni 1000 10000 50000] [--ricerche 2000]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from catalog import AdCatalog, CatalogAd  # noqa: E402
+
+OGGETTI = ['libri', 'libreria', 'lampada', 'lampadario', 'sedia', 'sedie', 'tavolo', 'divano',
+           'bicicletta', 'biciclette', 'vestiti', 'scarpe', 'giocattoli', 'piatti', 'bicchieri',
+           'quadri', 'dischi', 'vinili', 'fumetti', 'attrezzi', 'pentole', 'tende', 'tappeti',
+           'cornici', 'specchio', 'borse', 'orologi', 'cavi', 'telefoni', 'tablet']
+AGGETTIVI = ['usati', 'vintage', 'nuovi', 'antichi', 'moderni', 'rotti', 'misti', 'assortiti',
+             'colorati', 'grandi', 'piccoli', 'originali', 'economici', 'rari', 'puliti']
+LOCALITA = ['Milano', 'Roma', 'Torino', 'Napoli', 'Bologna', 'Firenze', 'Genova', 'Bari',
+            'Palermo', 'Verona', 'Padova', 'Trieste', 'Brescia', 'Parma', 'Modena', 'Monza',
+            'Bergamo', 'Rimini', 'Salerno', 'Lecce']
+
+
+def annuncio(id: int) -> CatalogAd:
+    oggetto, altro = random.sample(OGGETTI, 2)
+    descrizione = ' '.join(random.choices(OGGETTI + AGGETTIVI, k=12)) + f" lotto{id % 5000}"
+    return CatalogAd(id, 10_000 + id % 3000, 'Utente', f"{oggetto.capitalize()} {random.choice(AGGETTIVI)}",
+                     descrizione, f"{random.choice(LOCALITA)} {altro[:3]}",
+                     random.randint(100, 50_000), None if id % 3 else f"foto{id}")
+
+
+def ricerca_casuale() -> str:
+    tipo = random.random()
+    if tipo < 0.1:
+        return ''
+    parole = [random.choice(OGGETTI + AGGETTIVI)[:random.randint(2, 8)]
+              for _ in range(random.randint(1, 2))]
+    if tipo < 0.4:
+        parole.append('@' + random.choice(LOCALITA)[:random.randint(2, 6)].lower())
+    if tipo > 0.7:
+        minimo = random.randint(1, 300)
+        parole.append(f"{minimo}-{minimo + random.randint(10, 200)}")
+    return ' '.join(parole)
+
+
+def percentile(valori: list[float], p: float) -> float:
+    return valori[min(len(valori) - 1, int(len(valori) * p))]
+
+
+def prezzi(cartella: str) -> None:
+    path = os.path.join(cartella, "prezzi.db")
+    catalogo = AdCatalog()
+    catalogo.apri(path)
+    for id, centesimi in ((1, 29), (2, 1999), (3, 1000), (4, None)):
+        catalogo.aggiungi(CatalogAd(id, id, 'Utente', f"Lotto {id}", "libri", "Milano", centesimi))
+    for testo, attesi in (("<0.29", [1]), ("0,29-0,29", [1]), (">19.99", [2]), ("10-19.98", [3]),
+                          ("<=1000000000000", [3, 2, 1])):
+        assert [ad.id for ad in catalogo.cerca(testo)[0]] == attesi, testo
+    ricostruito = AdCatalog()
+    ricostruito.apri(path)
+    assert [ricostruito.get(id).prezzo_centesimi for id in (1, 2, 3, 4)] == [29, 1999, 1000, None]
+    assert all(isinstance(prezzo, int) for prezzo, _ in ricostruito._prezzi)
+
+    vecchio = os.path.join(cartella, "prezzi_euro.db")
+    conn = sqlite3.connect(vecchio)
+    conn.execute("CREATE TABLE catalogo (id INTEGER PRIMARY KEY, user_id INTEGER NOT NULL, "
+                 "user_name TEXT NOT NULL, title TEXT NOT NULL, description TEXT NOT NULL, "
+                 "location TEXT NOT NULL, price REAL, photo TEXT, pubblicato_il REAL NOT NULL)")
+    conn.executemany("INSERT INTO catalogo VALUES (?, 1, 'Utente', 'Lotto', 'libri', 'Milano', ?, NULL, 0)",
+                     [(1, 0.29), (2, 19.99), (3, None)])
+    conn.commit()
+    conn.close()
+    migrato = AdCatalog()
+    migrato.apri(vecchio)
+    assert [migrato.get(id).prezzo_centesimi for id in (1, 2, 3)] == [29, 1999, None]
+    print("OK: prezzi in centesimi interi, anche dopo la migrazione")
+
+
+def misura(n: int, ricerche: int, cartella: str) -> None:
+    random.seed(n)
+    path = os.path.join(cartella, f"catalogo_{n}.db")
+    catalogo = AdCatalog()
+    catalogo.apri(path)
+    catalogo._conn.execute("BEGIN")
+    for id in range(1, n + 1):
+        catalogo.aggiungi(annuncio(id))
+    catalogo._conn.execute("COMMIT")
+
+    inizio = time.perf_counter()
+    for id in range(n + 1, n + 201):
+        catalogo.aggiungi(annuncio(id))
+    inserimento = (time.perf_counter() - inizio) / 200
+
+    ricostruito = AdCatalog()
+    inizio = time.perf_counter()
+    ricostruito.apri(path)
+    ricostruzione = time.perf_counter() - inizio
+
+    tempi = []
+    trovati = 0
+    for _ in range(ricerche):
+        testo = ricerca_casuale()
+        inizio = time.perf_counter()
+        risultati, _ = ricostruito.cerca(testo, limite=20)
+        tempi.append(time.perf_counter() - inizio)
+        trovati += len(risultati)
+    tempi.sort()
+    print(f"{n:>7} annunci: ricostruzione {ricostruzione * 1000:7.0f} ms, "
+          f"inserimento {inserimento * 1e6:6.0f} µs, ricerca p50 {percentile(tempi, 0.5) * 1000:6.2f} ms "
+          f"p99 {percentile(tempi, 0.99) * 1000:6.2f} ms max {tempi[-1] * 1000:6.2f} ms "
+          f"({trovati / ricerche:.1f} risultati in media)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--dimensioni', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--ricerche', type=int, default=2000)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as cartella:
+        prezzi(cartella)
+        for n in args.dimensioni:
+            misura(n, args.ricerche, cartella)
@@ -0,0 +1,157 @@
+"""Chiusura ordinata durante un deploy: nessun aggiornamento perso.
+
+Avvia `main.py` (istanza A) contro il finto server Bot API e gli manda un flusso
+continuo di /start da utenti diversi, ritentando come Telegram ogni risposta
+diversa da 200. A metà flusso avvia l'istanza B sulla stessa porta e sullo stesso
+database e manda SIGTERM ad A: A smette di accettare aggiornamenti, finisce quelli
+in corso e chiude; B carica lo stato quando A ha rilasciato il lock e prende il
+suo posto.
+
+Alla fine verifica con degli assert che ogni aggiornamento abbia avuto esattamente
+una risposta, che A abbia smaltito tutti quelli in corso al SIGTERM senza
+abbandonarne nessuno (dal suo log di chiusura), che entrambe le istanze siano
+uscite con codice 0 e che la chiusura sia rimasta entro SHUTDOWN_TIMEOUT.
+
+Uso: python benchmarks/chiusura.py [--aggiornamenti 400] [--latenza 0.05]
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import sys
+import tempfile
+import time
+from collections import Counter
+from typing import Optional
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+RADICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+PRIMO_UTENTE = 100000
+SHUTDOWN_TIMEOUT = 25
+
+
+async def lancia(ambiente: dict, log: str) -> asyncio.subprocess.Process:
+    with open(log, 'ab') as file:
+        return await asyncio.create_subprocess_exec(
+            sys.executable, 'main.py', cwd=RADICE, env=ambiente, stdout=file, stderr=file)
+
+
+def conteggi_chiusura(log: str) -> tuple[Optional[int], Optional[int]]:
+    """Aggiornamenti in corso al SIGTERM e abbandonati, letti dal log di chiusura di un'istanza."""
+    in_corso = abbandonati = None
+    with open(log, encoding='utf-8', errors='replace') as file:
+        for riga in file:
+            try:
+                messaggio = json.loads(riga).get('messaggio', '')
+            except ValueError:
+                continue
+            if messaggio.startswith("Chiusura:"):
+                in_corso = int(re.search(r"(\d+) aggiornamenti in corso", messaggio).group(1))
+            elif messaggio.startswith("Chiusura completata"):
+                abbandonati = int(re.search(r"(\d+) aggiornamenti abbandonati", messaggio).group(1))
+    return in_corso, abbandonati
+
+
+async def attendi_avvio(sessione: aiohttp.ClientSession, base: str) -> None:
+    while True:
+        try:
+            async with sessione.get(f"{base}/stato") as risposta:
+                if risposta.status == 200 and 'completato' in (await risposta.json())['avvio']:
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.01)
+
+
+async def consegna(sessione: aiohttp.ClientSession, base: str, n: int, esiti: Counter) -> None:
+    """Consegna un aggiornamento come fa Telegram: ritenta finché non riceve 200."""
+    utente = PRIMO_UTENTE + n
+    aggiornamento = {'update_id': n + 1, 'message': {
+        'message_id': n + 1, 'date': int(time.time()), 'text': '/start',
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': 6}],
+        'chat': {'id': utente, 'type': 'private'},
+        'from': {'id': utente, 'is_bot': False, 'first_name': f"U{n}"}}}
+    while True:
+        try:
+            async with sessione.post(f"{base}/webhook", json=aggiornamento) as risposta:
+                esiti[risposta.status] += 1
+                if risposta.status == 200:
+                    return
+        except aiohttp.ClientError as e:
+            esiti[type(e).__name__] += 1
+        await asyncio.sleep(0.02)
+
+
+async def principale(args) -> None:
+    api = FakeBotApi(latenza=args.latenza)
+    url_api = await api.start(args.porta_api)
+    base = f"http://127.0.0.1:{args.porta}"
+    with tempfile.TemporaryDirectory() as cartella:
+        ambiente = dict(
+            os.environ, TELEGRAM_BOT_TOKEN='123:abc', GROUP_CHAT_ID='-100', TOPIC_MESSAGE_THREAD_ID='7',
+            MODERATION_CHAT_ID='-200', BASE_URL='http://127.0.0.1', PORT=str(args.porta),
+            DATABASE_PATH=os.path.join(cartella, 'bot.db'), TELEGRAM_API_BASE_URL=url_api,
+            SHUTDOWN_TIMEOUT=str(SHUTDOWN_TIMEOUT))
+        log_a, log_b = os.path.join(cartella, 'a.log'), os.path.join(cartella, 'b.log')
+        esiti: Counter = Counter()
+        async with aiohttp.ClientSession() as sessione:
+            istanza_a = await lancia(ambiente, log_a)
+            await attendi_avvio(sessione, base)
+            consegne = []
+            for n in range(args.aggiornamenti):
+                consegne.append(asyncio.create_task(consegna(sessione, base, n, esiti)))
+                if n == args.aggiornamenti // 2:
+                    istanza_b = await lancia(ambiente, log_b)
+                    inizio_chiusura = time.perf_counter()
+                    istanza_a.send_signal(signal.SIGTERM)
+                await asyncio.sleep(1 / args.frequenza)
+            codice_a = await istanza_a.wait()
+            durata_chiusura = time.perf_counter() - inizio_chiusura
+            await asyncio.gather(*consegne)
+            # Le ultime risposte di B possono essere ancora nello scheduler degli invii
+            await asyncio.sleep(1)
+        istanza_b.send_signal(signal.SIGTERM)
+        codice_b = await istanza_b.wait()
+        risposte = Counter(
+            parametri.get('chat_id') for _, metodo, parametri in api.chiamate if metodo == 'sendMessage')
+        senza_risposta = [n for n in range(args.aggiornamenti) if not risposte[PRIMO_UTENTE + n]]
+        doppie = [n for n in range(args.aggiornamenti) if risposte[PRIMO_UTENTE + n] > 1]
+        print(f"{args.aggiornamenti} aggiornamenti a {args.frequenza}/s, latenza Bot API "
+              f"{args.latenza * 1000:.0f} ms")
+        print(f"risposte del webhook: {dict(esiti)}")
+        print(f"istanza A: uscita {codice_a} dopo {durata_chiusura:.2f}s dal SIGTERM; istanza B: uscita {codice_b}")
+        in_corso, abbandonati = conteggi_chiusura(log_a)
+        print(f"senza risposta: {len(senza_risposta)}, con più risposte: {len(doppie)}")
+        print(f"istanza A: {in_corso} aggiornamenti in corso al SIGTERM, {abbandonati} abbandonati")
+        try:
+            assert codice_a == 0 and codice_b == 0, (codice_a, codice_b)
+            assert in_corso is not None and abbandonati is not None, "log di chiusura di A incompleto"
+            assert abbandonati == 0, f"{abbandonati} aggiornamenti persi da A"
+            assert not senza_risposta, f"senza risposta: {senza_risposta[:20]}"
+            assert not doppie, f"con più risposte: {doppie[:20]}"
+            assert durata_chiusura < SHUTDOWN_TIMEOUT, durata_chiusura
+        except AssertionError:
+            for nome, log in (('A', log_a), ('B', log_b)):
+                with open(log, encoding='utf-8', errors='replace') as file:
+                    print(f"--- istanza {nome} ---\n{file.read()[-4000:]}")
+            raise
+        finally:
+            await api.stop()
+        print(f"OK: {in_corso} aggiornamenti smaltiti da A, nessuno perso")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aggiornamenti', type=int, default=400)
+    parser.add_argument('--frequenza', type=float, default=100)
+    parser.add_argument('--latenza', type=float, default=0.05)
+    parser.add_argument('--porta', type=int, default=18092)
+    parser.add_argument('--porta-api', type=int, default=18093)
+    asyncio.run(principale(parser.parse_args()))
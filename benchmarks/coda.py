@@ -0,0 +1,97 @@
+"""Lotto di approvazioni da /coda contro un clic alla volta sulle schede.
+
+Prepara 100 annunci in attesa e li approva in due modi contro la finta Bot API
+con latenza: un clic per scheda, aspettando che ognuno finisca (come un moderatore
+che scorre la chat), e un unico lotto con `modera_lotto`. In entrambi i casi gli
+invii passano dallo scheduler. Il limite per gruppo di Telegram (20 messaggi al
+minuto) renderebbe entrambi lunghissimi: qui è alzato con --gruppo-al-minuto per
+misurare la latenza delle chiamate e non il limite.
+
+Uso: python benchmarks/coda.py [--annunci 100] [--latenza 0.05] [--gruppo-al-minuto 1200]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123:abc')
+os.environ.setdefault('GROUP_CHAT_ID', '-1001')
+os.environ.setdefault('TOPIC_MESSAGE_THREAD_ID', '7')
+os.environ.setdefault('MODERATION_CHAT_ID', '-1002')
+
+PORTA = 18092
+_update_id = itertools.count(1)
+
+
+def clic(scheda: int) -> dict:
+    import main
+    return {'update_id': next(_update_id), 'callback_query': {
+        'id': str(next(_update_id)), 'chat_instance': '1', 'data': f"approve_{scheda}",
+        'from': {'id': 1, 'is_bot': False, 'first_name': 'Moderatore'},
+        'message': {'message_id': scheda, 'date': int(time.time()), 'caption': 'scheda',
+                    'photo': [{'file_id': 'f', 'file_unique_id': 'uf', 'width': 1, 'height': 1}],
+                    'chat': {'id': main.MODERATION_CHAT_ID, 'type': 'supergroup'}}}}
+
+
+async def principale(args) -> None:
+    os.environ['OUTBOX_GROUP_RATE_PER_MINUTE'] = str(args.gruppo_al_minuto)
+    os.environ['OUTBOX_GLOBAL_RATE'] = '1000'
+    from telegram import Update
+    from telegram.ext import Application, CallbackQueryHandler, CallbackContext
+
+    import main
+    from fake_bot_api import FakeBotApi
+    from ad_record import PendingAd
+
+    api = FakeBotApi(latenza=args.latenza)
+    url = await api.start(PORTA)
+    application = (Application.builder().token(main.TOKEN)
+                   .base_url(f"{url}/bot").base_file_url(f"{url}/file/bot").build())
+    application.add_handler(CallbackQueryHandler(main.button_callback, pattern=r'^(approve|reject)_\d+$'))
+    await application.initialize()
+    main.outbox.start()
+
+    def prepara(base: int) -> list[int]:
+        ids = list(range(base, base + args.annunci))
+        for i in ids:
+            # Utenti diversi: le notifiche non si accodano sulla stessa chat privata
+            main.moderazioni.aggiungi(PendingAd(i, 100_000 + i, 'Utente', [f"foto{i}"],
+                                                f"Annuncio {i}", "Descrizione", "Milano", 10.0))
+        return ids
+
+    ids = prepara(1)
+    api.azzera()
+    inizio = time.perf_counter()
+    for scheda in ids:
+        await application.process_update(Update.de_json(clic(scheda), application.bot))
+    uno_alla_volta = time.perf_counter() - inizio
+    chiamate_clic = len(api.chiamate)
+
+    ids = prepara(10_000)
+    api.azzera()
+    context = CallbackContext(application)
+    inizio = time.perf_counter()
+    esiti = await main.modera_lotto(context, ids, True, 'Moderatore')
+    lotto = time.perf_counter() - inizio
+    approvati = sum(1 for _, esito in esiti if esito.startswith('✅'))
+
+    print(f"{args.annunci} annunci, latenza API {args.latenza * 1000:.0f} ms")
+    print(f"un clic alla volta: {uno_alla_volta:6.2f} s ({chiamate_clic} chiamate)")
+    print(f"lotto da /coda:     {lotto:6.2f} s ({len(api.chiamate)} chiamate, {approvati} approvati)")
+    print(f"scheduler: {main.outbox.statistiche()}")
+
+    await main.outbox.stop(timeout=5)
+    await application.shutdown()
+    await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--annunci', type=int, default=100)
+    parser.add_argument('--latenza', type=float, default=0.05)
+    parser.add_argument('--gruppo-al-minuto', type=float, default=1200)
+    asyncio.run(principale(parser.parse_args()))
@@ -0,0 +1,226 @@
+"""Finto server Bot API locale per misurare il bot senza contattare Telegram.
+
+Implementa i metodi usati dal bot e registra ogni chiamata. Si possono simulare
+latenza, errori casuali, limiti di flood per chat e risposte 429 casuali (entrambi
+con `retry_after`, che PTB trasforma in RetryAfter).
+
+Avvio autonomo: python benchmarks/fake_bot_api.py --porta 8081 --latenza 0.05
+Il bot va poi avviato con TELEGRAM_API_BASE_URL=http://127.0.0.1:8081
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from collections import Counter, defaultdict, deque
+from itertools import count
+from typing import Optional
+
+from aiohttp import web
+
+
+class FakeBotApi:
+    def __init__(self, latenza: float = 0.0, errori: float = 0.0,
+                 limite_per_chat: Optional[int] = None, finestra: float = 1.0,
+                 retry_after: int = 1, flood: float = 0.0):
+        self.latenza = latenza
+        self.errori = errori
+        self.flood = flood
+        self.limite_per_chat = limite_per_chat
+        self.finestra = finestra
+        self.retry_after = retry_after
+        self.chiamate: list[tuple[float, str, dict]] = []
+        # Ultimo messaggio inviato o modificato per chat, per costruire le callback dei pulsanti
+        self.ultimi_messaggi: dict[str, dict] = {}
+        self.file: dict[str, bytes] = {}
+        self._message_id = count(1000)
+        self._invii_per_chat: dict[str, deque] = defaultdict(deque)
+        self._webhook: dict = {'url': '', 'allowed_updates': None}
+        self._comandi: list = []
+        self._runner: Optional[web.AppRunner] = None
+        self.app = web.Application()
+        self.app.router.add_route('*', '/bot{token}/{metodo}', self._gestisci)
+        self.app.router.add_get('/file/bot{token}/{percorso:.*}', self._scarica)
+
+    # --- Statistiche ---
+
+    def conteggi(self) -> Counter:
+        return Counter(metodo for _, metodo, _ in self.chiamate)
+
+    def azzera(self) -> None:
+        self.chiamate.clear()
+        self.ultimi_messaggi.clear()
+
+    def chiamate_verso(self, chat_id) -> list[tuple[float, str, dict]]:
+        return [c for c in self.chiamate if str(c[2].get('chat_id')) == str(chat_id)]
+
+    # --- Server ---
+
+    async def start(self, porta: int = 8081, host: str = '127.0.0.1') -> str:
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, host, porta).start()
+        return f"http://{host}:{porta}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def _parametri(self, request: web.Request) -> dict:
+        if request.content_type == 'application/json':
+            return await request.json()
+        dati = await request.post()
+        parametri = {}
+        for chiave, valore in dati.items():
+            if not isinstance(valore, str):
+                continue
+            try:
+                parametri[chiave] = json.loads(valore)
+            except ValueError:
+                parametri[chiave] = valore
+        return parametri
+
+    def _flood(self, chat_id) -> bool:
+        if self.limite_per_chat is None or chat_id is None:
+            return False
+        adesso = time.monotonic()
+        invii = self._invii_per_chat[str(chat_id)]
+        while invii and invii[0] <= adesso - self.finestra:
+            invii.popleft()
+        if len(invii) >= self.limite_per_chat:
+            return True
+        invii.append(adesso)
+        return False
+
+    async def _gestisci(self, request: web.Request) -> web.Response:
+        metodo = request.match_info['metodo']
+        parametri = await self._parametri(request)
+        if self.latenza:
+            await asyncio.sleep(self.latenza)
+        if metodo.startswith('send') and (self._flood(parametri.get('chat_id'))
+                                          or (self.flood and random.random() < self.flood)):
+            return web.json_response({
+                'ok': False, 'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after}}, status=429)
+        if self.errori and random.random() < self.errori:
+            return web.json_response(
+                {'ok': False, 'error_code': 500, 'description': 'Internal Server Error'}, status=500)
+        self.chiamate.append((time.monotonic(), metodo, parametri))
+        gestore = getattr(self, f"_m_{metodo.lower()}", None)
+        risultato = gestore(parametri) if gestore else True
+        if isinstance(risultato, dict) and 'message_id' in risultato:
+            self.ultimi_messaggi[str(parametri.get('chat_id'))] = risultato
+        return web.json_response({'ok': True, 'result': risultato})
+
+    async def _scarica(self, request: web.Request) -> web.Response:
+        contenuto = self.file.get(request.match_info['percorso'])
+        if contenuto is None:
+            return web.Response(status=404)
+        return web.Response(body=contenuto)
+
+    # --- Metodi Bot API ---
+
+    def _messaggio(self, parametri: dict, **campi) -> dict:
+        chat_id = parametri.get('chat_id', 0)
+        messaggio = {
+            'message_id': next(self._message_id),
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id) if str(chat_id).lstrip('-').isdigit() else 0,
+                     'type': 'private' if int(chat_id or 0) > 0 else 'supergroup'},
+        }
+        if parametri.get('message_thread_id'):
+            messaggio['message_thread_id'] = int(parametri['message_thread_id'])
+        messaggio.update(campi)
+        return messaggio
+
+    def _m_getme(self, parametri: dict) -> dict:
+        return {'id': 1, 'is_bot': True, 'first_name': 'AQBazar', 'username': 'aqbazar_bot',
+                'can_join_groups': True, 'can_read_all_group_messages': False,
+                'supports_inline_queries': True}
+
+    def _m_sendmessage(self, parametri: dict) -> dict:
+        return self._messaggio(parametri, text=parametri.get('text', ''))
+
+    def _m_sendphoto(self, parametri: dict) -> dict:
+        photo = parametri.get('photo')
+        return self._messaggio(
+            parametri, photo=[{'file_id': photo, 'file_unique_id': f"u{photo}",
+                               'width': 800, 'height': 600}],
+            **({'caption': parametri['caption']} if parametri.get('caption') else {}))
+
+    def _m_sendmediagroup(self, parametri: dict) -> list:
+        media = parametri.get('media', [])
+        group_id = str(next(self._message_id))
+        return [
+            self._messaggio(
+                parametri, media_group_id=group_id,
+                photo=[{'file_id': m.get('media'), 'file_unique_id': f"u{m.get('media')}",
+                        'width': 800, 'height': 600}],
+                **({'caption': m['caption']} if m.get('caption') else {}))
+            for m in media
+        ]
+
+    def _m_editmessagetext(self, parametri: dict) -> dict:
+        return self._messaggio(parametri, message_id=int(parametri.get('message_id', 0)),
+                               text=parametri.get('text', ''))
+
+    def _m_editmessagecaption(self, parametri: dict) -> dict:
+        return self._messaggio(parametri, message_id=int(parametri.get('message_id', 0)),
+                               caption=parametri.get('caption', ''))
+
+    def _m_editmessagereplymarkup(self, parametri: dict) -> dict:
+        return self._messaggio(parametri, message_id=int(parametri.get('message_id', 0)),
+                               text='')
+
+    def _m_setwebhook(self, parametri: dict) -> bool:
+        self._webhook = {'url': parametri.get('url', ''),
+                         'allowed_updates': parametri.get('allowed_updates')}
+        return True
+
+    def _m_deletewebhook(self, parametri: dict) -> bool:
+        self._webhook = {'url': '', 'allowed_updates': None}
+        return True
+
+    def _m_getwebhookinfo(self, parametri: dict) -> dict:
+        info = {'url': self._webhook['url'], 'has_custom_certificate': False,
+                'pending_update_count': 0}
+        if self._webhook['allowed_updates'] is not None:
+            info['allowed_updates'] = self._webhook['allowed_updates']
+        return info
+
+    def _m_setmycommands(self, parametri: dict) -> bool:
+        self._comandi = parametri.get('commands', [])
+        return True
+
+    def _m_getmycommands(self, parametri: dict) -> list:
+        return self._comandi
+
+    def _m_getfile(self, parametri: dict) -> dict:
+        file_id = parametri.get('file_id', '')
+        percorso = f"photos/{file_id}.jpg"
+        return {'file_id': file_id, 'file_unique_id': f"u{file_id}",
+                'file_size': len(self.file.get(percorso, b'')), 'file_path': percorso}
+
+
+async def _principale(args) -> None:
+    api = FakeBotApi(latenza=args.latenza, errori=args.errori,
+                     limite_per_chat=args.limite_per_chat, flood=args.flood)
+    url = await api.start(args.porta)
+    print(f"Finta Bot API in ascolto su {url}")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            print(dict(api.conteggi()))
+    finally:
+        await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--porta', type=int, default=8081)
+    parser.add_argument('--latenza', type=float, default=0.0)
+    parser.add_argument('--errori', type=float, default=0.0)
+    parser.add_argument('--limite-per-chat', type=int, default=None)
+    parser.add_argument('--flood', type=float, default=0.0)
+    asyncio.run(_principale(parser.parse_args()))
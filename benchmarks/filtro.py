@@ -0,0 +1,137 @@
+"""Tempo di scansione del filtro dei contenuti al crescere del numero di regole.
+
+Per ogni numero di termini vietati misura `ContentFilter.esamina` su testi lunghi
+come una descrizione (circa 800 caratteri) contro il controllo ingenuo, un `in`
+per ogni termine, e contro un'unica regex con tutti i termini in alternativa. Il
+filtro deve restare piatto: il suo costo dipende dalla lunghezza del testo, non
+dal numero di regole. Verifica anche che filtro e controllo ingenuo trovino gli
+stessi termini e che il file delle regole venga ricaricato quando cambia, e che
+le regole predefinite riconoscano telefoni e link senza scattare su date, codici
+ISBN, prezzi e nomi di marche.
+
+Uso: python benchmarks/filtro.py [--termini 10 1000 10000 100000] [--testi 200]
+"""
+import argparse
+import json
+import os
+import random
+import re
+import string
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from catalog import normalizza  # noqa: E402
+from content_filter import BLOCCA, SEGNALA, ContentFilter  # noqa: E402
+
+PAROLE = ("libro usato ottime condizioni copertina rigida prima edizione spedizione "
+          "ritiro a mano prezzo trattabile fantascienza collana completa volumi").split()
+
+
+def termine_casuale() -> str:
+    return ''.join(random.choices(string.ascii_lowercase, k=random.randint(5, 10)))
+
+
+def testo_casuale(termini: list[str], con_vietato: bool) -> str:
+    parole = random.choices(PAROLE, k=110)
+    if con_vietato:
+        parole.insert(random.randrange(len(parole)), random.choice(termini))
+    return ' '.join(parole)[:800]
+
+
+def scrivi_regole(path: str, termini: list[str]) -> None:
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump({BLOCCA: termini[::2], SEGNALA: termini[1::2], 'espressioni': []}, file)
+
+
+def media(funzione, testi: list[str]) -> float:
+    inizio = time.perf_counter()
+    for testo in testi:
+        funzione(testo)
+    return (time.perf_counter() - inizio) / len(testi)
+
+
+def misura(n: int, numero_testi: int, cartella: str) -> None:
+    random.seed(n)
+    termini = sorted({termine_casuale() for _ in range(n)})
+    path = os.path.join(cartella, f'regole_{n}.json')
+    scrivi_regole(path, termini)
+    filtro = ContentFilter(path)
+    inizio = time.perf_counter()
+    assert filtro.ricarica()
+    caricamento = time.perf_counter() - inizio
+    testi = [testo_casuale(termini, i % 2 == 0) for i in range(numero_testi)]
+
+    def ingenuo(testo: str) -> set[str]:
+        parole = set(normalizza(testo).split())
+        return {termine for termine in termini if termine in parole}
+
+    alternativa = re.compile(r'\b(?:' + '|'.join(map(re.escape, termini)) + r')\b')
+
+    for testo in testi:
+        trovati = {v.motivo for v in filtro.esamina(testo)}
+        assert trovati == {f"la parola «{t}»" for t in ingenuo(testo)}
+    tempo_filtro = media(filtro.esamina, testi)
+    tempo_ingenuo = media(ingenuo, testi)
+    tempo_regex = media(lambda testo: alternativa.findall(normalizza(testo)), testi)
+    print(f"{len(termini):>7} termini (caricamento {caricamento:5.2f} s): filtro {tempo_filtro * 1e6:7.1f} µs | "
+          f"un 'in' per termine {tempo_ingenuo * 1e6:9.1f} µs | regex in alternativa {tempo_regex * 1e6:8.1f} µs")
+
+
+def ricarica(cartella: str) -> None:
+    path = os.path.join(cartella, 'regole_ricarica.json')
+    scrivi_regole(path, ['tarocco'])
+    filtro = ContentFilter(path)
+    assert filtro.ricarica()
+    assert filtro.esamina("borsa tarocco") and not filtro.esamina("borsa originale")
+    assert not filtro.ricarica()
+    # File non valido: restano le regole attuali
+    with open(path, 'w', encoding='utf-8') as file:
+        file.write('{"blocca": [')
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000))
+    assert not filtro.ricarica() and filtro.esamina("borsa tarocco")
+    scrivi_regole(path, ['originale'])
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 2_000_000))
+    assert filtro.ricarica()
+    assert not filtro.esamina("borsa tarocco") and filtro.esamina("borsa originale")
+    print("ricarica a caldo: ok (file non valido ignorato, nuove regole attive senza riavvio)")
+
+
+# Testo -> motivi attesi con le regole predefinite (senza file delle regole)
+CASI_PREDEFINITI = {
+    "Acquistati il 12/05/2023": {},
+    "Fattura del 03.05.2023": {},
+    "ISBN 9788804668237": {},
+    "ISBN 978-88-04-66823-7": {},
+    "Lotto 1 2 3 4 5 6 7 8 9": {},
+    "Prezzo € 1.250,00, trattabile": {},
+    "Anno 2019, 35000 km": {},
+    "Originale Samsung.it": {"un indirizzo web": SEGNALA},
+    "Chiamami al 333 123 4567.": {"un numero di telefono": BLOCCA},
+    "Tel. +39 3331234567": {"un numero di telefono": BLOCCA},
+    "Fisso 06-12345678": {"un numero di telefono": BLOCCA},
+    "Dettagli su https://negozio.it/offerta": {"un link": BLOCCA},
+    "Vedi www.negozio.com": {"un link": BLOCCA},
+}
+
+
+def predefinite() -> None:
+    filtro = ContentFilter()
+    for testo, attesi in CASI_PREDEFINITI.items():
+        trovati = {v.motivo: v.azione for v in filtro.esamina(testo)}
+        assert trovati == attesi, f"{testo!r}: {trovati} invece di {attesi}"
+    print(f"regole predefinite: ok ({len(CASI_PREDEFINITI)} casi tra date, ISBN, prezzi, marche, telefoni e link)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--termini', type=int, nargs='+', default=[10, 1000, 10000, 100000])
+    parser.add_argument('--testi', type=int, default=200)
+    args = parser.parse_args()
+    with tempfile.TemporaryDirectory() as cartella:
+        for n in args.termini:
+            misura(n, args.testi, cartella)
+        ricarica(cartella)
+    predefinite()
@@ -0,0 +1,115 @@
+"""Ricerca delle foto già inviate nell'indice delle impronte.
+
+Per ogni numero di impronte misura `PhotoIndex.simili` (tempo medio e p99) contro
+la scansione lineare di tutti gli hash, su interrogazioni che per metà sono foto
+nuove e per metà copie leggermente alterate di foto già presenti; verifica anche
+che i risultati coincidano. Gli hash casuali uniformi sono il caso peggiore per
+l'indice: gli hash di foto vere sono più concentrati.
+
+Con Pillow installato misura anche `dhash` e la distanza tra una foto e le sue
+versioni ricompresse, ridimensionate e ritagliate.
+
+Uso: python benchmarks/impronte.py [--impronte 10000 100000 200000] [--ricerche 500]
+"""
+import argparse
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from photo_index import PILLOW, Fingerprint, PhotoIndex, dhash  # noqa: E402
+
+if PILLOW:
+    from PIL import Image
+
+
+def percentile(valori: list[float], p: float) -> float:
+    return sorted(valori)[min(len(valori) - 1, int(len(valori) * p))]
+
+
+def altera(hash: int, bit: int) -> int:
+    for posizione in random.sample(range(64), bit):
+        hash ^= 1 << posizione
+    return hash
+
+
+def misura(n: int, ricerche: int, distanza: int) -> None:
+    random.seed(n)
+    indice = PhotoIndex(distanza)
+    hashes = [random.getrandbits(64) for _ in range(n)]
+    inizio = time.perf_counter()
+    indice.aggiungi(Fingerprint(f"f{i}", h, i, i % 5000, 0) for i, h in enumerate(hashes))
+    costruzione = time.perf_counter() - inizio
+
+    interrogazioni = [altera(random.choice(hashes), random.randint(0, distanza)) if i % 2
+                      else random.getrandbits(64) for i in range(ricerche)]
+    tempi_indice, tempi_lineare, trovate = [], [], 0
+    for h in interrogazioni:
+        inizio = time.perf_counter()
+        risultato = indice.simili(h)
+        tempi_indice.append(time.perf_counter() - inizio)
+        inizio = time.perf_counter()
+        lineare = {f"f{i}" for i, altro in enumerate(hashes) if (altro ^ h).bit_count() <= distanza}
+        tempi_lineare.append(time.perf_counter() - inizio)
+        assert lineare == {impronta.file_unique_id for _, impronta in risultato}
+        trovate += bool(risultato)
+    print(f"{n:>7} impronte (costruzione {costruzione:5.2f} s): indice media "
+          f"{sum(tempi_indice) / ricerche * 1000:6.3f} ms p99 {percentile(tempi_indice, 0.99) * 1000:6.3f} ms | "
+          f"lineare media {sum(tempi_lineare) / ricerche * 1000:7.2f} ms | {trovate}/{ricerche} con simili")
+
+
+def immagine_di_prova(lato: int = 800) -> 'Image.Image':
+    random.seed(0)
+    immagine = Image.new('RGB', (lato, lato))
+    pixel = immagine.load()
+    # Sfondo a gradiente con qualche rettangolo, per avere strutture come in una foto
+    for y in range(lato):
+        for x in range(lato):
+            pixel[x, y] = (x * 255 // lato, y * 255 // lato, 128)
+    for _ in range(12):
+        x, y = random.randrange(lato - 100), random.randrange(lato - 100)
+        colore = tuple(random.randrange(256) for _ in range(3))
+        immagine.paste(colore, (x, y, x + random.randint(40, 200), y + random.randint(40, 200)))
+    return immagine
+
+
+def jpeg(immagine, qualita: int = 85) -> bytes:
+    buffer = io.BytesIO()
+    immagine.save(buffer, 'JPEG', quality=qualita)
+    return buffer.getvalue()
+
+
+def robustezza(ripetizioni: int = 50) -> None:
+    originale = immagine_di_prova()
+    base = jpeg(originale)
+    inizio = time.perf_counter()
+    for _ in range(ripetizioni):
+        h = dhash(base)
+    print(f"dhash: {(time.perf_counter() - inizio) / ripetizioni * 1000:.2f} ms per JPEG 800x800")
+    lato = originale.width
+    varianti = {
+        'ricompressa (qualità 40)': jpeg(originale, 40),
+        'ridimensionata al 50%': jpeg(originale.resize((lato // 2, lato // 2))),
+        'ritagliata del 3%': jpeg(originale.crop((12, 12, lato - 12, lato - 12))),
+        'ritagliata del 6%': jpeg(originale.crop((24, 24, lato - 24, lato - 24))),
+        'ruotata di 180°': jpeg(originale.rotate(180)),
+    }
+    for nome, contenuto in varianti.items():
+        print(f"  {nome:<26} distanza {(dhash(contenuto) ^ h).bit_count():2d}/64")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--impronte', type=int, nargs='+', default=[10000, 100000, 200000])
+    parser.add_argument('--ricerche', type=int, default=500)
+    parser.add_argument('--distanza', type=int, default=8)
+    args = parser.parse_args()
+    for n in args.impronte:
+        misura(n, args.ricerche, args.distanza)
+    if PILLOW:
+        robustezza()
+    else:
+        print("Pillow non installato: dhash non misurato")
@@ -0,0 +1,81 @@
+"""Raffica di approvazioni verso il gruppo contro la finta Bot API con limiti di flood.
+
+Confronta gli invii diretti (come faceva il bot prima dello scheduler) con gli invii
+tramite SendScheduler: messaggi persi per 429, tempo totale, attese in coda e ordine
+di uscita per priorità.
+
+Uso: python benchmarks/invii.py [--annunci 40] [--limite 5]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from telegram import Bot  # noqa: E402
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+from send_scheduler import (PRIORITA_MODERAZIONE, PRIORITA_PUBBLICAZIONE,  # noqa: E402
+                            PRIORITA_UTENTE, SendScheduler)
+
+GRUPPO = -1001
+MODERAZIONE = -1002
+
+
+async def approvazione(bot: Bot, outbox: SendScheduler, i: int) -> None:
+    await outbox.invia(GRUPPO, PRIORITA_PUBBLICAZIONE, bot.send_message,
+                       chat_id=GRUPPO, text=f"Annuncio {i}", message_thread_id=7)
+    await asyncio.gather(
+        outbox.invia(MODERAZIONE, PRIORITA_MODERAZIONE, bot.edit_message_text,
+                     chat_id=MODERAZIONE, message_id=i, text=f"✅ Approvato {i}"),
+        outbox.invia(10_000 + i, PRIORITA_UTENTE, bot.send_message,
+                     chat_id=10_000 + i, text="✅ Il tuo annuncio è stato approvato"))
+
+
+async def esegui(api: FakeBotApi, url: str, annunci: int, scheduler: bool,
+                 limite: int) -> None:
+    api.azzera()
+    bot = Bot('123:abc', base_url=f"{url}/bot")
+    await bot.initialize()
+    outbox = SendScheduler(global_rate=30, group_rate=limite * 0.9, group_burst=limite)
+    if scheduler:
+        outbox.start()
+    inizio = time.perf_counter()
+    esiti = await asyncio.gather(*(approvazione(bot, outbox, i) for i in range(annunci)),
+                                 return_exceptions=True)
+    durata = time.perf_counter() - inizio
+    await outbox.stop()
+    await bot.shutdown()
+    persi = sum(isinstance(e, Exception) for e in esiti)
+    pubblicati = sum(1 for _, metodo, p in api.chiamate
+                     if metodo == 'sendMessage' and str(p.get('chat_id')) == str(GRUPPO))
+    nome = 'scheduler' if scheduler else 'diretto'
+    print(f"{nome:10} pubblicati {pubblicati}/{annunci}, approvazioni fallite {persi}, "
+          f"tempo {durata:.2f}s")
+    if scheduler:
+        stat = outbox.statistiche()
+        print(f"{'':10} attesa in coda p50 {stat['attesa_p50'] * 1000:.0f} ms, "
+              f"p99 {stat['attesa_p99'] * 1000:.0f} ms, ritentati {stat['ritentati']}")
+
+
+async def principale(args) -> None:
+    api = FakeBotApi(latenza=args.latenza, limite_per_chat=args.limite, retry_after=1)
+    url = await api.start(args.porta)
+    try:
+        await esegui(api, url, args.annunci, scheduler=False, limite=args.limite)
+        await asyncio.sleep(1.5)
+        await esegui(api, url, args.annunci, scheduler=True, limite=args.limite)
+    finally:
+        await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--annunci', type=int, default=40)
+    parser.add_argument('--limite', type=int, default=5,
+                        help="messaggi al secondo accettati dalla finta API per ogni chat")
+    parser.add_argument('--latenza', type=float, default=0.02)
+    parser.add_argument('--porta', type=int, default=18091)
+    asyncio.run(principale(parser.parse_args()))
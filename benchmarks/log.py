@@ -0,0 +1,140 @@
+"""Costo del logging per aggiornamento nel loop degli eventi, prima e dopo la coda di log.
+
+Simula `--aggiornamenti` passi di compilazione di un annuncio (foto, titolo,
+descrizione, località, prezzo), ognuno con la traccia dell'aggiornamento attiva
+come in processa_payload, e misura il tempo speso dal loop nelle chiamate di log:
+
+- prima: StreamHandler sincrono di basicConfig, messaggi formattati subito con il
+  testo dell'utente e il record di httpx per la risposta inviata;
+- dopo: record JSON messi in coda e scritti da un thread, con e senza il
+  campionamento di default degli eventi frequenti.
+
+Ogni configurazione scrive su un file e su una destinazione lenta (`--lento`
+millisecondi per scrittura, come un terminale o una pipe piena): con la coda il
+loop non aspetta la scrittura, al più i record in eccesso vengono scartati.
+
+Uso: python benchmarks/log.py [--aggiornamenti 20000] [--lento 0.2]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from diagnostics import UpdateTrace, traccia_corrente  # noqa: E402
+from log_pipeline import FORMATO_TESTO, configura_logging, record_scartati  # noqa: E402
+
+CAMPIONAMENTO = {'foto_ricevuta': 10, 'campo_ricevuto': 10}
+TESTI = {'title': 'Lotto di libri usati', 'description': 'Libri in buono stato, qualche sottolineatura',
+         'location': 'Milano'}
+PREZZO = 25.5
+
+
+class Lento:
+    """Destinazione che impiega `ritardo` secondi per ogni scrittura."""
+
+    def __init__(self, ritardo: float):
+        self.ritardo = ritardo
+
+    def write(self, testo: str) -> None:
+        time.sleep(self.ritardo)
+
+    def flush(self) -> None:
+        pass
+
+
+def prima(logger, httpx, passo: int, update_id: int) -> None:
+    if passo == 0:
+        logger.info(f"Ricevuta foto: AgACAgQAAxkBAAI{update_id}")
+    elif passo == 4:
+        logger.info(f"Prezzo ricevuto: {PREZZO}")
+    else:
+        campo = ('title', 'description', 'location')[passo - 1]
+        logger.info(f"{campo.capitalize()} ricevuto: {TESTI[campo]}")
+    httpx.info('HTTP Request: POST https://api.telegram.org/bot123:abc/sendMessage "HTTP/1.1 200 OK"')
+
+
+def dopo(logger, httpx, passo: int, update_id: int) -> None:
+    if passo == 0:
+        logger.info("Ricevuta foto", extra={'evento': 'foto_ricevuta', 'file_id': f"AgACAgQAAxkBAAI{update_id}"})
+    elif passo == 4:
+        logger.info("Prezzo ricevuto", extra={'evento': 'campo_ricevuto', 'campo': 'price', 'prezzo': PREZZO})
+    else:
+        campo = ('title', 'description', 'location')[passo - 1]
+        logger.info("Campo ricevuto", extra={'evento': 'campo_ricevuto', 'campo': campo, 'testo': TESTI[campo]})
+    httpx.info('HTTP Request: POST https://api.telegram.org/bot123:abc/sendMessage "HTTP/1.1 200 OK"')
+
+
+async def misura(aggiornamenti: int, chiamata) -> float:
+    """Microsecondi per aggiornamento spesi nelle chiamate di log."""
+    logger = logging.getLogger('main')
+    httpx = logging.getLogger('httpx')
+    totale = 0.0
+    for update_id in range(aggiornamenti):
+        token = traccia_corrente.set(UpdateTrace(update_id, 'message', update_id % 500))
+        traccia_corrente.get().handler_corrente = 'ricevi_titolo'
+        inizio = time.perf_counter()
+        chiamata(logger, httpx, update_id % 5, update_id)
+        totale += time.perf_counter() - inizio
+        traccia_corrente.reset(token)
+    return totale / aggiornamenti * 1e6
+
+
+def configura_prima(flusso) -> logging.Handler:
+    radice = logging.getLogger()
+    for vecchio in radice.handlers[:]:
+        radice.removeHandler(vecchio)
+        vecchio.close()
+    gestore = logging.StreamHandler(flusso)
+    gestore.setFormatter(logging.Formatter(FORMATO_TESTO))
+    radice.addHandler(gestore)
+    radice.setLevel(logging.INFO)
+    logging.getLogger('httpx').setLevel(logging.NOTSET)
+    return gestore
+
+
+def configura_dopo(flusso, campionamento: dict) -> logging.Handler:
+    gestore = configura_logging('INFO', 'json', campionamento, flusso=flusso)
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    return gestore
+
+
+async def principale(args) -> None:
+    configurazioni = [
+        ('prima (sincrono, testo)', configura_prima, prima),
+        ('dopo (coda, JSON)', lambda flusso: configura_dopo(flusso, {}), dopo),
+        ('dopo (coda, JSON, campionato)', lambda flusso: configura_dopo(flusso, CAMPIONAMENTO), dopo),
+    ]
+    print(f"{args.aggiornamenti} aggiornamenti, destinazione lenta {args.lento:g} ms per scrittura")
+    with tempfile.TemporaryDirectory() as cartella:
+        for nome, configura, chiamata in configurazioni:
+            for destinazione in ('file', 'lenta'):
+                if destinazione == 'file':
+                    flusso = open(os.path.join(cartella, 'log.txt'), 'w', encoding='utf-8')
+                    aggiornamenti = args.aggiornamenti
+                else:
+                    flusso = Lento(args.lento / 1000)
+                    # Con la scrittura sincrona ogni record costa `lento` ms: bastano meno passi
+                    aggiornamenti = min(args.aggiornamenti, 2000)
+                gestore = configura(flusso)
+                costo = await misura(aggiornamenti, chiamata)
+                inizio = time.perf_counter()
+                scartati = record_scartati(gestore) if hasattr(gestore, 'ascoltatore') else None
+                gestore.close()
+                svuotamento = time.perf_counter() - inizio
+                if destinazione == 'file':
+                    flusso.close()
+                dettagli = f"svuotamento coda {svuotamento * 1000:6.0f} ms, scartati {scartati}" if scartati else ''
+                print(f"  {nome:32} {destinazione:6} {costo:8.1f} µs per aggiornamento  {dettagli}")
+    logging.getLogger().handlers.clear()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aggiornamenti', type=int, default=20000)
+    parser.add_argument('--lento', type=float, default=0.2, help="millisecondi per scrittura della destinazione lenta")
+    asyncio.run(principale(parser.parse_args()))
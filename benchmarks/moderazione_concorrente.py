@@ -0,0 +1,161 @@
+"""Raffica di clic concorrenti sulla stessa scheda di moderazione.
+
+Per ogni scheda più moderatori premono insieme ✅ Approva e ❌ Rifiuta; le callback
+vengono elaborate in parallelo da `button_callback` contro la finta Bot API, con
+latenza, così le chiamate di rete si intrecciano. Verifica che per ogni scheda
+vinca una sola decisione: al massimo una pubblicazione nel gruppo, una sola
+notifica all'utente, una sola modifica della scheda, e che tutti gli altri clic
+ricevano soltanto la risposta "già gestito".
+
+Controlla anche `rivendica`/`rilascia` da soli e il caso in cui la risposta al
+primo clic fallisce: la rivendicazione va rilasciata, la scheda resta in sospeso e
+la raffica successiva la decide una volta sola. Ogni controllo è un assert.
+
+Uso: python benchmarks/moderazione_concorrente.py [--schede 50] [--clic 20] [--latenza 0.02]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import sys
+import time
+from typing import Optional
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123:abc')
+os.environ.setdefault('GROUP_CHAT_ID', '-1001')
+os.environ.setdefault('TOPIC_MESSAGE_THREAD_ID', '7')
+os.environ.setdefault('MODERATION_CHAT_ID', '-1002')
+
+from aiohttp import web  # noqa: E402
+from telegram import Update  # noqa: E402
+from telegram.ext import Application, CallbackQueryHandler  # noqa: E402
+
+import main  # noqa: E402
+from fake_bot_api import FakeBotApi  # noqa: E402
+from ad_record import PendingAd  # noqa: E402
+from moderation_store import ModerationStore  # noqa: E402
+
+PORTA = 18091
+_update_id = itertools.count(1)
+
+
+class ApiConRisposteFallite(FakeBotApi):
+    """Finta Bot API che fa fallire la risposta alle callback con gli id indicati."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fallite: set[str] = set()
+
+    async def _gestisci(self, request):
+        if request.match_info['metodo'] == 'answerCallbackQuery':
+            if str((await self._parametri(request)).get('callback_query_id')) in self.fallite:
+                return web.json_response(
+                    {'ok': False, 'error_code': 400, 'description': 'Bad Request: query is too old'}, status=400)
+        return await super()._gestisci(request)
+
+
+def clic(scheda: int, moderatore: int, azione: str, callback_id: Optional[str] = None) -> dict:
+    return {'update_id': next(_update_id), 'callback_query': {
+        'id': callback_id or str(next(_update_id)), 'chat_instance': '1', 'data': f"{azione}_{scheda}",
+        'from': {'id': moderatore, 'is_bot': False, 'first_name': f"Moderatore{moderatore}"},
+        'message': {'message_id': scheda, 'date': int(time.time()), 'text': 'scheda',
+                    'chat': {'id': main.MODERATION_CHAT_ID, 'type': 'supergroup'}}}}
+
+
+def rivendicazioni() -> None:
+    """`rivendica` e `rilascia` su una scheda, senza Bot API."""
+    store = ModerationStore()
+    assert not store.rivendica(1, "Anna")
+    store.aggiungi(PendingAd(1, 10, "Utente", [], "Annuncio", "Descrizione", "Milano", 10.0))
+    assert store.rivendica(1, "Anna") and not store.rivendica(1, "Bruno")
+    assert store.gestito_da(1) == "Anna"
+    store.rilascia(1)
+    assert store.gestito_da(1) is None and store.rivendica(1, "Bruno")
+    assert store.rimuovi(1) is not None
+    assert store.gestito_da(1) == "Bruno" and not store.rivendica(1, "Anna")
+
+
+def decisioni(api: FakeBotApi, scheda: int) -> tuple[int, int, int]:
+    """Pubblicazioni, notifiche all'utente e modifiche della scheda registrate per `scheda`."""
+    pubblicazioni = [p for _, m, p in api.chiamate_verso(main.GROUP_CHAT_ID)
+                     if p.get('text', '').find(f"Annuncio {scheda}\n") >= 0]
+    notifiche = api.chiamate_verso(50_000 + scheda)
+    modifiche = [p for _, m, p in api.chiamate_verso(main.MODERATION_CHAT_ID)
+                 if m == 'editMessageText' and int(p.get('message_id')) == scheda]
+    return len(pubblicazioni), len(notifiche), len(modifiche)
+
+
+async def principale(args) -> None:
+    rivendicazioni()
+    api = ApiConRisposteFallite(latenza=args.latenza)
+    url = await api.start(PORTA)
+    application = (Application.builder().token(main.TOKEN)
+                   .base_url(f"{url}/bot").base_file_url(f"{url}/file/bot").build())
+    application.add_handler(CallbackQueryHandler(main.button_callback, pattern=r'^(approve|reject)_\d+$'))
+    application.add_error_handler(main.errore_handler)
+    await application.initialize()
+    # Scheduler non avviato: gli invii partono subito e si sovrappongono il più possibile
+    random.seed(1)
+    schede = range(1, args.schede + 1)
+    for scheda in schede:
+        main.moderazioni.aggiungi(PendingAd(
+            scheda, 50_000 + scheda, f"Utente{scheda}", [], f"Annuncio {scheda}",
+            "Descrizione", "Milano", 10.0))
+
+    aggiornamenti = [Update.de_json(clic(scheda, random.randrange(1, 6),
+                                         random.choice(('approve', 'reject'))), application.bot)
+                     for scheda in schede for _ in range(args.clic)]
+    random.shuffle(aggiornamenti)
+    inizio = time.perf_counter()
+    await asyncio.gather(*(application.process_update(u) for u in aggiornamenti))
+    durata = time.perf_counter() - inizio
+
+    risposte = [p for _, metodo, p in api.chiamate if metodo == 'answerCallbackQuery']
+    gia_gestiti = sum(1 for p in risposte if 'già gestito' in str(p.get('text', '')))
+    totale = len(aggiornamenti)
+    print(f"{totale} clic su {args.schede} schede in {durata:.2f}s")
+    print(f"risposte alle callback: {len(risposte)}, di cui 'già gestito': {gia_gestiti} "
+          f"(attese {totale - args.schede})")
+    print(f"chiamate alla Bot API: {dict(api.conteggi())}")
+    for scheda in schede:
+        pubblicate, notifiche, modifiche = decisioni(api, scheda)
+        assert pubblicate <= 1 and notifiche == 1 and modifiche == 1, \
+            f"scheda {scheda}: {pubblicate} pubblicazioni, {notifiche} notifiche, {modifiche} modifiche"
+    assert len(risposte) == totale and gia_gestiti == totale - args.schede
+    assert len(main.moderazioni) == 0
+
+    # Risposta al primo clic fallita: la scheda torna libera e viene decisa dalla raffica dopo
+    seconde = range(args.schede + 1, 2 * args.schede + 1)
+    for scheda in seconde:
+        main.moderazioni.aggiungi(PendingAd(
+            scheda, 50_000 + scheda, f"Utente{scheda}", [], f"Annuncio {scheda}",
+            "Descrizione", "Milano", 10.0))
+    api.fallite = {f"primo-{scheda}" for scheda in seconde}
+    await asyncio.gather(*(application.process_update(Update.de_json(
+        clic(scheda, 1, 'approve', f"primo-{scheda}"), application.bot)) for scheda in seconde))
+    for scheda in seconde:
+        assert scheda in main.moderazioni and main.moderazioni.gestito_da(scheda) is None, scheda
+        assert decisioni(api, scheda) == (0, 0, 0), scheda
+    await asyncio.gather(*(application.process_update(Update.de_json(
+        clic(scheda, random.randrange(1, 6), random.choice(('approve', 'reject'))), application.bot))
+        for scheda in seconde for _ in range(args.clic)))
+    for scheda in seconde:
+        pubblicate, notifiche, modifiche = decisioni(api, scheda)
+        assert pubblicate <= 1 and notifiche == 1 and modifiche == 1, \
+            f"scheda {scheda} dopo il rilascio: {pubblicate} pubblicazioni, {notifiche} notifiche, {modifiche} modifiche"
+    assert len(main.moderazioni) == 0
+    print("OK: una sola decisione per scheda, anche dopo una rivendicazione rilasciata")
+
+    await application.shutdown()
+    await api.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--schede', type=int, default=50)
+    parser.add_argument('--clic', type=int, default=20)
+    parser.add_argument('--latenza', type=float, default=0.02)
+    asyncio.run(principale(parser.parse_args()))
@@ -0,0 +1,107 @@
+"""Confronta DictPersistence e SQLitePersistence sul ciclo di persistenza dell'Application.
+
+Simula il lavoro che l'Application svolge per ogni aggiornamento (refresh dei dati
+dell'utente, modifica della bozza, cambio di stato della conversazione) e, ogni
+`--intervallo` aggiornamenti, il giro di `update_persistence` con le copie profonde.
+Misura anche il tempo di avvio a freddo con uno storico di `--storico` utenti.
+
+Uso: python benchmarks/persistenza.py [--aggiornamenti 20000] [--utenti 2000]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+from copy import deepcopy
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from telegram.ext import DictPersistence  # noqa: E402
+
+from sqlite_persistence import SQLitePersistence  # noqa: E402
+
+
+def bozza(i: int) -> dict:
+    return {
+        'photos': [f"AgACAgQAAxkBAAI{i:08d}{n}" for n in range(3)],
+        'title': f"Lotto di {i % 50} libri di fantascienza",
+        'description': "Libri in ottime condizioni, qualche segno d'uso sulle copertine. " * 3,
+        'location': random.choice(['Milano', 'Roma', 'Torino', 'Napoli']),
+        'price': 25.5,
+    }
+
+
+async def ciclo(persistence, aggiornamenti: int, utenti: int, intervallo: int) -> float:
+    user_data: dict[int, dict] = {}
+    await persistence.get_user_data()
+    await persistence.get_conversations('annuncio')
+    toccati: set[int] = set()
+    conversazioni: dict[tuple, int] = {}
+    inizio = time.perf_counter()
+    for n in range(aggiornamenti):
+        user_id = random.randrange(utenti)
+        dati = user_data.setdefault(user_id, {})
+        await persistence.refresh_user_data(user_id, dati)
+        dati.update(bozza(n))
+        toccati.add(user_id)
+        conversazioni[(user_id, user_id)] = n % 7
+        if n % intervallo == intervallo - 1:
+            await asyncio.gather(
+                *(persistence.update_user_data(u, deepcopy(user_data[u])) for u in toccati),
+                *(persistence.update_conversation('annuncio', k, v) for k, v in conversazioni.items()))
+            toccati.clear()
+            conversazioni.clear()
+    await persistence.flush()
+    return time.perf_counter() - inizio
+
+
+async def avvio_a_freddo(path: str, storico: int) -> tuple[float, float]:
+    persistence = SQLitePersistence(path)
+    for u in range(storico):
+        await persistence.update_user_data(u, bozza(u))
+    await persistence.flush()
+
+    inizio = time.perf_counter()
+    lenta = SQLitePersistence(path)
+    await lenta.get_user_data()
+    await lenta.get_conversations('annuncio')
+    sqlite_avvio = time.perf_counter() - inizio
+
+    dict_persistence = DictPersistence()
+    for u in range(storico):
+        await dict_persistence.update_user_data(u, bozza(u))
+    snapshot = dict_persistence.user_data_json
+    inizio = time.perf_counter()
+    await DictPersistence(user_data_json=snapshot).get_user_data()
+    dict_avvio = time.perf_counter() - inizio
+    return sqlite_avvio, dict_avvio
+
+
+async def principale(args) -> None:
+    random.seed(1)
+    with tempfile.TemporaryDirectory() as cartella:
+        risultati = {
+            'DictPersistence': await ciclo(
+                DictPersistence(), args.aggiornamenti, args.utenti, args.intervallo),
+            'SQLitePersistence': await ciclo(
+                SQLitePersistence(os.path.join(cartella, 'bench.db'), flush_interval=0.05),
+                args.aggiornamenti, args.utenti, args.intervallo),
+        }
+        for nome, durata in risultati.items():
+            print(f"{nome:18} {args.aggiornamenti / durata:10.0f} aggiornamenti/s ({durata:.2f}s)")
+        sqlite_avvio, dict_avvio = await avvio_a_freddo(
+            os.path.join(cartella, 'storico.db'), args.storico)
+        print(f"Avvio a freddo con {args.storico} utenti: SQLite {sqlite_avvio * 1000:.1f} ms, "
+              f"DictPersistence da JSON {dict_avvio * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aggiornamenti', type=int, default=20000)
+    parser.add_argument('--utenti', type=int, default=2000)
+    parser.add_argument('--intervallo', type=int, default=500,
+                        help="aggiornamenti tra due giri di update_persistence")
+    parser.add_argument('--storico', type=int, default=20000)
+    asyncio.run(principale(parser.parse_args()))
@@ -0,0 +1,73 @@
+"""Costo per aggiornamento di rumore del gruppo: parse completo contro prefiltro.
+
+Genera messaggi, modifiche, reazioni ed eventi di membri del gruppo degli annunci e
+confronta `json.loads` + `Update.de_json` (il percorso di prima) con
+`carica_json` + `UpdatePrefilter.motivo_scarto`.
+
+Uso: python benchmarks/prefiltro.py [--aggiornamenti 20000]
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from telegram import Bot, Update  # noqa: E402
+
+from update_filter import UpdatePrefilter, carica_json  # noqa: E402
+
+GRUPPO = -1001234567890
+
+
+def rumore(update_id: int) -> dict:
+    utente = {'id': random.randrange(10 ** 9), 'is_bot': False, 'first_name': 'Mario',
+              'username': 'mario', 'language_code': 'it'}
+    chat = {'id': GRUPPO, 'type': 'supergroup', 'title': 'AQBazar', 'is_forum': True}
+    messaggio = {'message_id': update_id, 'date': 1700000000, 'chat': chat, 'from': utente,
+                 'message_thread_id': 7, 'is_topic_message': True,
+                 'text': "Ciao, il lotto di libri è ancora disponibile? Grazie mille!"}
+    tipo = random.random()
+    if tipo < 0.6:
+        return {'update_id': update_id, 'message': messaggio}
+    if tipo < 0.8:
+        return {'update_id': update_id, 'edited_message': dict(messaggio, edit_date=1700000100)}
+    if tipo < 0.95:
+        return {'update_id': update_id, 'message_reaction': {
+            'chat': chat, 'message_id': update_id - 1, 'user': utente, 'date': 1700000000,
+            'old_reaction': [], 'new_reaction': [{'type': 'emoji', 'emoji': '👍'}]}}
+    return {'update_id': update_id, 'chat_member': {
+        'chat': chat, 'from': utente, 'date': 1700000000,
+        'old_chat_member': {'status': 'left', 'user': utente},
+        'new_chat_member': {'status': 'member', 'user': utente}}}
+
+
+def principale(args) -> None:
+    random.seed(1)
+    corpi = [json.dumps(rumore(i)).encode() for i in range(args.aggiornamenti)]
+    bot = Bot('123:abc')
+
+    inizio = time.perf_counter()
+    for corpo in corpi:
+        Update.de_json(json.loads(corpo), bot)
+    completo = time.perf_counter() - inizio
+
+    prefiltro = UpdatePrefilter(['callback_query', 'edited_message', 'message'], [GRUPPO])
+    inizio = time.perf_counter()
+    for corpo in corpi:
+        prefiltro.motivo_scarto(carica_json(corpo))
+    filtrato = time.perf_counter() - inizio
+
+    n = args.aggiornamenti
+    print(f"parse completo: {completo / n * 1e6:7.1f} µs/aggiornamento")
+    print(f"prefiltro:      {filtrato / n * 1e6:7.1f} µs/aggiornamento "
+          f"({prefiltro.statistiche()['decoder']}), scartati "
+          f"{sum(prefiltro.scartati.values())}/{n}: {dict(prefiltro.scartati)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--aggiornamenti', type=int, default=20000)
+    principale(parser.parse_args())
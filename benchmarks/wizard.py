@@ -0,0 +1,150 @@
+"""Chiamate alla Bot API per un annuncio completo, con il wizard a messaggi e con la scheda.
+
+Per ogni valore di WIZARD_MODE avvia `main.py` contro il finto server Bot API e
+invia come un utente gli aggiornamenti di un annuncio completo: /nuovo_annuncio,
+accettazione del readme, un album di 3 foto e due foto singole, titolo,
+descrizione, località, prezzo e conferma. Poi conta le chiamate fatte dal bot,
+separando quelle verso l'utente da quelle verso i moderatori, e i messaggi che
+restano nella chat dell'utente.
+
+Uso: python benchmarks/wizard.py [--latenza 0.02]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from fake_bot_api import FakeBotApi  # noqa: E402
+
+RADICE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+UTENTE = 4242
+MODERATORI = -200
+# Chiamate dell'avvio e dei calcoli delle impronte, uguali nei due wizard
+ESCLUSE = {'getMe', 'getWebhookInfo', 'setWebhook', 'getMyCommands', 'setMyCommands', 'getFile'}
+INVII = {'sendMessage', 'sendPhoto', 'sendMediaGroup'}
+ALBUM_DEBOUNCE = 0.3
+
+
+class Utente:
+    def __init__(self, sessione: aiohttp.ClientSession, base: str):
+        self.sessione = sessione
+        self.base = base
+        self.update_id = 0
+
+    async def invia(self, campo: str, contenuto: dict) -> None:
+        self.update_id += 1
+        async with self.sessione.post(f"{self.base}/webhook",
+                                      json={'update_id': self.update_id, campo: contenuto}) as risposta:
+            if risposta.status != 200:
+                raise RuntimeError(f"aggiornamento {self.update_id} rifiutato: {risposta.status}")
+
+    def _messaggio(self, **campi) -> dict:
+        return {'message_id': self.update_id + 1, 'date': int(time.time()),
+                'chat': {'id': UTENTE, 'type': 'private'},
+                'from': {'id': UTENTE, 'is_bot': False, 'first_name': 'Mario'}, **campi}
+
+    async def testo(self, testo: str) -> None:
+        campi = {'text': testo}
+        if testo.startswith('/'):
+            campi['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(testo.split()[0])}]
+        await self.invia('message', self._messaggio(**campi))
+
+    async def foto(self, file_id: str, album: str = None) -> None:
+        campi = {'photo': [{'file_id': file_id, 'file_unique_id': f"u{file_id}", 'width': 800, 'height': 600}]}
+        if album:
+            campi['media_group_id'] = album
+        await self.invia('message', self._messaggio(**campi))
+
+    async def pulsante(self, dati: str, message_id: int) -> None:
+        await self.invia('callback_query', {
+            'id': str(self.update_id), 'chat_instance': '1', 'data': dati,
+            'from': {'id': UTENTE, 'is_bot': False, 'first_name': 'Mario'},
+            'message': {'message_id': message_id, 'date': int(time.time()), 'text': '',
+                        'chat': {'id': UTENTE, 'type': 'private'}}})
+
+
+async def annuncio(api: FakeBotApi, utente: Utente, modalita: str) -> None:
+    await utente.testo('/nuovo_annuncio')
+    await utente.pulsante('accetta_readme', api.ultimi_messaggi[str(UTENTE)]['message_id'])
+    for n in range(3):
+        await utente.foto(f"album{n}", album='a1')
+    await asyncio.sleep(ALBUM_DEBOUNCE + 0.2)
+    # Due foto singole una dopo l'altra, come le manda chi le sceglie dalla galleria
+    await utente.foto('singola1')
+    await utente.foto('singola2')
+    await asyncio.sleep(ALBUM_DEBOUNCE + 0.2)
+    if modalita == 'messaggi':
+        await utente.testo('✅ Fatto')
+    for testo in ('Lotto di libri usati', 'Venti libri in buono stato', 'Milano', '25.50'):
+        await utente.testo(testo)
+    if modalita == 'messaggi':
+        await utente.testo('Si')
+    else:
+        await utente.pulsante('bozza_invia', api.ultimi_messaggi[str(UTENTE)]['message_id'])
+
+
+async def misura(api: FakeBotApi, args, modalita: str, ambiente: dict) -> Counter:
+    base = f"http://127.0.0.1:{args.porta}"
+    processo = await asyncio.create_subprocess_exec(
+        sys.executable, 'main.py', cwd=RADICE, env=dict(ambiente, WIZARD_MODE=modalita),
+        stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    try:
+        async with aiohttp.ClientSession() as sessione:
+            while True:
+                try:
+                    async with sessione.get(f"{base}/stato") as risposta:
+                        if 'completato' in (await risposta.json())['avvio']:
+                            break
+                except aiohttp.ClientError:
+                    pass
+                await asyncio.sleep(0.01)
+            api.azzera()
+            await annuncio(api, Utente(sessione, base), modalita)
+            # Le ultime chiamate possono essere ancora nello scheduler degli invii
+            await asyncio.sleep(1)
+    finally:
+        processo.kill()
+        await processo.wait()
+    chiamate = Counter()
+    for _, metodo, parametri in api.chiamate:
+        if metodo in ESCLUSE:
+            continue
+        moderatori = str(parametri.get('chat_id')) == str(MODERATORI)
+        chiamate[('moderatori' if moderatori else 'utente', metodo)] += 1
+    return chiamate
+
+
+async def principale(args) -> None:
+    api = FakeBotApi(latenza=args.latenza)
+    url_api = await api.start(args.porta_api)
+    risultati = {}
+    with tempfile.TemporaryDirectory() as cartella:
+        for modalita in ('messaggi', 'scheda'):
+            ambiente = dict(
+                os.environ, TELEGRAM_BOT_TOKEN='123:abc', GROUP_CHAT_ID='-100', TOPIC_MESSAGE_THREAD_ID='7',
+                MODERATION_CHAT_ID=str(MODERATORI), BASE_URL='http://127.0.0.1', PORT=str(args.porta),
+                DATABASE_PATH=os.path.join(cartella, f"{modalita}.db"), TELEGRAM_API_BASE_URL=url_api,
+                ALBUM_DEBOUNCE=str(ALBUM_DEBOUNCE))
+            risultati[modalita] = await misura(api, args, modalita, ambiente)
+    await api.stop()
+    for modalita, chiamate in risultati.items():
+        utente = {metodo: n for (chi, metodo), n in chiamate.items() if chi == 'utente'}
+        moderatori = sum(n for (chi, _), n in chiamate.items() if chi == 'moderatori')
+        messaggi = sum(n for metodo, n in utente.items() if metodo in INVII)
+        print(f"{modalita:9} chiamate verso l'utente: {sum(utente.values()):2} {utente}")
+        print(f"{'':9} messaggi lasciati nella chat: {messaggi}, chiamate verso i moderatori: {moderatori}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latenza', type=float, default=0.02)
+    parser.add_argument('--porta', type=int, default=18094)
+    parser.add_argument('--porta-api', type=int, default=18095)
+    asyncio.run(principale(parser.parse_args()))
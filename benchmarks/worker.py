@@ -0,0 +1,150 @@
+"""Scalabilità con più processi worker: aggiornamenti al secondo al variare di WORKER_PROCESSES.
+
+Per ogni valore di `--worker` avvia `main.py` contro il finto server Bot API (in
+un processo a parte, per non rubare CPU al bot) e per `--durata` secondi gli
+invia /start e /readme da utenti sempre diversi, a ciclo chiuso: `--client`
+processi generatori con `--concorrenza` richieste in corso ciascuno. Riporta
+aggiornamenti al secondo, latenza del webhook (p50/p99) e accelerazione rispetto
+al primo valore.
+
+Con più worker il carico si divide tra i processi solo se ci sono abbastanza
+core: il numero di CPU disponibili è riportato in testa ai risultati.
+
+Uso: python benchmarks/worker.py [--worker 1,2,4] [--durata 15] [--client 2] [--concorrenza 32]
+"""
+import argparse
+import asyncio
+import os
+import random
+import signal
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import aiohttp
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from carico import LIMITI_ALTI, RADICE, percentile  # noqa: E402
+
+QUI = os.path.dirname(os.path.abspath(__file__))
+GRUPPO = -100
+MODERATORI = -200
+
+
+def genera(base: str, durata: float, concorrenza: int, primo_update: int) -> tuple[int, list[float]]:
+    """Processo generatore: invia aggiornamenti a ciclo chiuso e restituisce (rifiutati, latenze)."""
+
+    async def ciclo() -> tuple[int, list[float]]:
+        latenze: list[float] = []
+        rifiutati = 0
+        update_id = primo_update
+        fine = time.monotonic() + durata
+
+        async def invia(sessione: aiohttp.ClientSession) -> None:
+            nonlocal rifiutati, update_id
+            while time.monotonic() < fine:
+                update_id += 1
+                utente = random.randrange(1_000_000, 1_000_000_000)
+                corpo = {'update_id': update_id, 'message': {
+                    'message_id': update_id, 'date': int(time.time()), 'text': random.choice(('/start', '/readme')),
+                    'chat': {'id': utente, 'type': 'private'},
+                    'from': {'id': utente, 'is_bot': False, 'first_name': 'Carico'}}}
+                corpo['message']['entities'] = [
+                    {'type': 'bot_command', 'offset': 0, 'length': len(corpo['message']['text'])}]
+                inizio = time.perf_counter()
+                while True:
+                    async with sessione.post(f"{base}/webhook", json=corpo) as risposta:
+                        if risposta.status == 200:
+                            break
+                    # Come Telegram: l'aggiornamento rifiutato viene reinviato
+                    rifiutati += 1
+                    await asyncio.sleep(0.05)
+                latenze.append(time.perf_counter() - inizio)
+
+        async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as sessione:
+            await asyncio.gather(*(invia(sessione) for _ in range(concorrenza)))
+        return rifiutati, latenze
+
+    return asyncio.run(ciclo())
+
+
+async def attendi(url: str, sessione: aiohttp.ClientSession, pronto) -> None:
+    while True:
+        try:
+            async with sessione.get(url) as risposta:
+                if risposta.status == 200 and pronto(await risposta.json()):
+                    return
+        except aiohttp.ClientError:
+            pass
+        await asyncio.sleep(0.05)
+
+
+async def misura(args, worker: int, url_api: str) -> dict:
+    base = f"http://127.0.0.1:{args.porta}"
+    with tempfile.TemporaryDirectory() as cartella:
+        ambiente = dict(
+            os.environ, TELEGRAM_BOT_TOKEN='123:abc', GROUP_CHAT_ID=str(GRUPPO), TOPIC_MESSAGE_THREAD_ID='7',
+            MODERATION_CHAT_ID=str(MODERATORI), BASE_URL='http://127.0.0.1', PORT=str(args.porta),
+            DATABASE_PATH=os.path.join(cartella, 'bot.db'), TELEGRAM_API_BASE_URL=url_api,
+            WORKER_PROCESSES=str(worker), **LIMITI_ALTI)
+        processo = await asyncio.create_subprocess_exec(
+            sys.executable, 'main.py', cwd=RADICE, env=ambiente,
+            stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        try:
+            async with aiohttp.ClientSession() as sessione:
+                await attendi(f"{base}/stato", sessione, lambda stato: 'completato' in stato['avvio'])
+            loop = asyncio.get_running_loop()
+            with ProcessPoolExecutor(args.client) as pool:
+                inizio = time.perf_counter()
+                esiti = await asyncio.gather(*(
+                    loop.run_in_executor(pool, genera, base, args.durata, args.concorrenza, i * 100_000_000)
+                    for i in range(args.client)))
+                trascorso = time.perf_counter() - inizio
+        finally:
+            if processo.returncode is None:
+                processo.send_signal(signal.SIGTERM)
+                await processo.wait()
+    latenze = [latenza for _, valori in esiti for latenza in valori]
+    return {
+        'worker': worker,
+        'al_secondo': len(latenze) / trascorso,
+        'rifiutati': sum(rifiutati for rifiutati, _ in esiti),
+        'p50': percentile(latenze, 0.5),
+        'p99': percentile(latenze, 0.99),
+    }
+
+
+async def principale(args) -> None:
+    api = await asyncio.create_subprocess_exec(
+        sys.executable, os.path.join(QUI, 'fake_bot_api.py'), '--porta', str(args.porta_api),
+        '--latenza', str(args.latenza), stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+    url_api = f"http://127.0.0.1:{args.porta_api}"
+    try:
+        async with aiohttp.ClientSession() as sessione:
+            await attendi(f"{url_api}/bot123:abc/getMe", sessione, lambda risposta: risposta.get('ok'))
+        risultati = [await misura(args, worker, url_api) for worker in args.worker]
+    finally:
+        api.send_signal(signal.SIGTERM)
+        await api.wait()
+
+    print(f"{os.cpu_count()} CPU, {args.client} client x {args.concorrenza} richieste in corso, "
+          f"latenza Bot API {args.latenza * 1000:.0f} ms, {args.durata:g}s per prova")
+    riferimento = risultati[0]['al_secondo']
+    for r in risultati:
+        print(f"  {r['worker']:2} worker  {r['al_secondo']:7.0f}/s  x{r['al_secondo'] / riferimento:4.2f}  "
+              f"p50 {r['p50'] * 1000:6.1f} ms  p99 {r['p99'] * 1000:7.1f} ms  rifiutati {r['rifiutati']}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--worker', type=lambda testo: [int(n) for n in testo.split(',')], default=[1, 2, 4],
+                        help="valori di WORKER_PROCESSES da provare, separati da virgola")
+    parser.add_argument('--durata', type=float, default=15)
+    parser.add_argument('--client', type=int, default=2, help="processi generatori")
+    parser.add_argument('--concorrenza', type=int, default=32, help="richieste in corso per generatore")
+    parser.add_argument('--latenza', type=float, default=0.005)
+    parser.add_argument('--porta', type=int, default=18098)
+    parser.add_argument('--porta-api', type=int, default=18099)
+    asyncio.run(principale(parser.parse_args()))
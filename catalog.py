@@ -0,0 +1,354 @@
+import bisect
+import heapq
+import logging
+import re
+import sqlite3
+import time
+import unicodedata
+from typing import Iterable, NamedTuple, Optional
+
+from sqlite_persistence import ChangeLog, SQLiteWriter, apri_database
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS catalogo (
+    id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    user_name TEXT NOT NULL,
+    title TEXT NOT NULL,
+    description TEXT NOT NULL,
+    location TEXT NOT NULL,
+    price_cents INTEGER,
+    photo TEXT,
+    pubblicato_il REAL NOT NULL
+);
+"""
+_ARCHIVIO = 'catalogo'
+_COLONNE = "id, user_id, user_name, title, description, location, price_cents, photo, pubblicato_il"
+
+_PAROLA = re.compile(r'\w+')
+_PREZZO = r'(\d+(?:[.,]\d+)?)'
+_INTERVALLO = re.compile(rf'€?{_PREZZO}-€?{_PREZZO}€?')
+_MINIMO = re.compile(rf'>=?€?{_PREZZO}€?')
+_MASSIMO = re.compile(rf'<=?€?{_PREZZO}€?')
+
+
+def normalizza(testo: str) -> str:
+    """Minuscolo e senza accenti: "Città" e "citta" devono trovare gli stessi annunci."""
+    if testo.isascii():
+        return testo.lower()
+    scomposto = unicodedata.normalize('NFKD', testo.casefold())
+    return ''.join(c for c in scomposto if not unicodedata.combining(c))
+
+
+def parole(testo: str) -> set[str]:
+    return set(_PAROLA.findall(normalizza(testo)))
+
+
+def _numero(testo: str) -> float:
+    return float(testo.replace(',', '.'))
+
+
+def _centesimi(euro: Optional[float], assente: float) -> float:
+    """Limite di prezzo di una ricerca in centesimi, come i prezzi nel catalogo."""
+    return assente if euro is None else round(euro * 100)
+
+
+class Ricerca(NamedTuple):
+    parole: tuple[str, ...]
+    localita: tuple[str, ...]
+    prezzo_min: Optional[float]
+    prezzo_max: Optional[float]
+
+
+def interpreta_ricerca(testo: str) -> Ricerca:
+    """Interpreta il testo di una ricerca inline.
+
+    Le parole libere cercano in titolo, descrizione e località; `@milano` filtra per
+    località; `<50`, `>10` e `10-50` filtrano per prezzo. Ogni parola vale come prefisso.
+    """
+    termini, localita = [], []
+    prezzo_min = prezzo_max = None
+    for pezzo in testo.split():
+        if pezzo.startswith('@'):
+            localita.extend(parole(pezzo[1:]))
+        elif intervallo := _INTERVALLO.fullmatch(pezzo):
+            prezzo_min, prezzo_max = sorted((_numero(intervallo[1]), _numero(intervallo[2])))
+        elif minimo := _MINIMO.fullmatch(pezzo):
+            prezzo_min = _numero(minimo[1])
+        elif massimo := _MASSIMO.fullmatch(pezzo):
+            prezzo_max = _numero(massimo[1])
+        else:
+            termini.extend(parole(pezzo))
+    return Ricerca(tuple(termini), tuple(localita), prezzo_min, prezzo_max)
+
+
+class CatalogAd:
+    """Annuncio approvato e pubblicato, ricercabile dal catalogo.
+
+    Il prezzo è in centesimi, come in PendingAd (`price` lo restituisce in euro).
+    """
+
+    __slots__ = ('id', 'user_id', 'user_name', 'title', 'description', 'location',
+                 'prezzo_centesimi', 'photo', 'pubblicato_il')
+
+    def __init__(self, id: int, user_id: int, user_name: str, title: str, description: str,
+                 location: str, prezzo_centesimi: Optional[int], photo: Optional[str] = None,
+                 pubblicato_il: Optional[float] = None):
+        self.id = id
+        self.user_id = user_id
+        self.user_name = user_name
+        self.title = title
+        self.description = description
+        self.location = location
+        self.prezzo_centesimi = prezzo_centesimi
+        self.photo = photo
+        self.pubblicato_il = time.time() if pubblicato_il is None else pubblicato_il
+
+    @property
+    def price(self) -> Optional[float]:
+        return None if self.prezzo_centesimi is None else self.prezzo_centesimi / 100
+
+
+class _Indice:
+    """Indice invertito parola -> id, con il vocabolario ordinato per cercare i prefissi."""
+
+    def __init__(self):
+        self.posting: dict[str, set[int]] = {}
+        self.vocabolario: list[str] = []
+
+    def aggiungi(self, id: int, parole_annuncio: Iterable[str]) -> None:
+        for parola in parole_annuncio:
+            ids = self.posting.get(parola)
+            if ids is None:
+                self.posting[parola] = ids = set()
+                bisect.insort(self.vocabolario, parola)
+            ids.add(id)
+
+    def rimuovi(self, id: int, parole_annuncio: Iterable[str]) -> None:
+        for parola in parole_annuncio:
+            ids = self.posting.get(parola)
+            if ids is None:
+                continue
+            ids.discard(id)
+            if not ids:
+                del self.posting[parola]
+                del self.vocabolario[bisect.bisect_left(self.vocabolario, parola)]
+
+    def ricostruisci_vocabolario(self) -> None:
+        self.vocabolario = sorted(self.posting)
+
+    def con_prefisso(self, prefisso: str) -> list[set[int]]:
+        """Insiemi di id delle parole che iniziano con `prefisso`, senza unirli."""
+        insiemi = []
+        for i in range(bisect.bisect_left(self.vocabolario, prefisso), len(self.vocabolario)):
+            parola = self.vocabolario[i]
+            if not parola.startswith(prefisso):
+                break
+            insiemi.append(self.posting[parola])
+        return insiemi
+
+
+class AdCatalog:
+    """Catalogo degli annunci approvati, salvato su SQLite e indicizzato in memoria.
+
+    - indice invertito sulle parole di titolo, descrizione e località;
+    - indice separato sulle parole della località, per i filtri `@località`;
+    - lista ordinata (prezzo in centesimi, id) per gli intervalli di prezzo con bisect;
+    - lista ordinata degli id, per scorrere gli annunci dal più recente.
+
+    Gli indici si aggiornano a ogni annuncio aggiunto o rimosso e all'avvio vengono
+    ricostruiti con una sola lettura della tabella. I risultati escono dal più recente:
+    per le ricerche poco selettive conviene scorrere gli id dal più alto fermandosi
+    alla prima pagina piena, per le altre intersecare gli insiemi dell'indice.
+
+    Con più worker (`modifiche`) il catalogo lo scrive il worker che pubblica: gli
+    altri portano i nuovi annunci nei propri indici con `sincronizza`.
+    """
+
+    def __init__(self, modifiche: Optional[ChangeLog] = None,
+                 scrittore: Optional[SQLiteWriter] = None):
+        self._conn: Optional[sqlite3.Connection] = None
+        self._scrittore_condiviso = scrittore
+        self._scrittore: Optional[SQLiteWriter] = None
+        self._modifiche = modifiche
+        self._annunci: dict[int, CatalogAd] = {}
+        self._testo = _Indice()
+        self._localita = _Indice()
+        self._prezzi: list[tuple[int, int]] = []
+        self._ids: list[int] = []
+
+    def apri(self, path: str) -> None:
+        """Apre il database e ricostruisce gli indici dal catalogo salvato."""
+        inizio = time.perf_counter()
+        self._conn = apri_database(path)
+        self._scrittore = self._scrittore_condiviso or SQLiteWriter(self._conn)
+        self._conn.executescript(_SCHEMA)
+        colonne = {riga[1] for riga in self._conn.execute("PRAGMA table_info(catalogo)")}
+        if 'price_cents' not in colonne:
+            # Database creato quando il prezzo era salvato in euro (REAL)
+            self._conn.execute("ALTER TABLE catalogo ADD COLUMN price_cents INTEGER")
+            self._conn.execute("UPDATE catalogo SET price_cents = CAST(ROUND(price * 100) AS INTEGER)")
+        self._annunci.clear()
+        self._testo = _Indice()
+        self._localita = _Indice()
+        annunci, testo, localita = self._annunci, self._testo.posting, self._localita.posting
+        for riga in self._conn.execute(f"SELECT {_COLONNE} FROM catalogo"):
+            ad = CatalogAd(*riga)
+            annunci[ad.id] = ad
+            # Il vocabolario e le liste ordinate si costruiscono una volta sola alla fine
+            parole_localita = parole(ad.location)
+            for indice, parole_annuncio in ((testo, parole(f"{ad.title} {ad.description}") | parole_localita),
+                                            (localita, parole_localita)):
+                for parola in parole_annuncio:
+                    ids = indice.get(parola)
+                    if ids is None:
+                        indice[parola] = {ad.id}
+                    else:
+                        ids.add(ad.id)
+        self._testo.ricostruisci_vocabolario()
+        self._localita.ricostruisci_vocabolario()
+        self._prezzi = sorted((ad.prezzo_centesimi, ad.id) for ad in annunci.values()
+                              if ad.prezzo_centesimi is not None)
+        self._ids = sorted(annunci)
+        logger.info(f"Catalogo: {len(self)} annunci indicizzati in "
+                    f"{(time.perf_counter() - inizio) * 1000:.0f} ms")
+
+    def __len__(self) -> int:
+        return len(self._annunci)
+
+    def __contains__(self, id: int) -> bool:
+        return id in self._annunci
+
+    def get(self, id: int) -> Optional[CatalogAd]:
+        return self._annunci.get(id)
+
+    def _parole_testo(self, ad: CatalogAd) -> set[str]:
+        return parole(f"{ad.title} {ad.description} {ad.location}")
+
+    def _indicizza(self, ad: CatalogAd) -> None:
+        self._annunci[ad.id] = ad
+        self._testo.aggiungi(ad.id, self._parole_testo(ad))
+        self._localita.aggiungi(ad.id, parole(ad.location))
+        if ad.prezzo_centesimi is not None:
+            bisect.insort(self._prezzi, (ad.prezzo_centesimi, ad.id))
+        bisect.insort(self._ids, ad.id)
+
+    def _deindicizza(self, ad: CatalogAd) -> None:
+        del self._annunci[ad.id]
+        self._testo.rimuovi(ad.id, self._parole_testo(ad))
+        self._localita.rimuovi(ad.id, parole(ad.location))
+        if ad.prezzo_centesimi is not None:
+            _rimuovi_ordinato(self._prezzi, (ad.prezzo_centesimi, ad.id))
+        _rimuovi_ordinato(self._ids, ad.id)
+
+    def aggiungi(self, ad: CatalogAd) -> None:
+        if ad.id in self._annunci:
+            self._deindicizza(self._annunci[ad.id])
+        self._indicizza(ad)
+        if self._conn is not None:
+            self._scrittore.esegui(
+                f"INSERT OR REPLACE INTO catalogo ({_COLONNE}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (ad.id, ad.user_id, ad.user_name, ad.title, ad.description, ad.location,
+                 ad.prezzo_centesimi, ad.photo, ad.pubblicato_il))
+            if self._modifiche is not None:
+                self._modifiche.annota(_ARCHIVIO, (ad.id,))
+
+    def rimuovi(self, id: int) -> Optional[CatalogAd]:
+        ad = self._annunci.get(id)
+        if ad is None:
+            return None
+        self._deindicizza(ad)
+        if self._conn is not None:
+            self._scrittore.esegui("DELETE FROM catalogo WHERE id = ?", (id,))
+            if self._modifiche is not None:
+                self._modifiche.annota(_ARCHIVIO, (id,))
+        return ad
+
+    def sincronizza(self) -> int:
+        """Ricarica gli annunci pubblicati o tolti dagli altri worker e restituisce quanti erano."""
+        if self._modifiche is None or self._conn is None:
+            return 0
+        ids = self._modifiche.nuove(_ARCHIVIO)
+        for id in ids:
+            riga = self._conn.execute(f"SELECT {_COLONNE} FROM catalogo WHERE id = ?", (id,)).fetchone()
+            if id in self._annunci:
+                self._deindicizza(self._annunci[id])
+            if riga is not None:
+                self._indicizza(CatalogAd(*riga))
+        return len(ids)
+
+    def _fascia_prezzo(self, minimo: float, massimo: float) -> tuple[int, int]:
+        """Posizioni in `_prezzi` degli annunci con prezzo tra `minimo` e `massimo` centesimi."""
+        return (bisect.bisect_left(self._prezzi, (minimo, -1 << 63)),
+                bisect.bisect_right(self._prezzi, (massimo, 1 << 63)))
+
+    def cerca(self, testo: str, limite: int = 20, da: int = 0) -> tuple[list[CatalogAd], Optional[int]]:
+        """Annunci che corrispondono alla ricerca, dal più recente.
+
+        Restituisce una pagina di al massimo `limite` risultati a partire dalla
+        posizione `da` e la posizione della pagina successiva (None se è l'ultima).
+        """
+        ricerca = interpreta_ricerca(testo)
+        termini = [self._testo.con_prefisso(p) for p in ricerca.parole]
+        termini += [self._localita.con_prefisso(p) for p in ricerca.localita]
+        filtro_prezzo = ricerca.prezzo_min is not None or ricerca.prezzo_max is not None
+        minimo = _centesimi(ricerca.prezzo_min, float('-inf'))
+        massimo = _centesimi(ricerca.prezzo_max, float('inf'))
+        servono = da + limite + 1
+        totale = len(self._annunci) or 1
+
+        # Stima di quanti annunci passano tutti i filtri, supponendoli indipendenti
+        dimensioni = [sum(map(len, insiemi)) for insiemi in termini]
+        selettivita = 1.0
+        for dimensione in dimensioni:
+            selettivita *= min(1.0, dimensione / totale)
+        if filtro_prezzo:
+            inizio, fine = self._fascia_prezzo(minimo, massimo)
+            dimensioni.append(fine - inizio)
+            selettivita *= (fine - inizio) / totale
+        da_scorrere = servono / selettivita if selettivita else float('inf')
+
+        if not dimensioni or da_scorrere < min(dimensioni):
+            # Ricerca poco selettiva: si scorrono gli id dal più recente finché la pagina è piena
+            pagina = []
+            for id in reversed(self._ids):
+                if filtro_prezzo:
+                    prezzo = self._annunci[id].prezzo_centesimi
+                    if prezzo is None or not minimo <= prezzo <= massimo:
+                        continue
+                if all(any(id in ids for ids in insiemi) for insiemi in termini):
+                    pagina.append(id)
+                    if len(pagina) == servono:
+                        break
+        else:
+            # Ricerca selettiva: si parte dal filtro più piccolo e si verificano gli altri
+            # sui soli candidati, senza unire insiemi grandi
+            termini.sort(key=lambda insiemi: sum(map(len, insiemi)))
+            if filtro_prezzo and (not termini or fine - inizio <= sum(map(len, termini[0]))):
+                candidati = {id for _, id in self._prezzi[inizio:fine]}
+                filtro_prezzo = False
+            else:
+                candidati = set().union(*termini.pop(0))
+            for insiemi in termini:
+                if not candidati:
+                    break
+                if len(insiemi) == 1:
+                    candidati &= insiemi[0]
+                else:
+                    candidati = {id for id in candidati if any(id in ids for ids in insiemi)}
+            if filtro_prezzo:
+                candidati = [id for id in candidati
+                             if (prezzo := self._annunci[id].prezzo_centesimi) is not None
+                             and minimo <= prezzo <= massimo]
+            # Gli id dei messaggi di moderazione crescono nel tempo: i più alti sono i più recenti
+            pagina = heapq.nlargest(servono, candidati)
+        prossima = da + limite if len(pagina) > da + limite else None
+        return [self._annunci[id] for id in pagina[da:da + limite]], prossima
+
+
+def _rimuovi_ordinato(lista: list, valore) -> None:
+    i = bisect.bisect_left(lista, valore)
+    if i < len(lista) and lista[i] == valore:
+        del lista[i]
@@ -0,0 +1,191 @@
+import json
+import logging
+import os
+import re
+import time
+from typing import Iterator, NamedTuple, Optional
+
+from catalog import normalizza
+
+logger = logging.getLogger(__name__)
+
+BLOCCA = 'blocca'
+SEGNALA = 'segnala'
+
+# Regole usate finché non esiste il file delle regole. Il telefono ha la forma di un
+# numero italiano (cellulare 3xx o fisso 0x, con +39/0039 facoltativo e gruppi separati
+# solo da spazi o trattini), così date, codici ISBN, prezzi ed elenchi di numeri non scattano.
+# Un link con schema o www. blocca; un dominio scritto da solo ("Samsung.it") è spesso
+# solo una marca e viene soltanto segnalato ai moderatori.
+_TELEFONO = (r"(?<![\w+/-])(?:(?:\+|00)39[\s-]?)?"
+             r"(?:3\d{2}[\s-]?(?:\d{6,7}|\d{3}[\s-]?\d{3,4}|\d{2}[\s-]?\d{2}[\s-]?\d{2,3})"
+             r"|0\d{1,3}[\s-]?(?:\d{4,8}|\d{2,4}[\s-]?\d{2,4}(?:[\s-]?\d{2,4})?))"
+             r"(?!\w|[./-]\d)")
+_DOMINIO = r"(?<![\w@.])[\w-]+\.(?:com|it|net|org|eu|me|ly|io|shop|store|info)\b(?:/\S*)?"
+REGOLE_PREDEFINITE = {
+    'espressioni': [
+        {'motivo': "un numero di telefono", 'azione': BLOCCA, 'regex': _TELEFONO},
+        {'motivo': "un link", 'azione': BLOCCA, 'regex': r"(?:https?://|www\.)\S+"},
+        {'motivo': "un indirizzo web", 'azione': SEGNALA, 'regex': _DOMINIO},
+    ],
+}
+
+
+class Violazione(NamedTuple):
+    azione: str
+    motivo: str
+
+
+class _AhoCorasick:
+    """Automa di Aho-Corasick: trova tutti i termini in una sola passata sul testo.
+
+    Il tempo di scansione dipende dalla lunghezza del testo e dalle corrispondenze
+    trovate, non dal numero di termini.
+    """
+
+    def __init__(self, termini: dict[str, str]):
+        self._transizioni: list[dict[str, int]] = [{}]
+        self._fallimento = [0]
+        self._uscite: list[tuple[str, ...]] = [()]
+        for termine in termini:
+            stato = 0
+            for carattere in termine:
+                successivo = self._transizioni[stato].get(carattere)
+                if successivo is None:
+                    successivo = len(self._transizioni)
+                    self._transizioni[stato][carattere] = successivo
+                    self._transizioni.append({})
+                    self._fallimento.append(0)
+                    self._uscite.append(())
+                stato = successivo
+            self._uscite[stato] = (termine,)
+        # Collegamenti di fallimento in ampiezza: ogni stato eredita le uscite del suo suffisso
+        coda = list(self._transizioni[0].values())
+        for stato in coda:
+            for carattere, successivo in self._transizioni[stato].items():
+                ripiego = self._fallimento[stato]
+                while ripiego and carattere not in self._transizioni[ripiego]:
+                    ripiego = self._fallimento[ripiego]
+                destinazione = self._transizioni[ripiego].get(carattere, 0)
+                self._fallimento[successivo] = destinazione
+                self._uscite[successivo] += self._uscite[destinazione]
+                coda.append(successivo)
+
+    def cerca(self, testo: str) -> Iterator[tuple[int, str]]:
+        """(posizione dell'ultimo carattere, termine) per ogni termine presente nel testo."""
+        transizioni, fallimento, uscite = self._transizioni, self._fallimento, self._uscite
+        stato = 0
+        for posizione, carattere in enumerate(testo):
+            while stato and carattere not in transizioni[stato]:
+                stato = fallimento[stato]
+            stato = transizioni[stato].get(carattere, 0)
+            if uscite[stato]:
+                for termine in uscite[stato]:
+                    yield posizione, termine
+
+
+class _Regole:
+    __slots__ = ('automa', 'azione_termine', 'espressione', 'per_gruppo', 'numero')
+
+    def __init__(self, configurazione: dict):
+        self.azione_termine: dict[str, str] = {}
+        for azione in (SEGNALA, BLOCCA):
+            for termine in configurazione.get(azione, ()):
+                termine = ' '.join(normalizza(termine).split())
+                if termine:
+                    self.azione_termine[termine] = azione
+        self.automa = _AhoCorasick(self.azione_termine)
+        gruppi = []
+        self.per_gruppo: dict[str, Violazione] = {}
+        for i, regola in enumerate(configurazione.get('espressioni', ())):
+            azione = regola.get('azione', SEGNALA)
+            if azione not in (BLOCCA, SEGNALA):
+                raise ValueError(f"azione non valida: {azione}")
+            re.compile(regola['regex'])
+            gruppi.append(f"(?P<r{i}>{regola['regex']})")
+            self.per_gruppo[f"r{i}"] = Violazione(azione, regola['motivo'])
+        # Tutte le espressioni in un'unica regex: una sola passata anche per loro
+        self.espressione = re.compile('|'.join(gruppi), re.IGNORECASE) if gruppi else None
+        self.numero = len(self.azione_termine) + len(gruppi)
+
+
+class ContentFilter:
+    """Filtro dei testi degli annunci: termini vietati e espressioni (telefoni, link…).
+
+    Le regole stanno in un file JSON, ricaricato quando cambia senza riavviare il bot:
+
+        {"blocca": ["termine", ...], "segnala": ["termine", ...],
+         "espressioni": [{"motivo": "un link", "regex": "...", "azione": "blocca"}]}
+
+    I termini sono confrontati come parole intere, senza distinguere maiuscole e
+    accenti. `blocca` impedisce l'invio dell'annuncio, `segnala` lo lascia passare
+    con un avviso per i moderatori. Senza file valgono le REGOLE_PREDEFINITE.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self._regole = _Regole(REGOLE_PREDEFINITE)
+        self._versione_file: Optional[tuple] = None
+        self.caricate_il: Optional[float] = None
+        self.bloccati = 0
+        self.segnalati = 0
+        self.errori_caricamento = 0
+
+    def ricarica(self) -> bool:
+        """Ricarica le regole se il file è cambiato. Con un file non valido restano quelle attuali."""
+        if not self.path:
+            return False
+        try:
+            info = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        versione = (info.st_mtime_ns, info.st_size)
+        if versione == self._versione_file:
+            return False
+        self._versione_file = versione
+        try:
+            with open(self.path, encoding='utf-8') as file:
+                regole = _Regole(json.load(file))
+        except (OSError, ValueError, KeyError, re.error) as e:
+            self.errori_caricamento += 1
+            logger.error(f"Regole del filtro in {self.path} non valide, restano quelle attuali: {e}")
+            return False
+        # Lo scambio è un solo assegnamento: le scansioni in corso finiscono con le regole vecchie
+        self._regole = regole
+        self.caricate_il = time.time()
+        logger.info(f"Caricate {regole.numero} regole del filtro dei contenuti da {self.path}")
+        return True
+
+    def esamina(self, testo: str) -> list[Violazione]:
+        """Violazioni trovate nel testo, prima quelle che bloccano."""
+        regole = self._regole
+        trovate: dict[str, Violazione] = {}
+        if regole.espressione is not None:
+            for corrispondenza in regole.espressione.finditer(testo):
+                violazione = regole.per_gruppo[corrispondenza.lastgroup]
+                trovate.setdefault(violazione.motivo, violazione)
+        if regole.azione_termine:
+            normalizzato = ' '.join(normalizza(testo).split())
+            for fine, termine in regole.automa.cerca(normalizzato):
+                inizio = fine - len(termine) + 1
+                # Solo parole intere: "asta" non deve scattare su "pasta"
+                if ((inizio == 0 or not normalizzato[inizio - 1].isalnum())
+                        and (fine + 1 == len(normalizzato) or not normalizzato[fine + 1].isalnum())):
+                    motivo = f"la parola «{termine}»"
+                    trovate.setdefault(motivo, Violazione(regole.azione_termine[termine], motivo))
+        violazioni = sorted(trovate.values(), key=lambda v: v.azione != BLOCCA)
+        if violazioni:
+            if violazioni[0].azione == BLOCCA:
+                self.bloccati += 1
+            else:
+                self.segnalati += 1
+        return violazioni
+
+    def statistiche(self) -> dict:
+        return {
+            'regole': self._regole.numero,
+            'caricate_il': self.caricate_il,
+            'bloccati': self.bloccati,
+            'segnalati': self.segnalati,
+            'errori_caricamento': self.errori_caricamento,
+        }
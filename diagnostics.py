@@ -0,0 +1,248 @@
+import asyncio
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Traccia dell'aggiornamento in elaborazione: gli handler e le chiamate alla Bot API
+# la trovano qui, anche dentro i task dello scheduler degli invii
+traccia_corrente: contextvars.ContextVar[Optional['UpdateTrace']] = contextvars.ContextVar(
+    'traccia_corrente', default=None)
+
+MAX_VOCI_TRACCIA = 50
+PROFONDITA_PILA = 30
+
+
+class UpdateTrace:
+    """Cosa è successo durante un aggiornamento: handler chiamati, chiamate alla Bot API e pila."""
+
+    __slots__ = ('update_id', 'tipo', 'utente', 'inizio', 'ricevuto_il', 'task', 'handler', 'handler_corrente',
+                 'chiamate_api', 'pila')
+
+    def __init__(self, update_id, tipo: str, utente: Optional[int] = None):
+        self.update_id = update_id
+        self.tipo = tipo
+        self.utente = utente
+        self.inizio = time.perf_counter()
+        self.ricevuto_il = time.time()
+        self.task = asyncio.current_task()
+        self.handler: list = []
+        self.handler_corrente: Optional[str] = None
+        self.chiamate_api: list = []
+        self.pila: Optional[dict] = None
+
+    def registra_handler(self, nome: str, stato: Optional[str], durata: float) -> None:
+        if len(self.handler) < MAX_VOCI_TRACCIA:
+            self.handler.append((nome, stato, durata))
+
+    def registra_chiamata(self, metodo: str, durata: float, esito: str) -> None:
+        if len(self.chiamate_api) < MAX_VOCI_TRACCIA:
+            self.chiamate_api.append((metodo, durata, esito))
+
+    def record(self, durata: float) -> dict:
+        return {
+            'update_id': self.update_id,
+            'tipo': self.tipo,
+            'ricevuto_il': datetime.fromtimestamp(self.ricevuto_il).isoformat(timespec='milliseconds'),
+            'durata': round(durata, 4),
+            'handler': [{'handler': nome, 'stato': stato, 'durata': round(d, 4)}
+                        for nome, stato, d in self.handler],
+            'chiamate_api': [{'metodo': metodo, 'durata': round(d, 4), 'esito': esito}
+                             for metodo, d, esito in self.chiamate_api],
+            'tempo_api': round(sum(d for _, d, _ in self.chiamate_api), 4),
+            'pila': self.pila,
+        }
+
+
+def _riga(codice, lineno: int) -> str:
+    return f"{os.path.basename(codice.co_filename)}:{lineno} {codice.co_name}"
+
+
+def pila_thread(thread_id: int) -> list[str]:
+    """Pila attuale di un thread, dalla chiamata più esterna alla più interna."""
+    frame = sys._current_frames().get(thread_id)
+    righe = []
+    while frame is not None and len(righe) < PROFONDITA_PILA:
+        righe.append(_riga(frame.f_code, frame.f_lineno))
+        frame = frame.f_back
+    return righe[::-1]
+
+
+def pila_task(task: Optional[asyncio.Task]) -> list[str]:
+    """Dove è fermo un task: la catena di coroutine in attesa, dalla più esterna."""
+    righe = []
+    coroutine = task.get_coro() if task is not None else None
+    while coroutine is not None and len(righe) < PROFONDITA_PILA:
+        frame = getattr(coroutine, 'cr_frame', None) or getattr(coroutine, 'gi_frame', None)
+        if frame is None:
+            break
+        righe.append(_riga(frame.f_code, frame.f_lineno))
+        coroutine = getattr(coroutine, 'cr_await', None) or getattr(coroutine, 'gi_yieldfrom', None)
+    return righe
+
+
+class LoopWatchdog:
+    """Sorveglia il loop degli eventi e gli aggiornamenti lenti.
+
+    - un task nel loop si risveglia ogni `intervallo` secondi e misura di quanto è
+      in ritardo: è il ritardo che subisce qualsiasi altra callback in quel momento;
+    - un thread separato controlla che quel task continui a battere: se il loop è
+      fermo da più di `soglia_loop` secondi, registra la pila del thread del loop,
+      cioè il codice sincrono che lo sta bloccando;
+    - ogni aggiornamento ha una traccia (`inizia`/`termina`); quando supera
+      `soglia_aggiornamento` viene campionata la pila del suo task e alla fine la
+      traccia completa finisce nel log come JSON.
+    """
+
+    def __init__(self, soglia_loop: float = 0.5, soglia_aggiornamento: float = 2.0,
+                 intervallo: float = 0.1, istogramma_ritardo=None, conserva: int = 50):
+        self.soglia_loop = soglia_loop
+        self.soglia_aggiornamento = soglia_aggiornamento
+        self.intervallo = intervallo
+        self._istogramma = istogramma_ritardo
+        self._in_corso: dict[int, UpdateTrace] = {}
+        self.lenti: deque = deque(maxlen=conserva)
+        self.aggiornamenti_lenti = 0
+        self.blocchi = 0
+        self.ritardo_massimo = 0.0
+        self._battito = time.monotonic()
+        self._thread_loop: Optional[int] = None
+        self._task: Optional[asyncio.Task] = None
+        self._fermo = threading.Event()
+        self._sorvegliante: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        self._thread_loop = threading.get_ident()
+        self._battito = time.monotonic()
+        self._task = asyncio.create_task(self._misura_ritardo())
+        self._fermo.clear()
+        self._sorvegliante = threading.Thread(target=self._sorveglia, name='sorveglianza-loop', daemon=True)
+        self._sorvegliante.start()
+
+    async def stop(self) -> None:
+        self._fermo.set()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _misura_ritardo(self) -> None:
+        while True:
+            atteso = time.monotonic() + self.intervallo
+            await asyncio.sleep(self.intervallo)
+            adesso = time.monotonic()
+            self._battito = adesso
+            ritardo = max(0.0, adesso - atteso)
+            self.ritardo_massimo = max(self.ritardo_massimo, ritardo)
+            if self._istogramma is not None:
+                self._istogramma.osserva((), ritardo)
+            limite = time.perf_counter() - self.soglia_aggiornamento
+            for traccia in self._in_corso.values():
+                if traccia.pila is None and traccia.inizio < limite:
+                    traccia.pila = {'origine': 'task', 'righe': pila_task(traccia.task)}
+
+    def _sorveglia(self) -> None:
+        segnalato = None
+        while not self._fermo.wait(self.intervallo):
+            battito = self._battito
+            fermo_da = time.monotonic() - battito
+            if fermo_da < self.soglia_loop or segnalato == battito:
+                continue
+            # Un solo avviso per ogni blocco: il prossimo dopo che il loop è ripartito
+            segnalato = battito
+            self.blocchi += 1
+            righe = pila_thread(self._thread_loop)
+            for traccia in list(self._in_corso.values()):
+                if traccia.pila is None:
+                    traccia.pila = {'origine': 'loop bloccato', 'righe': righe}
+            logger.warning(f"Loop degli eventi bloccato da {fermo_da:.2f}s, pila: {' > '.join(righe[-8:])}")
+
+    def inizia(self, update_id, tipo: str, utente: Optional[int] = None) -> contextvars.Token:
+        traccia = UpdateTrace(update_id, tipo, utente)
+        self._in_corso[id(traccia)] = traccia
+        return traccia_corrente.set(traccia)
+
+    def termina(self, token: contextvars.Token) -> None:
+        traccia = traccia_corrente.get()
+        traccia_corrente.reset(token)
+        if traccia is None:
+            return
+        self._in_corso.pop(id(traccia), None)
+        durata = time.perf_counter() - traccia.inizio
+        if durata < self.soglia_aggiornamento:
+            return
+        self.aggiornamenti_lenti += 1
+        record = traccia.record(durata)
+        self.lenti.append(record)
+        logger.warning(f"Aggiornamento lento: {json.dumps(record, ensure_ascii=False)}")
+
+    def statistiche(self) -> dict:
+        return {
+            'ritardo_massimo': self.ritardo_massimo,
+            'blocchi': self.blocchi,
+            'aggiornamenti_in_corso': len(self._in_corso),
+            'aggiornamenti_lenti': self.aggiornamenti_lenti,
+            'ultimo_lento': self.lenti[-1] if self.lenti else None,
+        }
+
+
+class SamplingProfiler:
+    """Profiler a campionamento del thread del loop.
+
+    Ogni `intervallo` secondi legge la pila del thread e conta le pile uguali; il file
+    risultante è nel formato "folded" (una pila per riga, funzioni separate da `;` e
+    numero di campioni), leggibile da flamegraph.pl o speedscope. Gira in un thread
+    a parte e non tocca il codice del bot: costa solo il tempo dei campionamenti.
+    """
+
+    def __init__(self, cartella: str = 'profili', intervallo: float = 0.005):
+        self.cartella = cartella
+        self.intervallo = intervallo
+        self.attivo = False
+
+    async def profila(self, secondi: float) -> tuple[str, int, list[tuple[str, int]]]:
+        """Campiona per `secondi`; restituisce il file scritto, i campioni e le funzioni più presenti."""
+        if self.attivo:
+            raise RuntimeError("profilazione già in corso")
+        self.attivo = True
+        try:
+            return await asyncio.to_thread(self._campiona, threading.get_ident(), secondi)
+        finally:
+            self.attivo = False
+
+    def _campiona(self, thread_id: int, secondi: float) -> tuple[str, int, list[tuple[str, int]]]:
+        pile: dict[str, int] = {}
+        foglie: dict[str, int] = {}
+        campioni = 0
+        fine = time.monotonic() + secondi
+        while time.monotonic() < fine:
+            frame = sys._current_frames().get(thread_id)
+            nomi = []
+            while frame is not None:
+                nomi.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)})")
+                frame = frame.f_back
+            if nomi:
+                campioni += 1
+                pila = ';'.join(reversed(nomi))
+                pile[pila] = pile.get(pila, 0) + 1
+                foglie[nomi[0]] = foglie.get(nomi[0], 0) + 1
+            time.sleep(self.intervallo)
+        os.makedirs(self.cartella, exist_ok=True)
+        path = os.path.join(self.cartella, f"profilo-{datetime.now():%Y%m%d-%H%M%S}.folded")
+        with open(path, 'w', encoding='utf-8') as file:
+            for pila, conteggio in sorted(pile.items(), key=lambda voce: -voce[1]):
+                file.write(f"{pila} {conteggio}\n")
+        piu_presenti = sorted(foglie.items(), key=lambda voce: -voce[1])[:10]
+        logger.info(f"Profilo di {secondi:.0f}s scritto in {path} ({campioni} campioni)")
+        return path, campioni, piu_presenti
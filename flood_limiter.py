@@ -0,0 +1,217 @@
+import logging
+import time
+from collections import Counter, OrderedDict
+from typing import Iterable, Optional
+
+from send_scheduler import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# Esiti di `valuta` per gli aggiornamenti da scartare
+LIMITATO = 'limitato'    # oltre il limite: scartato in silenzio
+AVVISATO = 'avvisato'    # oltre il limite: scartato, all'utente va detto di rallentare
+BANDITO = 'bandito'      # utente nella lista dei blocchi temporanei
+
+# Chiave del limite delle query inline, che non sono comandi ma arrivano a raffica mentre si scrive
+INLINE = 'inline'
+
+
+def leggi_limiti(testo: str) -> dict[str, tuple[float, float]]:
+    """Limiti per comando nel formato `comando=rate/burst,…` (es. `nuovo_annuncio=0.05/3`)."""
+    limiti = {}
+    for voce in testo.split(','):
+        if not voce.strip():
+            continue
+        comando, _, valori = voce.partition('=')
+        rate, _, burst = valori.partition('/')
+        limiti[comando.strip().lstrip('/').lower()] = (float(rate), float(burst or 1))
+    return limiti
+
+
+def _mittente(data: dict) -> tuple[Optional[int], Optional[int], Optional[str], Optional[str]]:
+    """Utente, chat, tipo di chat e tipo di aggiornamento (None per le query inline) dal payload grezzo."""
+    for tipo, contenuto in data.items():
+        if tipo == 'update_id' or not isinstance(contenuto, dict):
+            continue
+        utente = contenuto.get('from', {}).get('id')
+        if tipo == 'inline_query':
+            return utente, None, None, None
+        messaggio = contenuto.get('message', {}) if tipo == 'callback_query' else contenuto
+        chat = messaggio.get('chat', {})
+        return utente, chat.get('id'), chat.get('type'), tipo
+    return None, None, None, None
+
+
+def _comando(testo: str) -> Optional[str]:
+    if not testo.startswith('/'):
+        return None
+    return testo[1:].split(maxsplit=1)[0].split('@', 1)[0].lower() if len(testo) > 1 else None
+
+
+class _Utente:
+    __slots__ = ('secchielli', 'album', 'avvisato_il', 'violazioni', 'inizio_finestra')
+
+    def __init__(self):
+        # Un secchiello generico (chiave None) più uno per ogni comando con un limite proprio
+        self.secchielli: dict[Optional[str], TokenBucket] = {}
+        self.album: Optional[str] = None
+        self.avvisato_il = 0.0
+        self.violazioni = 0
+        self.inizio_finestra = 0.0
+
+
+class FloodLimiter:
+    """Anti-flood in ingresso, per utente e per chat, valutato sul payload grezzo.
+
+    Come il prefiltro lavora prima di `Update.de_json` e degli handler, con poche
+    ricerche in un dict: un aggiornamento oltre il limite non costa né il parse né
+    le risposte degli handler.
+
+    - ogni utente ha un secchiello di gettoni; i comandi in `limiti_comandi` (e le
+      query inline, chiave `inline`) hanno un secchiello proprio al posto di quello
+      generico;
+    - le foto dello stesso album contano come un solo messaggio;
+    - i gruppi hanno anche un secchiello per chat, le chat in `chat_esenti` (i
+      moderatori) non hanno limiti;
+    - chi supera il limite riceve al massimo un avviso ogni `finestra` secondi; con
+      `soglia_blocco` aggiornamenti scartati nella stessa finestra finisce per
+      `durata_blocco` secondi nella lista dei blocchi temporanei, tenuta in memoria.
+
+    Gli utenti sono in un OrderedDict in ordine di ultimo utilizzo: oltre
+    `max_utenti` si dimentica il meno recente, e chi è fermo da abbastanza tempo da
+    avere i secchielli pieni viene dimenticato comunque, perché equivale a un
+    utente nuovo. La memoria resta proporzionale agli utenti attivi.
+    """
+
+    def __init__(self, rate: float = 1, burst: float = 20,
+                 limiti_comandi: Optional[dict[str, tuple[float, float]]] = None,
+                 chat_rate: float = 5, chat_burst: float = 30, chat_esenti: Iterable[int] = (),
+                 finestra: float = 10, soglia_blocco: int = 50, durata_blocco: float = 600,
+                 max_utenti: int = 100000):
+        self._parametri = {None: (rate, burst), **(limiti_comandi or {})}
+        self._parametri_chat = (chat_rate, chat_burst)
+        self.chat_esenti = frozenset(chat_esenti)
+        self.finestra = finestra
+        self.soglia_blocco = soglia_blocco
+        self.durata_blocco = durata_blocco
+        self._max_utenti = max_utenti
+        # Dopo questo tempo di inattività tutti i secchielli di un utente sono pieni
+        self._ricarica_completa = max(b / r for r, b in self._parametri.values())
+        self._utenti: OrderedDict[int, _Utente] = OrderedDict()
+        self._chat: OrderedDict[int, TokenBucket] = OrderedDict()
+        self.bloccati: dict[int, float] = {}
+        self.scartati: Counter = Counter()
+        self.blocchi = 0
+
+    def valuta(self, data: dict, adesso: Optional[float] = None) -> Optional[str]:
+        """None se l'aggiornamento può passare, altrimenti l'esito (LIMITATO, AVVISATO, BANDITO)."""
+        utente_id, chat_id, tipo_chat, tipo = _mittente(data)
+        if utente_id is None or chat_id in self.chat_esenti:
+            return None
+        adesso = time.monotonic() if adesso is None else adesso
+        esito = self._valuta(data, utente_id, chat_id, tipo_chat, tipo, adesso)
+        if esito is not None:
+            self.scartati[esito] += 1
+        return esito
+
+    def _valuta(self, data, utente_id, chat_id, tipo_chat, tipo, adesso) -> Optional[str]:
+        fine_blocco = self.bloccati.get(utente_id)
+        if fine_blocco is not None:
+            if fine_blocco > adesso:
+                return BANDITO
+            del self.bloccati[utente_id]
+        self._dimentica_inattivi(adesso)
+        utente = self._utente(utente_id)
+
+        messaggio = data.get(tipo) if tipo in ('message', 'edited_message') else None
+        chiave = INLINE if tipo is None else None
+        album = None
+        if messaggio is not None:
+            album = messaggio.get('media_group_id')
+            if album is not None and album == utente.album:
+                return None
+            comando = _comando(messaggio.get('text') or '')
+            if comando in self._parametri:
+                chiave = comando
+        if chiave not in self._parametri:
+            chiave = None
+
+        secchiello = utente.secchielli.get(chiave)
+        if secchiello is None:
+            secchiello = utente.secchielli[chiave] = TokenBucket(*self._parametri[chiave])
+            secchiello.aggiornato = adesso
+        if secchiello.attesa(adesso) > 0:
+            return self._oltre_limite(utente_id, utente, adesso, privata=tipo_chat in (None, 'private'))
+        if tipo_chat not in (None, 'private') and not self._consuma_chat(chat_id, adesso):
+            return LIMITATO
+        secchiello.consuma(1)
+        utente.album = album
+        return None
+
+    def _utente(self, utente_id: int) -> _Utente:
+        utente = self._utenti.get(utente_id)
+        if utente is None:
+            if len(self._utenti) >= self._max_utenti:
+                self._utenti.popitem(last=False)
+            utente = self._utenti[utente_id] = _Utente()
+        else:
+            self._utenti.move_to_end(utente_id)
+        return utente
+
+    def _dimentica_inattivi(self, adesso: float) -> None:
+        # I meno recenti sono in testa: si scorre solo finché si trovano utenti inattivi
+        while self._utenti:
+            utente_id, utente = next(iter(self._utenti.items()))
+            ultimo = max((s.aggiornato for s in utente.secchielli.values()), default=adesso)
+            if adesso - ultimo < self._ricarica_completa or adesso - utente.inizio_finestra < self.finestra:
+                break
+            del self._utenti[utente_id]
+
+    def _consuma_chat(self, chat_id: int, adesso: float) -> bool:
+        secchiello = self._chat.get(chat_id)
+        if secchiello is None:
+            if len(self._chat) >= self._max_utenti:
+                self._chat.popitem(last=False)
+            secchiello = self._chat[chat_id] = TokenBucket(*self._parametri_chat)
+            secchiello.aggiornato = adesso
+        else:
+            self._chat.move_to_end(chat_id)
+        if secchiello.attesa(adesso) > 0:
+            return False
+        secchiello.consuma(1)
+        return True
+
+    def _oltre_limite(self, utente_id: int, utente: _Utente, adesso: float, privata: bool) -> str:
+        if adesso - utente.inizio_finestra >= self.finestra:
+            utente.inizio_finestra = adesso
+            utente.violazioni = 0
+        utente.violazioni += 1
+        if utente.violazioni >= self.soglia_blocco:
+            self.blocca(utente_id, self.durata_blocco, adesso)
+            return BANDITO
+        # Un solo avviso per finestra, e solo in privato: nei gruppi si scarta in silenzio
+        if privata and adesso - utente.avvisato_il >= self.finestra:
+            utente.avvisato_il = adesso
+            return AVVISATO
+        return LIMITATO
+
+    def blocca(self, utente_id: int, secondi: float, adesso: Optional[float] = None) -> None:
+        adesso = time.monotonic() if adesso is None else adesso
+        self.bloccati[utente_id] = adesso + secondi
+        self._utenti.pop(utente_id, None)
+        self.blocchi += 1
+        logger.warning(f"Utente {utente_id} bloccato per {secondi:.0f}s")
+
+    def sblocca(self, utente_id: int) -> bool:
+        self._utenti.pop(utente_id, None)
+        return self.bloccati.pop(utente_id, None) is not None
+
+    def statistiche(self) -> dict:
+        adesso = time.monotonic()
+        return {
+            'utenti_attivi': len(self._utenti),
+            'chat_attive': len(self._chat),
+            'bloccati': sum(1 for fine in self.bloccati.values() if fine > adesso),
+            'blocchi': self.blocchi,
+            'scartati': dict(self.scartati),
+        }
@@ -0,0 +1,56 @@
+import asyncio
+import logging
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:  # senza fcntl (Windows) non c'è passaggio di consegne tra istanze
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+
+class InstanceLock:
+    """Lock esclusivo sul database, per passarsi le consegne tra due istanze del bot.
+
+    Durante un deploy la nuova istanza si mette in ascolto subito, ma carica lo
+    stato dal database solo quando la vecchia ha finito di chiudere e ha rilasciato
+    il lock: le due istanze non elaborano mai aggiornamenti insieme. Il lock è un
+    `flock` su un file accanto al database, quindi il sistema lo rilascia anche se
+    il processo muore senza chiudere.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = None
+
+    async def acquisisci(self, intervallo: float = 0.1) -> float:
+        """Attende il lock; restituisce i secondi passati ad aspettare l'altra istanza."""
+        if fcntl is None:
+            return 0.0
+        self._file = open(self.path, 'a+')
+        inizio = time.monotonic()
+        avvisato = False
+        while True:
+            try:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if not avvisato:
+                    logger.info(f"Un'altra istanza sta chiudendo: attendo che rilasci {self.path}")
+                    avvisato = True
+                await asyncio.sleep(intervallo)
+        # Il pid serve solo a chi guarda il file
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.write(f"{os.getpid()}\n")
+        self._file.flush()
+        return time.monotonic() - inizio
+
+    def rilascia(self) -> None:
+        if self._file is None:
+            return
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
@@ -0,0 +1,175 @@
+import json
+import logging
+import queue
+import re
+import sys
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO
+
+from diagnostics import traccia_corrente
+
+# Campi con dati inseriti dagli utenti: nei log ne resta solo la lunghezza
+CAMPI_PERSONALI = frozenset({'testo', 'nome', 'username', 'telefono'})
+
+# Il token compare negli URL della Bot API (per esempio nei log di httpx)
+_TOKEN = re.compile(r'bot\d+:[\w-]+')
+
+# Attributi che ogni LogRecord ha già: tutto il resto è un campo passato con `extra`
+_ATTRIBUTI_RECORD = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+FORMATO_TESTO = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+def leggi_campionamento(testo: str) -> dict[str, int]:
+    """Legge il campionamento da "evento=N,evento=N": di ogni evento si tiene un record su N."""
+    campionamento = {}
+    for voce in testo.split(','):
+        if voce.strip():
+            evento, _, ogni = voce.partition('=')
+            campionamento[evento.strip()] = max(1, int(ogni))
+    return campionamento
+
+
+def _oscura(valore) -> str:
+    return f"[{len(valore)} caratteri]" if isinstance(valore, str) else '[omesso]'
+
+
+class JsonFormatter(logging.Formatter):
+    """Un oggetto JSON per riga: ora, livello, logger, messaggio e campi del record.
+
+    I campi in CAMPI_PERSONALI sono sostituiti dalla loro lunghezza e il token del
+    bot è tolto dai messaggi. `campi` si aggiunge a ogni riga (per esempio il worker).
+    """
+
+    def __init__(self, campi: Optional[dict] = None):
+        super().__init__()
+        self.campi = campi if campi is not None else {}
+
+    def format(self, record: logging.LogRecord) -> str:
+        voce = {
+            'ora': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'livello': record.levelname,
+            'logger': record.name,
+            'messaggio': _TOKEN.sub('bot<token>', record.getMessage()),
+            **self.campi,
+        }
+        for chiave, valore in vars(record).items():
+            if chiave not in _ATTRIBUTI_RECORD:
+                voce[chiave] = _oscura(valore) if chiave in CAMPI_PERSONALI else valore
+        if isinstance(voce.get('durata'), float):
+            voce['durata'] = round(voce['durata'], 4)
+        if record.exc_info:
+            voce['eccezione'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            voce['pila'] = self.formatStack(record.stack_info)
+        return json.dumps(voce, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """Il formato leggibile di sempre, senza token del bot nei messaggi."""
+
+    def __init__(self):
+        super().__init__(FORMATO_TESTO)
+
+    def format(self, record: logging.LogRecord) -> str:
+        return _TOKEN.sub('bot<token>', super().format(record))
+
+
+class EventSampler(logging.Filter):
+    """Tiene un record su N per gli eventi ad alto volume (il campo `evento` del record).
+
+    Avvisi ed errori passano sempre. Ai record tenuti aggiunge `campionamento` = N,
+    per risalire ai conteggi reali.
+    """
+
+    def __init__(self, campionamento: dict[str, int]):
+        super().__init__()
+        self.campionamento = campionamento
+        self._visti: dict[str, int] = {}
+        self.scartati = 0
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        ogni = self.campionamento.get(getattr(record, 'evento', None), 1)
+        if ogni == 1 or record.levelno >= logging.WARNING:
+            return True
+        visti = self._visti[record.evento] = self._visti.get(record.evento, 0) + 1
+        if (visti - 1) % ogni:
+            self.scartati += 1
+            return False
+        record.campionamento = ogni
+        return True
+
+
+class ContextQueueHandler(QueueHandler):
+    """Mette i record in una coda limitata: formattazione e scrittura avvengono nel thread di `ascoltatore`.
+
+    Nel loop degli eventi restano il filtro di campionamento e la lettura della
+    traccia dell'aggiornamento in corso (update_id, utente, handler e durata fin
+    lì). Il messaggio non viene formattato qui: gli argomenti `%` sono letti dal
+    thread di scrittura, quindi devono essere valori che non cambiano. Se la coda è
+    piena il record è scartato e contato, senza bloccare il loop.
+    """
+
+    def __init__(self, coda: queue.Queue):
+        super().__init__(coda)
+        self.ascoltatore: Optional[QueueListener] = None
+        self.scartati = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        traccia = traccia_corrente.get()
+        if traccia is not None:
+            record.update_id = traccia.update_id
+            record.utente = traccia.utente
+            record.handler = traccia.handler_corrente
+            record.durata = time.perf_counter() - traccia.inizio
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.scartati += 1
+
+    def close(self) -> None:
+        # Chiamato anche da logging.shutdown all'uscita: scrive i record ancora in coda
+        if self.ascoltatore is not None:
+            self.ascoltatore.stop()
+            self.ascoltatore = None
+        super().close()
+
+
+class _Ascoltatore(QueueListener):
+    def enqueue_sentinel(self) -> None:
+        # Alla chiusura la coda può essere piena: si attende che il thread liberi un posto
+        self.queue.put(self._sentinel)
+
+
+def configura_logging(livello: str = 'INFO', formato: str = 'json', campionamento: Optional[dict] = None,
+                      capacita: int = 10000, campi: Optional[dict] = None,
+                      flusso: TextIO = None) -> ContextQueueHandler:
+    """Sostituisce gli handler del logger radice con la coda e avvia il thread di scrittura.
+
+    `formato` è 'json' o 'testo'; `flusso` è di default stderr. Restituisce l'handler
+    della coda, con i conteggi dei record scartati.
+    """
+    radice = logging.getLogger()
+    for vecchio in radice.handlers[:]:
+        radice.removeHandler(vecchio)
+        vecchio.close()
+    scrittore = logging.StreamHandler(flusso if flusso is not None else sys.stderr)
+    scrittore.setFormatter(JsonFormatter(campi) if formato == 'json' else TextFormatter())
+    gestore = ContextQueueHandler(queue.Queue(capacita))
+    gestore.addFilter(EventSampler(campionamento or {}))
+    gestore.ascoltatore = _Ascoltatore(gestore.queue, scrittore)
+    gestore.ascoltatore.start()
+    radice.addHandler(gestore)
+    radice.setLevel(livello)
+    return gestore
+
+
+def record_scartati(gestore: ContextQueueHandler) -> dict[str, int]:
+    """Record non scritti, per motivo."""
+    campionati = sum(f.scartati for f in gestore.filters if isinstance(f, EventSampler))
+    return {'campionamento': campionati, 'coda_piena': gestore.scartati}
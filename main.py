@@ -1,18 +1,63 @@
 import logging
+import hashlib
+import html
 import json
 import os
+import shutil
+import signal
+import socket
+import sys
+import tempfile
 import asyncio
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
+from functools import wraps
+from typing import Optional
 from telegram import Update, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto, ReplyKeyboardMarkup, KeyboardButton, BotCommand
-from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackQueryHandler, ContextTypes, DictPersistence
+from telegram import BotCommandScopeChat, InlineQueryResultArticle, InlineQueryResultCachedPhoto, InputTextMessageContent, LinkPreviewOptions
+from telegram.error import BadRequest, Forbidden, TimedOut
+from telegram.helpers import escape_markdown, mention_html
+from telegram.ext import Application, CommandHandler, MessageHandler, filters, ConversationHandler, CallbackQueryHandler, ContextTypes, InlineQueryHandler, TypeHandler
 import re
 from aiohttp import web
 
-
-# Abilita il logging
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO)
+from catalog import AdCatalog, CatalogAd
+from content_filter import BLOCCA, SEGNALA, ContentFilter
+from diagnostics import LoopWatchdog, SamplingProfiler
+from flood_limiter import AVVISATO, FloodLimiter, leggi_limiti
+from instance_lock import InstanceLock
+from log_pipeline import configura_logging, leggi_campionamento, record_scartati
+from ad_record import MAX_DESCRIZIONE, MAX_FOTO, MAX_LOCALITA, MAX_TITOLO, PendingAd, formatta_prezzo, in_centesimi
+from metrics import MeteredRequest, MetricsRegistry, conversazioni_per_stato, misura_handler, tipo_aggiornamento
+from moderation_store import ModerationStore
+from photo_index import PILLOW, Fingerprint, PhotoIndex, dhash
+from publish_queue import INTERROTTA, PublishQueue
+from saved_searches import SavedSearches
+from send_scheduler import PRIORITA_AVVISI, PRIORITA_MODERAZIONE, PRIORITA_PUBBLICAZIONE, PRIORITA_UTENTE, SendScheduler
+from sqlite_persistence import ChangeLog, SQLitePersistence, SQLiteWriter
+from update_filter import UpdatePrefilter, carica_json, tipi_aggiornamento
+from update_queue import UpdateQueue, chat_aggiornamento, chiave_ordinamento, utente_aggiornamento
+from update_registry import FALLITO, IN_CORSO, UpdateRegistry
+from worker_pool import HashRing, WorkerPool, unisci_metriche
+
+# Riferimento per i tempi di avvio riportati nei log e in /stato
+INIZIO_PROCESSO = time.perf_counter()
+avvio: dict = {}
+
+# Abilita il logging: i record passano da una coda a un thread che li formatta (JSON o
+# testo) e li scrive, fuori dal loop degli eventi. Degli eventi più frequenti si tiene
+# un record ogni N (LOG_SAMPLING, "evento=N,...")
+campi_log: dict = {}
+gestore_log = configura_logging(
+    livello=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    formato=os.environ.get('LOG_FORMAT', 'json'),
+    campionamento=leggi_campionamento(os.environ.get('LOG_SAMPLING', 'foto_ricevuta=10,campo_ricevuto=10')),
+    capacita=int(os.environ.get('LOG_QUEUE_SIZE', 10000)),
+    campi=campi_log)
+# httpx registra ogni chiamata alla Bot API: durata ed errori sono già nelle metriche
+logging.getLogger('httpx').setLevel(logging.WARNING)
 logger = logging.getLogger(__name__)
 
 # Carica il token da una variabile d'ambiente per sicurezza
@@ -20,6 +65,9 @@ TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
 if not TOKEN:
     raise ValueError("La variabile d'ambiente TELEGRAM_BOT_TOKEN non è stata impostata.")
 
+# URL della Bot API: di default quella di Telegram, in locale un finto server per i benchmark
+TELEGRAM_API_BASE_URL = os.environ.get('TELEGRAM_API_BASE_URL', 'https://api.telegram.org')
+
 # Carica gli ID dei gruppi e dei topic dalle variabili d'ambiente
 try:
     GROUP_CHAT_ID = int(os.environ.get('GROUP_CHAT_ID'))
@@ -28,10 +76,245 @@ try:
 except (TypeError, ValueError):
     raise ValueError("Errore: Assicurati che le variabili d'ambiente GROUP_CHAT_ID, TOPIC_MESSAGE_THREAD_ID, e MODERATION_CHAT_ID siano impostate e siano numeri interi.")
 
+# Modalità di gestione del webhook: 'sync' elabora l'aggiornamento prima di rispondere,
+# 'queue' risponde subito a Telegram e lo accoda a un pool di worker
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'sync').lower()
+UPDATE_WORKERS = int(os.environ.get('UPDATE_WORKERS', 8))
+UPDATE_QUEUE_SIZE = int(os.environ.get('UPDATE_QUEUE_SIZE', 256))
+UPDATE_QUEUE_PUT_TIMEOUT = float(os.environ.get('UPDATE_QUEUE_PUT_TIMEOUT', 2.0))
+# In modalità 'queue' Telegram non reinvia gli aggiornamenti falliti: ci riprovano i worker
+UPDATE_MAX_RETRIES = int(os.environ.get('UPDATE_MAX_RETRIES', 3))
+
+# Ultimi update_id visti, per rendere innocui i reinvii di Telegram e riprendere i
+# tentativi falliti dal punto in cui si erano fermati
+registro_aggiornamenti = UpdateRegistry(int(os.environ.get('UPDATE_DEDUP_WINDOW', 10000)))
+
+# Chat i cui messaggi vengono scartati prima del parse completo, tranne i comandi
+# (di default il gruppo degli annunci, molto trafficato e dove il bot non risponde)
+PREFILTER_IGNORED_CHAT_IDS = [
+    int(chat_id) for chat_id in
+    os.environ.get('PREFILTER_IGNORED_CHAT_IDS', str(GROUP_CHAT_ID)).split(',') if chat_id.strip()
+]
+
+# Anti-flood in ingresso: FLOOD_USER_RATE messaggi al secondo per utente (con raffiche fino a
+# FLOOD_USER_BURST), limiti propri per i comandi in FLOOD_COMMAND_LIMITS ("comando=rate/burst,…",
+# "inline" per le query inline). La chat dei moderatori non ha limiti.
+antiflood = FloodLimiter(
+    rate=float(os.environ.get('FLOOD_USER_RATE', 1)),
+    burst=float(os.environ.get('FLOOD_USER_BURST', 20)),
+    limiti_comandi=leggi_limiti(os.environ.get(
+        'FLOOD_COMMAND_LIMITS', 'nuovo_annuncio=0.05/3,riprendi=0.1/3,avvisami=0.2/5,inline=2/20')),
+    chat_rate=float(os.environ.get('FLOOD_CHAT_RATE', 5)),
+    chat_burst=float(os.environ.get('FLOOD_CHAT_BURST', 30)),
+    chat_esenti=[MODERATION_CHAT_ID],
+    finestra=float(os.environ.get('FLOOD_WARN_WINDOW', 10)),
+    soglia_blocco=int(os.environ.get('FLOOD_BAN_THRESHOLD', 50)),
+    durata_blocco=float(os.environ.get('FLOOD_BAN_SECONDS', 600)))
+BLOCCO_MINUTI = 60
+
+# File SQLite che conserva bozze, moderazioni in sospeso e stati delle conversazioni
+DATABASE_PATH = os.environ.get('DATABASE_PATH', 'bot.db')
+PERSISTENCE_UPDATE_INTERVAL = float(os.environ.get('PERSISTENCE_UPDATE_INTERVAL', 10))
+PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get('PERSISTENCE_FLUSH_INTERVAL', 2))
+
+# Con WORKER_PROCESSES > 1 questo processo fa da supervisore: avvia i worker (WORKER_INDEX e
+# WORKER_SOCKET li imposta lui) e smista loro gli aggiornamenti per utente
+WORKER_PROCESSES = max(1, int(os.environ.get('WORKER_PROCESSES', 1)))
+WORKER_INDEX = int(os.environ['WORKER_INDEX']) if 'WORKER_INDEX' in os.environ else None
+WORKER_SOCKET = os.environ.get('WORKER_SOCKET')
+SUPERVISORE = WORKER_PROCESSES > 1 and WORKER_INDEX is None
+if WORKER_INDEX is not None:
+    # I worker scrivono sullo stesso stderr del supervisore
+    campi_log['worker'] = WORKER_INDEX
+# Il worker che riceve la chat dei moderatori decide gli annunci, li pubblica e configura
+# webhook e comandi; gli altri gestiscono solo i propri utenti
+PRINCIPALE = WORKER_INDEX is None or HashRing(WORKER_PROCESSES).nodo(MODERATION_CHAT_ID) == WORKER_INDEX
+# Le scritture degli archivi (moderazioni, catalogo, ricerche, impronte, coda) passano per
+# un solo thread, fuori dal loop; gli indici in memoria restano aggiornati sul loop
+scrittore_archivi = SQLiteWriter()
+# Modifiche agli archivi condivisi tra i worker, rilette ogni SHARED_SYNC_INTERVAL secondi
+registro_modifiche = ChangeLog(scrittore_archivi) if WORKER_PROCESSES > 1 else None
+SHARED_SYNC_INTERVAL = float(os.environ.get('SHARED_SYNC_INTERVAL', 1))
+MODIFICHE_CONSERVATE = 3600
+
+# Telegram accetta al massimo 10 elementi per album: le bozze con più foto vengono divise
+MAX_FOTO_ALBUM = 10
+# Secondi di attesa dopo l'ultima foto di un album prima di rispondere all'utente
+ALBUM_DEBOUNCE = float(os.environ.get('ALBUM_DEBOUNCE', 1.5))
+# Conferme degli album in arrivo: (chat_id, media_group_id) -> (task della risposta, foto ricevute)
+album_in_arrivo: dict[tuple, tuple] = {}
+
+# Termini ed espressioni vietati nei testi degli annunci, ricaricati ogni
+# CONTENT_RULES_RELOAD_INTERVAL secondi se il file cambia
+filtro_contenuti = ContentFilter(os.environ.get('CONTENT_RULES_PATH', 'content_rules.json'))
+CONTENT_RULES_RELOAD_INTERVAL = int(os.environ.get('CONTENT_RULES_RELOAD_INTERVAL', 30))
+
+# Impronte delle foto già inviate (il database viene aperto in main()): foto identiche per
+# file_unique_id, simili per hash percettivo entro PHOTO_HASH_DISTANCE bit su 64
+impronte = PhotoIndex(int(os.environ.get('PHOTO_HASH_DISTANCE', 8)), modifiche=registro_modifiche,
+                      scrittore=scrittore_archivi)
+FINGERPRINT_WORKERS = int(os.environ.get('FINGERPRINT_WORKERS', 2))
+# La scheda di moderazione parte subito; gli hash ancora in calcolo che finiscono entro
+# FINGERPRINT_WAIT secondi aggiungono i loro duplicati modificandola
+FINGERPRINT_WAIT = float(os.environ.get('FINGERPRINT_WAIT', 5))
+# Per l'hash si scarica la versione più piccola della foto con almeno questo lato
+FINGERPRINT_MIN_SIDE = 320
+# Annunci con foto già inviate elencati al massimo sulla scheda (la didascalia ha un limite)
+MAX_DUPLICATI = 3
+# Pool di processi per gli hash: creato in main() solo se Pillow è installato
+pool_impronte = None
+# Hash in calcolo: file_unique_id -> task
+impronte_in_corso: dict[str, asyncio.Task] = {}
+# Schede di moderazione che si stanno modificando per aggiungere i duplicati: message_id -> task
+duplicati_in_modifica: dict[int, asyncio.Task] = {}
+
+# Una bozza di annuncio senza risposte per DRAFT_TIMEOUT secondi scade; l'utente può
+# riprenderla con /riprendi per DRAFT_RESUME_GRACE secondi, poi viene eliminata
+DRAFT_TIMEOUT = int(os.environ.get('DRAFT_TIMEOUT', 1800))
+DRAFT_RESUME_GRACE = int(os.environ.get('DRAFT_RESUME_GRACE', 86400))
+DRAFT_SWEEP_INTERVAL = int(os.environ.get('DRAFT_SWEEP_INTERVAL', 600))
+# Limiti di una bozza: foto e lunghezza dei testi (la scheda con foto è una didascalia,
+# che Telegram tronca a 1024 caratteri)
+# I limiti non superano quelli del record dell'annuncio (ad_record), che altrimenti
+# taglierebbe testi e foto senza che l'utente li veda
+DRAFT_MAX_PHOTOS = min(int(os.environ.get('DRAFT_MAX_PHOTOS', 30)), MAX_FOTO)
+MAX_LUNGHEZZA = {'title': min(100, MAX_TITOLO), 'description': min(700, MAX_DESCRIZIONE),
+                 'location': min(60, MAX_LOCALITA)}
+# Campi di user_data che compongono la bozza in corso
+CAMPI_BOZZA = ('photos', 'impronte', 'title', 'description', 'location', 'price', 'bozza_il',
+               'scheda_bozza', 'passo')
+# Wizard dell'annuncio: 'messaggi' invia un messaggio a ogni passo, 'scheda' tiene una sola
+# scheda della bozza con pulsanti inline e la modifica a ogni passo
+WIZARD_MODE = os.environ.get('WIZARD_MODE', 'messaggi').lower()
+# Le liste aperte con /coda nelle chat_data vengono eliminate dopo questo tempo
+CODA_SCADENZA = 86400
+# Esito dell'ultima pulizia, esposto in /stato
+statistiche_bozze: dict = {'attive': 0, 'in_grazia': 0, 'eliminate': 0, 'byte_liberati': 0}
+
+# Gli annunci che nessun moderatore esamina entro questo tempo scadono e l'utente viene avvisato
+MODERATION_TTL_HOURS = float(os.environ.get('MODERATION_TTL_HOURS', 72))
+MODERATION_SWEEP_INTERVAL = int(os.environ.get('MODERATION_SWEEP_INTERVAL', 600))
+
+# Annunci in attesa di moderazione (il database viene aperto in main())
+moderazioni = ModerationStore(modifiche=registro_modifiche, scrittore=scrittore_archivi)
+# Annunci approvati, ricercabili con le query inline (il database viene aperto in main())
+catalogo = AdCatalog(modifiche=registro_modifiche, scrittore=scrittore_archivi)
+# Telegram mostra al massimo 50 risultati per risposta inline
+INLINE_RESULTS = min(int(os.environ.get('INLINE_RESULTS', 20)), 50)
+INLINE_CACHE_TIME = int(os.environ.get('INLINE_CACHE_TIME', 30))
+
+# Ricerche salvate con /avvisami (il database viene aperto in main())
+ricerche_salvate = SavedSearches(int(os.environ.get('ALERTS_PER_USER', 10)), modifiche=registro_modifiche,
+                                 scrittore=scrittore_archivi)
+# Gli avvisi si accumulano per questo tempo e partono come un solo messaggio per utente
+ALERT_BATCH_WINDOW = float(os.environ.get('ALERT_BATCH_WINDOW', 60))
+# Gli annunci approvati escono nel topic al massimo PUBLISH_PER_MINUTE al minuto e mai nelle
+# ore di silenzio (PUBLISH_QUIET_HOURS, es. "23-7", nel fuso PUBLISH_TIMEZONE)
+_silenzio = os.environ.get('PUBLISH_QUIET_HOURS', '').strip()
+pubblicazioni = PublishQueue(
+    per_minuto=float(os.environ.get('PUBLISH_PER_MINUTE', 4)),
+    silenzio=tuple(int(ora) for ora in _silenzio.split('-')) if _silenzio else None,
+    fuso_orario=os.environ.get('PUBLISH_TIMEZONE', 'Europe/Rome'),
+    scrittore=scrittore_archivi)
+# Dopo questi tentativi falliti (o subito, se Telegram rifiuta l'annuncio) la
+# pubblicazione viene sospesa e i moderatori decidono se riprovarla o scartarla
+PUBLISH_MAX_ATTEMPTS = 3
+rilascio_in_corso = asyncio.Lock()
+
+# Annunci per pagina nel comando /coda dei moderatori
+CODA_PAGINA = int(os.environ.get('CODA_PAGE_SIZE', 8))
+# Utenti avvisati per ogni blocco di invii accodati allo scheduler
+ALERT_FANOUT_CHUNK = 100
+# Annunci in attesa di essere segnalati: user_id -> righe dell'avviso
+avvisi_in_attesa: dict[int, list[str]] = {}
+
+# Tutti gli invii verso la Bot API passano da qui per rispettare i limiti di flood di Telegram
+# (messaggi al secondo in totale, al secondo per chat privata, al minuto per gruppo).
+# Con più worker ognuno ha la sua quota del limite totale. Quello per chat privata resta
+# intero, perché ogni utente sta in un solo worker, e così quello per gruppo: nel gruppo
+# pubblica solo il worker principale. Le schede che i worker mandano insieme alla chat
+# dei moderatori possono superarlo di poco; l'eventuale RetryAfter le rallenta.
+outbox = SendScheduler(
+    global_rate=float(os.environ.get('OUTBOX_GLOBAL_RATE', 25)) / WORKER_PROCESSES,
+    chat_rate=float(os.environ.get('OUTBOX_CHAT_RATE', 1)),
+    group_rate=float(os.environ.get('OUTBOX_GROUP_RATE_PER_MINUTE', 20)) / 60)
+
 # Stati della conversazione per l'annuncio
 ACCETTAZIONE_README, FOTO, TITOLO, DESCRIZIONE, LOCALITA, PREZZO, CONFERMA = range(7)
 # Stati per il tutorial
 TUTORIAL_START, TUTORIAL_STEP_1_MENU, TUTORIAL_STEP_2_PROVA = range(6, 9)
+NOMI_STATI = {
+    'annuncio': {ACCETTAZIONE_README: 'accettazione_readme', FOTO: 'foto', TITOLO: 'titolo',
+                 DESCRIZIONE: 'descrizione', LOCALITA: 'localita', PREZZO: 'prezzo', CONFERMA: 'conferma'},
+    'tutorial': {TUTORIAL_START: 'inizio', TUTORIAL_STEP_1_MENU: 'conteggio_comandi',
+                 TUTORIAL_STEP_2_PROVA: 'prova'},
+}
+
+# Metriche esportate su /metrics: registrarle costa un conteggio, senza lock
+metriche = MetricsRegistry()
+metrica_aggiornamenti = metriche.counter(
+    'bot_aggiornamenti_total', "Aggiornamenti ricevuti sul webhook, per tipo ed esito", ('tipo', 'esito'))
+metrica_handler = metriche.counter(
+    'bot_handler_total', "Chiamate agli handler, per tipo di aggiornamento, handler ed esito",
+    ('tipo', 'handler', 'esito'))
+metrica_durata_handler = metriche.histogram(
+    'bot_handler_durata_seconds', "Durata degli handler", ('handler',))
+metrica_durata_api = metriche.histogram(
+    'bot_api_durata_seconds', "Durata delle chiamate alla Bot API, per metodo", ('metodo',))
+metrica_errori_api = metriche.counter(
+    'bot_api_errori_total', "Chiamate alla Bot API fallite, per metodo e codice HTTP o eccezione",
+    ('metodo', 'motivo'))
+metrica_durata_http = metriche.histogram(
+    'bot_http_durata_seconds', "Tempo di risposta del server web (webhook compreso), per percorso e stato",
+    ('percorso', 'stato'))
+metriche.gauge(
+    'bot_moderazioni_in_sospeso', "Annunci in attesa di moderazione",
+    lambda: [((), len(moderazioni))])
+metriche.gauge(
+    'bot_moderazioni_eta_massima_seconds', "Da quanto aspetta l'annuncio più vecchio in moderazione",
+    lambda: [((), time.time() - ad.inviato_il if (ad := moderazioni.piu_vecchio()) else 0.0)])
+metriche.gauge(
+    'bot_log_scartati', "Record di log non scritti, per motivo (campionamento o coda piena)",
+    lambda: [((motivo,), n) for motivo, n in record_scartati(gestore_log).items()], ('motivo',))
+metrica_ritardo_loop = metriche.histogram(
+    'bot_loop_ritardo_seconds', "Ritardo del loop degli eventi rispetto ai risvegli programmati", (),
+    limiti=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0))
+
+# Sorveglianza del loop: oltre LOOP_LAG_THRESHOLD secondi di blocco registra la pila
+# del codice che lo blocca, oltre SLOW_UPDATE_THRESHOLD la traccia dell'aggiornamento
+sorveglianza = LoopWatchdog(
+    soglia_loop=float(os.environ.get('LOOP_LAG_THRESHOLD', 0.5)),
+    soglia_aggiornamento=float(os.environ.get('SLOW_UPDATE_THRESHOLD', 2.0)),
+    intervallo=float(os.environ.get('LOOP_MONITOR_INTERVAL', 0.1)),
+    istogramma_ritardo=metrica_ritardo_loop)
+# Profiler a campionamento: /profila dai moderatori o PROFILE_ON_START secondi all'avvio
+profiler = SamplingProfiler(
+    os.environ.get('PROFILE_DIR', 'profili'), float(os.environ.get('PROFILE_INTERVAL', 0.005)))
+PROFILE_ON_START = float(os.environ.get('PROFILE_ON_START', 0))
+PROFILO_SECONDI = 30
+PROFILO_MAX_SECONDI = 300
+
+# Chiusura su SIGTERM: secondi concessi agli aggiornamenti in corso e agli invii in coda
+SHUTDOWN_TIMEOUT = float(os.environ.get('SHUTDOWN_TIMEOUT', 25))
+# Con SO_REUSEPORT la nuova istanza può mettersi in ascolto mentre la vecchia chiude
+WEB_REUSE_PORT = os.environ.get('WEB_REUSE_PORT', '1') == '1' and hasattr(socket, 'SO_REUSEPORT')
+
+# Comandi del menu (il tutorial chiede di contarli)
+COMANDI_MENU = [
+    BotCommand("start", "Avvia il bot"),
+    BotCommand("readme", "Istruzioni preliminari"),
+    BotCommand("nuovo_annuncio", "Crea annuncio di Stock oggetti"),
+    BotCommand("cancel", "Annulla la creazione dell'annuncio"),
+    BotCommand("avvisami", "Avvisami quando esce un annuncio che cerco"),
+    BotCommand("cosa_sono_i_bot", "introduzione ai bot di telegram")
+]
+# Nella chat dei moderatori compaiono anche questi
+COMANDI_MODERATORI = [
+    BotCommand("coda", "Annunci in attesa, da moderare in blocco"),
+    BotCommand("profila", "Profila il bot per qualche secondo"),
+    BotCommand("blocca", "Blocca un utente per qualche minuto"),
+    BotCommand("sblocca", "Sblocca un utente bloccato"),
+]
 
 
 # 🟦 ▓▓▓▒▒▒░░░ /start configurazione comando
@@ -54,6 +337,12 @@ Per annullare la creazione del tuo annuncio.
 
 🤖  <b>/cosa_sono_i_bot</b>
 Prima volta che usi i bot di telegram ? Ti consigliamo questo semplicissimo tutorial.
+
+🔔  <b>/avvisami</b>
+Per ricevere un messaggio quando viene pubblicato un annuncio che ti interessa.
+
+🔎  <b>@{context.bot.username}</b>
+Scrivilo in qualsiasi chat seguito da quello che cerchi per trovare gli annunci pubblicati (es. <code>@{context.bot.username} libri @milano &lt;50</code>).
 """
     if support_topic_url:
         messaggio_start += f"""
@@ -113,6 +402,56 @@ Usa il comando /nuovo_annuncio per iniziare.
 
 
 
+# 🟦 ▓▓▓▒▒▒░░░ /avvisami
+async def avvisami(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Salva una ricerca e avvisa l'utente quando viene pubblicato un annuncio che la soddisfa."""
+    user_id = update.effective_user.id
+    testo = ' '.join(context.args)
+    if testo:
+        try:
+            ricerca = await ricerche_salvate.aggiungi(user_id, testo)
+        except ValueError:
+            if ricerche_salvate.per_utente(user_id):
+                await update.message.reply_text(
+                    f"Hai già {ricerche_salvate.max_per_utente} ricerche salvate: eliminane una prima di aggiungerne altre.")
+            else:
+                await update.message.reply_text("Scrivi cosa cerchi dopo il comando, ad esempio: /avvisami libri @milano <50")
+            return
+        await update.message.reply_html(
+            f"🔔 Fatto! Ti avviserò quando verrà pubblicato un annuncio per <b>{html.escape(ricerca.testo)}</b>.")
+        return
+
+    ricerche = ricerche_salvate.per_utente(user_id)
+    if not ricerche:
+        await update.message.reply_html(
+            "🔔 Con <b>/avvisami</b> ti avviso quando viene pubblicato un annuncio che ti interessa.\n\n"
+            "Esempio: <code>/avvisami libri @milano &lt;50</code>\n"
+            "• le parole vengono cercate in titolo, descrizione e località;\n"
+            "• <code>@città</code> filtra per località;\n"
+            "• <code>&lt;50</code>, <code>&gt;10</code> o <code>10-50</code> filtrano per prezzo.")
+        return
+    keyboard = [[InlineKeyboardButton(f"🗑 {ricerca.testo}", callback_data=f"annulla_avviso_{ricerca.id}")]
+                for ricerca in ricerche]
+    await update.message.reply_text(
+        "🔔 Le tue ricerche salvate. Tocca una ricerca per eliminarla:",
+        reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+async def annulla_avviso(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    ricerca = ricerche_salvate.rimuovi(int(query.data.rsplit('_', 1)[1]), query.from_user.id)
+    await query.answer(f"Ricerca \"{ricerca.testo}\" eliminata." if ricerca else "Ricerca già eliminata.")
+    ricerche = ricerche_salvate.per_utente(query.from_user.id)
+    if ricerche:
+        keyboard = [[InlineKeyboardButton(f"🗑 {r.testo}", callback_data=f"annulla_avviso_{r.id}")]
+                    for r in ricerche]
+        await query.edit_message_reply_markup(InlineKeyboardMarkup(keyboard))
+    else:
+        await query.edit_message_text("🔕 Non hai più ricerche salvate.")
+# 🟧  ▓▓▓▒▒▒░░░ 
+
+
+
 # 🟦 ▓▓▓▒▒▒░░░ /cosa_sono_i_bot
 async def cosa_sono_i_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
     testo_spiegazione = """🤖 <b>Cosa sono i Bot e come si usano?</b>
@@ -158,7 +497,7 @@ async def ricevi_conteggio_comandi(update: Update, context: ContextTypes.DEFAULT
 
 
 # 🔹 ▓▓▓▒▒▒░░░ /cosa_sono_i_bot > mini-tutorial > step 2 
-    if update.message.text.strip() == '5':
+    if update.message.text.strip() == str(len(COMANDI_MENU)):
         testo_successo = """Esatto! ✅
 
 <b>Step 2 di 3: Avviare un Comando Manualmente</b>
@@ -236,22 +575,36 @@ async def accetta_readme(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """L'utente ha spuntato la dichiarazione. Avvia il processo di creazione annuncio."""
     query = update.callback_query
     await query.answer()
+    # Una nuova bozza sostituisce quella scaduta e quella eventualmente in corso
+    # (con allow_reentry /nuovo_annuncio può arrivare a metà di un'altra bozza)
+    context.user_data.pop('bozza_scaduta', None)
+    for campo in CAMPI_BOZZA:
+        context.user_data.pop(campo, None)
+    annulla_conferme_album(query.message.chat_id)
+    annulla_bozza_in_attesa(query.message.chat_id)
+    context.user_data['photos'] = []
+    context.user_data['bozza_il'] = time.time()
+    if WIZARD_MODE == 'scheda':
+        # Il messaggio della dichiarazione diventa la scheda della bozza
+        context.user_data['scheda_bozza'] = query.message.message_id
+        return await mostra_bozza(context, query.message.chat_id, FOTO)
 
     await query.edit_message_text(text="Perfetto, grazie per la conferma! Iniziamo.")
     
     # Ora avviamo il processo vero e proprio, partendo dalle foto
-    await query.message.reply_text(
-        "<b>1  Carica le Foto</b>\n\n"
-        "Allega una o più foto del tuo articolo \n\n"
-        "<i>💡 Consigli: </i>\n"
-        "<i>- Cerca di usare sfondi neutri</i>\n"
-        "<i>- Allega una foto che mostri tutti gli oggetti </i>\n"
-        "<i>- Usa foto di dettaglio per mostrare lo stato </i>\n",
-        parse_mode='HTML'
-    )
-    context.user_data['photos'] = []
+    await query.message.reply_text(TESTO_FOTO, parse_mode='HTML')
     return FOTO
 
+
+TESTO_FOTO = (
+    "<b>1  Carica le Foto</b>\n\n"
+    "Allega una o più foto del tuo articolo \n\n"
+    "<i>💡 Consigli: </i>\n"
+    "<i>- Cerca di usare sfondi neutri</i>\n"
+    "<i>- Allega una foto che mostri tutti gli oggetti </i>\n"
+    "<i>- Usa foto di dettaglio per mostrare lo stato </i>\n")
+
+
 async def mostra_readme_da_accettazione(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Mostra il readme e termina la conversazione per evitare blocchi."""
     query = update.callback_query
@@ -267,25 +620,102 @@ async def mostra_readme_da_accettazione(update: Update, context: ContextTypes.DE
     return ConversationHandler.END
     
 
+async def conferma_foto(message, testo: str) -> None:
+    keyboard = [[KeyboardButton("✅ Fatto")]]
+    reply_markup = ReplyKeyboardMarkup(keyboard,
+                                       resize_keyboard=True,
+                                       one_time_keyboard=True)
+    await message.reply_text(
+        f"{testo} Puoi inviarne altre oppure, quando hai finito, premi il bottone '✅ Fatto'.",
+        reply_markup=reply_markup)
+
+
+async def conferma_album_ritardata(message, chiave: tuple, photos: list) -> None:
+    """Risponde una sola volta all'album, quando non arrivano altre foto per ALBUM_DEBOUNCE secondi."""
+    await asyncio.sleep(ALBUM_DEBOUNCE)
+    conteggio = album_in_arrivo.pop(chiave)[1]
+    testo = f"Album ricevuto: {conteggio} foto!"
+    if len(photos) > conteggio:
+        testo += f" In totale hai inviato {len(photos)} foto."
+    if len(photos) >= DRAFT_MAX_PHOTOS:
+        testo += f" Hai raggiunto il massimo di {DRAFT_MAX_PHOTOS} foto: le altre non verranno aggiunte."
+    try:
+        await conferma_foto(message, testo)
+    except Exception as e:
+        logger.error(f"Impossibile confermare l'album {chiave[1]}: {e}")
+
+
+def annulla_conferme_album(chat_id: int) -> None:
+    for chiave in [k for k in album_in_arrivo if k[0] == chat_id]:
+        album_in_arrivo.pop(chiave)[0].cancel()
+
+
 async def ricevi_foto(update: Update, context):
     if update.message.photo:
         file_id = update.message.photo[-1].file_id
-        context.user_data['photos'].append(file_id)
-        logger.info(f"Ricevuta foto: {file_id}")
-        keyboard = [[KeyboardButton("✅ Fatto")]]
-        reply_markup = ReplyKeyboardMarkup(keyboard,
-                                           resize_keyboard=True,
-                                           one_time_keyboard=True)
-        await update.message.reply_text(
-            "Foto ricevuta! Puoi inviarne altre oppure, quando hai finito, premi il bottone '✅ Fatto'.",
-            reply_markup=reply_markup)
+        photos = context.user_data.setdefault('photos', [])
+        context.user_data['bozza_il'] = time.time()
+        # Se l'aggiornamento viene rielaborato dopo un errore la foto è già nella bozza
+        passi = registro_aggiornamenti.passi(update.update_id)
+        ripetuto = 'foto' in passi
+        passi['foto'] = True
+        if WIZARD_MODE == 'scheda':
+            return ricevi_foto_scheda(update, context, photos, ripetuto)
+        if len(photos) >= DRAFT_MAX_PHOTOS and not update.message.media_group_id:
+            await update.message.reply_text(
+                f"Hai raggiunto il massimo di {DRAFT_MAX_PHOTOS} foto. Premi il bottone '✅ Fatto' per continuare.")
+            return FOTO
+        if len(photos) < DRAFT_MAX_PHOTOS and not ripetuto:
+            photos.append(file_id)
+            avvia_impronta(context, update.message.photo, context.user_data.setdefault('impronte', {}))
+        logger.info("Ricevuta foto", extra={'evento': 'foto_ricevuta', 'file_id': file_id})
+        media_group_id = update.message.media_group_id
+        if media_group_id:
+            # Le foto di un album arrivano come aggiornamenti separati: si rimanda la
+            # risposta a dopo l'ultima foto, ripartendo da capo a ogni nuova foto
+            chiave = (update.effective_chat.id, media_group_id)
+            precedente = album_in_arrivo.get(chiave)
+            if precedente:
+                precedente[0].cancel()
+            conteggio = (precedente[1] if precedente else 0) + (0 if ripetuto else 1)
+            task = asyncio.create_task(
+                conferma_album_ritardata(update.message, chiave, photos))
+            album_in_arrivo[chiave] = (task, conteggio)
+        else:
+            await esegui_passo(passi, 'conferma', conferma_foto, update.message, "Foto ricevuta!")
         return FOTO
     else:
         await update.message.reply_text("Per favore, invia una foto.")
         return FOTO
 
 
+def avvia_impronta(context, formati, impronte_bozza: dict) -> None:
+    """Segna la foto nella bozza e avvia in background il calcolo del suo hash percettivo."""
+    file_unique_id = formati[-1].file_unique_id
+    impronte_bozza.setdefault(file_unique_id, None)
+    if (pool_impronte is None or file_unique_id in impronte_in_corso
+            or impronte_bozza[file_unique_id] is not None):
+        return
+    formato = next((f for f in formati if min(f.width, f.height) >= FINGERPRINT_MIN_SIDE), formati[-1])
+    task = context.application.create_task(
+        calcola_impronta(context.bot, formato.file_id, file_unique_id, impronte_bozza))
+    impronte_in_corso[file_unique_id] = task
+    task.add_done_callback(lambda _: impronte_in_corso.pop(file_unique_id, None))
+
+
+async def calcola_impronta(bot, file_id: str, file_unique_id: str, impronte_bozza: dict) -> None:
+    try:
+        file = await bot.get_file(file_id)
+        contenuto = await file.download_as_bytearray()
+        impronte_bozza[file_unique_id] = await asyncio.get_running_loop().run_in_executor(
+            pool_impronte, dhash, bytes(contenuto))
+    except Exception as e:
+        logger.error(f"Impossibile calcolare l'impronta della foto {file_unique_id}: {e}")
+
+
 async def foto_fatto(update: Update, context):
+    annulla_conferme_album(update.effective_chat.id)
+    context.user_data['bozza_il'] = time.time()
     if not context.user_data.get('photos'):
         await update.message.reply_text(
             "Non hai inviato nessuna foto. Per favore, invia almeno una foto.")
@@ -296,9 +726,36 @@ async def foto_fatto(update: Update, context):
     return TITOLO
 
 
+def errore_campo(testo: str, campo: str, nome: str, user_id: int) -> Optional[str]:
+    """Perché il testo non può entrare nella bozza (troppo lungo o con contenuti vietati), oppure None."""
+    if len(testo) > MAX_LUNGHEZZA[campo]:
+        return (f"{nome}: {len(testo)} caratteri, il massimo è {MAX_LUNGHEZZA[campo]}. "
+                "Per favore, accorcialo e invialo di nuovo.")
+    vietati = [v.motivo for v in filtro_contenuti.esamina(testo) if v.azione == BLOCCA]
+    if vietati:
+        logger.info(f"Testo dell'utente {user_id} bloccato dal filtro: {', '.join(vietati)}")
+        return (f"{nome}: questo contenuto non è ammesso negli annunci ({', '.join(vietati)}). "
+                "Gli interessati ti contatteranno su Telegram. Per favore, correggilo e invialo di nuovo.")
+    return None
+
+
+async def campo_non_valido(update: Update, context, campo: str, nome: str) -> bool:
+    """Rifiuta i testi oltre il limite della bozza o con contenuti vietati; altrimenti li salva."""
+    testo = update.message.text
+    errore = errore_campo(testo, campo, nome, update.effective_user.id)
+    if errore:
+        await update.message.reply_text(errore)
+        return True
+    context.user_data[campo] = testo
+    context.user_data['bozza_il'] = time.time()
+    return False
+
+
 async def ricevi_titolo(update: Update, context):
-    context.user_data['title'] = update.message.text
-    logger.info(f"Titolo ricevuto: {context.user_data['title']}")
+    if await campo_non_valido(update, context, 'title', "Titolo"):
+        return TITOLO
+    logger.info("Titolo ricevuto", extra={'evento': 'campo_ricevuto', 'campo': 'title',
+                                          'testo': context.user_data['title']})
     await update.message.reply_text(
         "Titolo ricevuto! Ora, per favora, invia la **descrizione** del tuo annuncio."
     )
@@ -306,8 +763,10 @@ async def ricevi_titolo(update: Update, context):
 
 
 async def ricevi_descrizione(update: Update, context):
-    context.user_data['description'] = update.message.text
-    logger.info(f"Descrizione ricevuta: {context.user_data['description']}")
+    if await campo_non_valido(update, context, 'description', "Descrizione"):
+        return DESCRIZIONE
+    logger.info("Descrizione ricevuta", extra={'evento': 'campo_ricevuto', 'campo': 'description',
+                                               'testo': context.user_data['description']})
     await update.message.reply_text(
         "Descrizione ricevuta! Ora, per favore, indica la **località** (es. Roma, Milano)."
     )
@@ -315,8 +774,10 @@ async def ricevi_descrizione(update: Update, context):
 
 
 async def ricevi_localita(update: Update, context):
-    context.user_data['location'] = update.message.text
-    logger.info(f"Località ricevuta: {context.user_data['location']}")
+    if await campo_non_valido(update, context, 'location', "Località"):
+        return LOCALITA
+    logger.info("Località ricevuta", extra={'evento': 'campo_ricevuto', 'campo': 'location',
+                                            'testo': context.user_data['location']})
     await update.message.reply_text(
         "Località ricevuta! Infine, per favore, invia il **prezzo** del tuo articolo (solo il numero, es. 25.50)."
     )
@@ -324,93 +785,108 @@ async def ricevi_localita(update: Update, context):
 
 
 async def ricevi_prezzo(update: Update, context):
-    price_text = update.message.text
-    try:
-        price = float(price_text.replace(',', '.'))
-        context.user_data['price'] = price
-        logger.info(f"Prezzo ricevuto: {context.user_data['price']}")
-        summary = (
-            f"**Riepilogo del tuo annuncio:**\n\n"
-            f"**Titolo:** {context.user_data.get('title', 'N/A')}\n"
-            f"**Descrizione:** {context.user_data.get('description', 'N/A')}\n"
-            f"**Località:** {context.user_data.get('location', 'N/A')}\n"
-            f"**Prezzo:** €{context.user_data.get('price', 'N/A'):.2f}\n"
-            f"**Numero di foto:** {len(context.user_data.get('photos', []))}\n\n"
-            "È corretto? Digita 'Si' per confermare o 'No' per annullare.")
-        await update.message.reply_text(summary, parse_mode='Markdown')
-        return CONFERMA
-    except ValueError:
+    centesimi = in_centesimi(update.message.text)
+    if centesimi is None:
         await update.message.reply_text(
             "Formato prezzo non valido. Per favora, inserisci solo un numero (es. 25 o 25.50)."
         )
         return PREZZO
+    context.user_data['price'] = centesimi / 100
+    context.user_data['bozza_il'] = time.time()
+    logger.info("Prezzo ricevuto", extra={'evento': 'campo_ricevuto', 'campo': 'price',
+                                          'prezzo': context.user_data['price']})
+    await update.message.reply_text(riepilogo_bozza(context.user_data), parse_mode='Markdown')
+    return CONFERMA
+
+
+def riepilogo_bozza(dati: dict) -> str:
+    return (
+        f"**Riepilogo del tuo annuncio:**\n\n"
+        f"**Titolo:** {dati.get('title', 'N/A')}\n"
+        f"**Descrizione:** {dati.get('description', 'N/A')}\n"
+        f"**Località:** {dati.get('location', 'N/A')}\n"
+        f"**Prezzo:** {formatta_prezzo(in_centesimi(dati.get('price')))}\n"
+        f"**Numero di foto:** {len(dati.get('photos', []))}\n\n"
+        "È corretto? Digita 'Si' per confermare o 'No' per annullare.")
+
+
+async def esegui_passo(passi: dict, nome: str, funzione, *args, **kwargs):
+    """Esegue `funzione` solo se il passo `nome` non è già riuscito per questo aggiornamento."""
+    if nome not in passi:
+        passi[nome] = await funzione(*args, **kwargs)
+    return passi[nome]
+
+
+def blocchi_album(photos) -> list[list[str]]:
+    """Divide le foto in blocchi da al massimo MAX_FOTO_ALBUM, di dimensioni il più possibile uguali.
+
+    Telegram accetta album da 2 a 10 elementi: 11 foto diventano 6 + 5 invece di 10 + 1.
+    """
+    numero_blocchi = -(-len(photos) // MAX_FOTO_ALBUM)
+    base, resto = divmod(len(photos), numero_blocchi)
+    blocchi, inizio = [], 0
+    for i in range(numero_blocchi):
+        fine = inizio + base + (1 if i < resto else 0)
+        blocchi.append(list(photos[inizio:fine]))
+        inizio = fine
+    return blocchi
+
+
+async def invia_foto(context, chat_id: int, priorita: int, photos, caption: str,
+                     parse_mode: str, **kwargs) -> list:
+    """Invia le foto in uno o più album, con la didascalia sulla prima foto.
+
+    Restituisce tutti i messaggi inviati: il primo è quello con la didascalia.
+    """
+    messaggi = []
+    for n, blocco in enumerate(blocchi_album(photos)):
+        didascalia = caption if n == 0 else None
+        if len(blocco) == 1:
+            messaggio = await outbox.invia(
+                chat_id, priorita, context.bot.send_photo,
+                chat_id=chat_id, photo=blocco[0], caption=didascalia,
+                parse_mode=parse_mode, **kwargs)
+            messaggi.append(messaggio)
+        else:
+            media_group = [
+                InputMediaPhoto(media=file_id,
+                                caption=didascalia if i == 0 else None,
+                                parse_mode=parse_mode)
+                for i, file_id in enumerate(blocco)
+            ]
+            messaggi.extend(await outbox.invia(
+                chat_id, priorita, context.bot.send_media_group,
+                chat_id=chat_id, media=media_group, costo=len(media_group), **kwargs))
+    return messaggi
+
+
+def testo_moderazione(ad: PendingAd) -> str:
+    """Testo della scheda inviata ai moderatori (da leggere con `ad.testo(testo_moderazione)`)."""
+    return (
+        f"🚨 **NUOVO ANNUNCIO DA APPROVARE!** 🚨\n\n"
+        f"**Da Utente:** {mention_html(ad.user_id, ad.user_name)}\n\n"
+        f" **Articolo:** {ad.title}\n"
+        f" **Descrizione:** {ad.description}\n"
+        f" **Località:** {ad.location}\n"
+        f" **Prezzo:** {formatta_prezzo(ad.prezzo_centesimi)}\n\n"
+        f"Approvazione richiesta. Cosa vuoi fare?")
+
+
+def testo_pubblicazione(ad) -> str:
+    """Testo dell'annuncio pubblicato nel topic (Markdown), uguale anche nei risultati inline."""
+    # I testi dell'utente sono protetti: un _ o un * spaiato farebbe rifiutare il messaggio
+    return (f" **Articolo:** {escape_markdown(ad.title)}\n"
+            f" **Descrizione:** {escape_markdown(ad.description)}\n"
+            f" **Località:** {escape_markdown(ad.location)}\n"
+            f" **Prezzo:** {formatta_prezzo(ad.prezzo_centesimi)}\n\n"
+            f"Contatta l'utente per maggiori info!")
 
 
 async def conferma_annuncio(update: Update, context):
     if update.message.text.lower() == 'si':
-        await update.message.reply_text(
-            "Perfetto! Il tuo annuncio è stato ricevuto e sarà inviato agli amministratori per l'approvazione. Ti avviserò non appena sarà pubblicato. Grazie!",
-            reply_markup=ReplyKeyboardRemove())
-        photos = context.user_data.get('photos', [])
-        title = context.user_data.get('title', 'N/A')
-        description = context.user_data.get('description', 'N/A')
-        location = context.user_data.get('location', 'N/A')
-        price = context.user_data.get('price', 'N/A')
-        moderation_card_text = (
-            f"🚨 **NUOVO ANNUNCIO DA APPROVARE!** 🚨\n\n"
-            f"**Da Utente:** {update.effective_user.mention_html()}\n\n"
-            f" **Articolo:** {title}\n"
-            f" **Descrizione:** {description}\n"
-            f" **Località:** {location}\n"
-            f" **Prezzo:** €{price:.2f}\n\n"
-            f"Approvazione richiesta. Cosa vuoi fare?")
-        keyboard = [[
-            InlineKeyboardButton(
-                "✅ Approva",
-                callback_data=f"approve_{update.effective_user.id}"),
-            InlineKeyboardButton(
-                "❌ Rifiuta",
-                callback_data=f"reject_{update.effective_user.id}")
-        ]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        try:
-            if photos:
-                media_group = [
-                    InputMediaPhoto(
-                        media=file_id,
-                        caption=moderation_card_text if i == 0 else None,
-                        parse_mode='HTML') for i, file_id in enumerate(photos)
-                ]
-                sent_messages_moderation = await context.bot.send_media_group(
-                    chat_id=MODERATION_CHAT_ID, media=media_group)
-                moderation_message_id = sent_messages_moderation[0].message_id
-                await context.bot.edit_message_reply_markup(
-                    chat_id=MODERATION_CHAT_ID,
-                    message_id=moderation_message_id,
-                    reply_markup=reply_markup)
-            else:
-                sent_message_moderation = await context.bot.send_message(
-                    chat_id=MODERATION_CHAT_ID,
-                    text=moderation_card_text,
-                    parse_mode='HTML',
-                    reply_markup=reply_markup)
-                moderation_message_id = sent_message_moderation.message_id
-            context.bot_data[str(moderation_message_id)] = {
-                'photos': photos,
-                'title': title,
-                'description': description,
-                'location': location,
-                'price': price,
-                'original_user_id': update.effective_user.id,
-                'moderation_card_text': moderation_card_text
-            }
-        except Exception as e:
-            logger.error(f"Errore durante l'invio per moderazione: {e}")
-            await update.message.reply_text(
-                "Si è verificato un errore durante l'invio per moderazione. Riprova più tardi."
-            )
-        context.user_data.clear()
-        return ConversationHandler.END
+        async def avvisa(testo: str) -> None:
+            await update.message.reply_text(testo, reply_markup=ReplyKeyboardRemove())
+        return await invia_in_moderazione(update, context, avvisa, update.message.reply_text)
     elif update.message.text.lower() == 'no':
         await update.message.reply_text(
             "Ok, annuncio annullato. Puoi riavviare con /nuovo_annuncio.",
@@ -420,13 +896,545 @@ async def conferma_annuncio(update: Update, context):
     else:
         await update.message.reply_text("Per favora, rispondi 'Si' o 'No'.")
         return CONFERMA
+
+
+async def invia_in_moderazione(update: Update, context, avvisa, avvisa_errore):
+    """Invia la bozza confermata ai moderatori e chiude la conversazione.
+
+    `avvisa(testo)` comunica all'utente l'esito, `avvisa_errore(testo)` un invio
+    fallito: con il wizard a messaggi sono risposte, con la scheda modifiche della scheda.
+    """
+    # Se l'aggiornamento viene rielaborato dopo un errore, i passi già riusciti non si ripetono
+    passi = registro_aggiornamenti.passi(update.update_id)
+    # Le regole possono essere cambiate mentre l'utente compilava la bozza
+    violazioni = [v for campo in ('title', 'description', 'location')
+                  for v in filtro_contenuti.esamina(context.user_data.get(campo, ''))]
+    vietati = sorted({v.motivo for v in violazioni if v.azione == BLOCCA})
+    if vietati and 'conferma' not in passi:
+        logger.info(f"Annuncio dell'utente {update.effective_user.id} rifiutato dal filtro: {', '.join(vietati)}")
+        await avvisa(
+            f"❌ Il tuo annuncio non può essere inviato ai moderatori perché contiene {' e '.join(vietati)}. "
+            "Puoi crearne uno nuovo con /nuovo_annuncio.")
+        context.user_data.clear()
+        return ConversationHandler.END
+    await esegui_passo(
+        passi, 'conferma', avvisa,
+        "Perfetto! Il tuo annuncio è stato ricevuto e sarà inviato agli amministratori per l'approvazione. Ti avviserò non appena sarà pubblicato. Grazie!")
+    user = update.effective_user
+    photos = context.user_data.get('photos', [])
+    ad = PendingAd(
+        0, user.id, user.first_name, photos,
+        title=context.user_data.get('title', 'N/A'),
+        description=context.user_data.get('description', 'N/A'),
+        location=context.user_data.get('location', 'N/A'),
+        price=context.user_data.get('price'))
+    impronte_bozza = context.user_data.get('impronte', {})
+    segnalati = sorted({v.motivo for v in violazioni if v.azione == SEGNALA})
+    filtro = f"\n\n🚩 <b>Filtro contenuti:</b> contiene {html.escape(', '.join(segnalati))}" if segnalati else ""
+    # Gli hash ancora in calcolo non fanno aspettare l'utente: i loro duplicati arrivano dopo
+    gia_trovati = duplicati(impronte_bozza, user.id)
+    moderation_card_text = ad.testo(testo_moderazione) + gia_trovati + filtro
+    keyboard = [[
+        InlineKeyboardButton(
+            "✅ Approva",
+            callback_data=f"approve_{update.effective_user.id}"),
+        InlineKeyboardButton(
+            "❌ Rifiuta",
+            callback_data=f"reject_{update.effective_user.id}")
+    ]]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    try:
+        if photos:
+            sent_messages_moderation = await esegui_passo(
+                passi, 'scheda', invia_foto,
+                context, MODERATION_CHAT_ID, PRIORITA_MODERAZIONE, photos,
+                moderation_card_text, 'HTML')
+            moderation_message_id = sent_messages_moderation[0].message_id
+            await esegui_passo(
+                passi, 'pulsanti', outbox.invia,
+                MODERATION_CHAT_ID, PRIORITA_MODERAZIONE, context.bot.edit_message_reply_markup,
+                chat_id=MODERATION_CHAT_ID,
+                message_id=moderation_message_id,
+                reply_markup=reply_markup)
+        else:
+            sent_message_moderation = await esegui_passo(
+                passi, 'scheda', outbox.invia,
+                MODERATION_CHAT_ID, PRIORITA_MODERAZIONE, context.bot.send_message,
+                chat_id=MODERATION_CHAT_ID,
+                text=moderation_card_text,
+                parse_mode='HTML',
+                reply_markup=reply_markup)
+            moderation_message_id = sent_message_moderation.message_id
+        ad.message_id = moderation_message_id
+        moderazioni.aggiungi(ad)
+        impronte.aggiungi(Fingerprint(file_unique_id, hash, ad.message_id, ad.user_id)
+                          for file_unique_id, hash in impronte_bozza.items())
+        in_calcolo = [impronte_in_corso[f] for f in impronte_bozza if f in impronte_in_corso]
+        if in_calcolo:
+            context.application.create_task(completa_duplicati(
+                context, ad, impronte_bozza, in_calcolo, gia_trovati, filtro, reply_markup))
+    except Exception as e:
+        logger.error(f"Errore durante l'invio per moderazione: {e}")
+        await esegui_passo(
+            passi, 'avviso_errore', avvisa_errore,
+            "Si è verificato un errore durante l'invio per moderazione. Riprova più tardi.")
+        # La conversazione resta in attesa di conferma e l'aggiornamento risulta fallito:
+        # un nuovo tentativo riparte dai passi che mancano
+        raise
+    context.user_data.clear()
+    return ConversationHandler.END
+# 🟧  ▓▓▓▒▒▒░░░ 
+
+
+# 🟦 ▓▓▓▒▒▒░░░ /nuovo_annuncio > scheda della bozza (WIZARD_MODE=scheda)
+# Campi di testo della scheda, per passo: campo della bozza, nome, richiesta
+CAMPI_SCHEDA = {
+    TITOLO: ('title', "Titolo", "Scrivi il <b>titolo</b> del tuo annuncio."),
+    DESCRIZIONE: ('description', "Descrizione", "Scrivi la <b>descrizione</b> del tuo annuncio."),
+    LOCALITA: ('location', "Località", "Indica la <b>località</b> (es. Roma, Milano)."),
+    PREZZO: ('price', "Prezzo", "Invia il <b>prezzo</b> del tuo articolo (solo il numero, es. 25.50)."),
+}
+RICHIESTA_FOTO = (
+    "Allega una o più foto del tuo articolo, poi scrivi il titolo.\n"
+    "<i>💡 Usa sfondi neutri, una foto che mostri tutti gli oggetti e foto di dettaglio per lo stato.</i>")
+RICHIESTA_CONFERMA = "Controlla l'annuncio: puoi correggere ogni campo oppure inviarlo ai moderatori."
+PATTERN_BOZZA = r'^bozza_(continua|invia|annulla|foto|modifica_(title|description|location|price))$'
+# Aggiornamenti della scheda rimandati dopo l'ultima foto: chat_id -> task
+schede_in_attesa: dict[int, asyncio.Task] = {}
+
+
+def prossimo_passo(dati: dict) -> int:
+    """Primo passo della bozza ancora da compilare, CONFERMA se è completa."""
+    if not dati.get('photos'):
+        return FOTO
+    for stato, (campo, _, _) in CAMPI_SCHEDA.items():
+        if campo not in dati:
+            return stato
+    return CONFERMA
+
+
+def testo_scheda(dati: dict, passo: int, nota: Optional[str] = None) -> str:
+    righe = ["📝 <b>Il tuo annuncio</b>", "", f"<b>Foto:</b> {len(dati.get('photos', []))}"]
+    for campo, nome, _ in CAMPI_SCHEDA.values():
+        valore = dati.get(campo)
+        if valore is None:
+            valore = "—"
+        elif campo == 'price':
+            valore = formatta_prezzo(in_centesimi(valore))
+        else:
+            valore = html.escape(valore)
+        righe.append(f"<b>{nome}:</b> {valore}")
+    if passo == FOTO:
+        richiesta = RICHIESTA_FOTO
+    elif passo == CONFERMA:
+        richiesta = RICHIESTA_CONFERMA
+    else:
+        campo, nome, richiesta = CAMPI_SCHEDA[passo]
+        if campo in dati:
+            richiesta = f"Invia il nuovo valore del campo <b>{nome}</b>."
+    righe += ["", f"👉 {richiesta}"]
+    if nota:
+        righe += ["", html.escape(nota)]
+    return "\n".join(righe)
+
+
+def tastiera_scheda(dati: dict, passo: int) -> InlineKeyboardMarkup:
+    righe = []
+    if passo == CONFERMA:
+        pulsanti = [InlineKeyboardButton(f"✏️ {nome}", callback_data=f"bozza_modifica_{campo}")
+                    for campo, nome, _ in CAMPI_SCHEDA.values()]
+        righe += [[InlineKeyboardButton("✅ Invia ai moderatori", callback_data='bozza_invia')],
+                  pulsanti[:2], pulsanti[2:],
+                  [InlineKeyboardButton("📷 Rifai le foto", callback_data='bozza_foto')]]
+    elif prossimo_passo(dati) != passo:
+        # Foto già caricate o campo in correzione: si può andare avanti senza scrivere
+        righe.append([InlineKeyboardButton("✅ Continua", callback_data='bozza_continua')])
+    righe.append([InlineKeyboardButton("❌ Annulla", callback_data='bozza_annulla')])
+    return InlineKeyboardMarkup(righe)
+
+
+async def mostra_bozza(context, chat_id: int, passo: int, nota: Optional[str] = None) -> int:
+    """Porta la scheda della bozza sul passo indicato e lo restituisce, come nuovo stato.
+
+    La scheda viene modificata; se non esiste o non è più modificabile se ne invia una nuova.
+    """
+    dati = context.user_data
+    dati['passo'] = passo
+    testo = testo_scheda(dati, passo, nota)
+    tastiera = tastiera_scheda(dati, passo)
+    message_id = dati.get('scheda_bozza')
+    if message_id is not None:
+        try:
+            await context.bot.edit_message_text(
+                testo, chat_id=chat_id, message_id=message_id, parse_mode='HTML', reply_markup=tastiera)
+            return passo
+        except BadRequest as e:
+            if 'not modified' in str(e).lower():
+                return passo
+            logger.info(f"Scheda della bozza {message_id} non modificabile ({e}): ne invio una nuova")
+    messaggio = await context.bot.send_message(chat_id, testo, parse_mode='HTML', reply_markup=tastiera)
+    dati['scheda_bozza'] = messaggio.message_id
+    return passo
+
+
+def annulla_bozza_in_attesa(chat_id: int) -> None:
+    task = schede_in_attesa.pop(chat_id, None)
+    if task is not None:
+        task.cancel()
+
+
+async def mostra_bozza_ritardata(context, chat_id: int) -> None:
+    """Aggiorna la scheda una sola volta per una serie di foto, dopo ALBUM_DEBOUNCE secondi di pausa."""
+    await asyncio.sleep(ALBUM_DEBOUNCE)
+    schede_in_attesa.pop(chat_id, None)
+    nota = None
+    if len(context.user_data.get('photos', [])) >= DRAFT_MAX_PHOTOS:
+        nota = f"⚠️ Hai raggiunto il massimo di {DRAFT_MAX_PHOTOS} foto: le altre non verranno aggiunte."
+    try:
+        await mostra_bozza(context, chat_id, FOTO, nota)
+    except Exception as e:
+        logger.error(f"Impossibile aggiornare la scheda della bozza di {chat_id}: {e}")
+
+
+def ricevi_foto_scheda(update: Update, context, photos: list, ripetuto: bool) -> int:
+    """Foto con la scheda: nessuna risposta, la scheda mostra il conteggio dopo l'ultima foto."""
+    if len(photos) < DRAFT_MAX_PHOTOS and not ripetuto:
+        photos.append(update.message.photo[-1].file_id)
+        avvia_impronta(context, update.message.photo, context.user_data.setdefault('impronte', {}))
+    chat_id = update.effective_chat.id
+    annulla_bozza_in_attesa(chat_id)
+    schede_in_attesa[chat_id] = asyncio.create_task(mostra_bozza_ritardata(context, chat_id))
+    return FOTO
+
+
+async def scrivi_campo(update: Update, context):
+    """Testo inviato con la scheda aperta: è il valore del campo che la scheda sta chiedendo."""
+    dati = context.user_data
+    chat_id = update.effective_chat.id
+    annulla_bozza_in_attesa(chat_id)
+    passo = dati.get('passo', prossimo_passo(dati))
+    if passo == FOTO:
+        if not dati.get('photos'):
+            return await mostra_bozza(context, chat_id, FOTO, "⚠️ Per favore, invia prima almeno una foto.")
+        if 'title' in dati:
+            return await mostra_bozza(context, chat_id, FOTO, "⚠️ Invia altre foto oppure premi ✅ Continua.")
+        # Dopo le foto il primo testo è il titolo, senza bisogno di premere Continua
+        passo = TITOLO
+    if passo == CONFERMA:
+        return await mostra_bozza(
+            context, chat_id, CONFERMA, "⚠️ Usa i pulsanti della scheda per correggere o inviare l'annuncio.")
+    campo, nome, _ = CAMPI_SCHEDA[passo]
+    testo = update.message.text
+    if campo == 'price':
+        centesimi = in_centesimi(testo)
+        if centesimi is None:
+            return await mostra_bozza(
+                context, chat_id, passo, "⚠️ Formato prezzo non valido: inserisci solo un numero (es. 25 o 25.50).")
+        dati['price'] = centesimi / 100
+    else:
+        errore = errore_campo(testo, campo, nome, update.effective_user.id)
+        if errore:
+            return await mostra_bozza(context, chat_id, passo, f"⚠️ {errore}")
+        dati[campo] = testo
+    dati['bozza_il'] = time.time()
+    logger.info("Campo della bozza ricevuto", extra={'evento': 'campo_ricevuto', 'campo': campo,
+                                                     'testo': dati[campo]})
+    return await mostra_bozza(context, chat_id, prossimo_passo(dati))
+
+
+async def pulsante_bozza(update: Update, context):
+    """Pulsanti della scheda: continua, correggi un campo, rifai le foto, invia o annulla."""
+    query = update.callback_query
+    dati = context.user_data
+    if query.message is None or query.message.message_id != dati.get('scheda_bozza'):
+        await query.answer("Questa scheda non è più attiva.", show_alert=True)
+        return None
+    chat_id = query.message.chat_id
+    azione = query.data.removeprefix('bozza_')
+    annulla_bozza_in_attesa(chat_id)
+    passi = registro_aggiornamenti.passi(update.update_id)
+    await esegui_passo(passi, 'risposta', query.answer)
+    dati['bozza_il'] = time.time()
+    if azione == 'annulla':
+        await query.edit_message_text("Ok, annuncio annullato. Puoi riavviare con /nuovo_annuncio.")
+        dati.clear()
+        return ConversationHandler.END
+    if azione == 'invia' and prossimo_passo(dati) == CONFERMA:
+        async def avvisa(testo: str) -> None:
+            await query.edit_message_text(testo)
+
+        async def avvisa_errore(testo: str) -> None:
+            await mostra_bozza(context, chat_id, CONFERMA, f"⚠️ {testo}")
+        return await invia_in_moderazione(update, context, avvisa, avvisa_errore)
+    if azione == 'foto':
+        dati['photos'] = []
+        dati['impronte'] = {}
+        return await mostra_bozza(context, chat_id, FOTO)
+    if azione.startswith('modifica_'):
+        campo = azione.removeprefix('modifica_')
+        return await mostra_bozza(context, chat_id, next(
+            stato for stato, (c, _, _) in CAMPI_SCHEDA.items() if c == campo))
+    return await mostra_bozza(context, chat_id, prossimo_passo(dati))
+
+
+async def bozza_non_attiva(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pulsanti di una scheda la cui conversazione è già finita (annullata, scaduta o inviata)."""
+    await update.callback_query.answer(
+        "Questa scheda non è più attiva. Puoi creare un nuovo annuncio con /nuovo_annuncio.", show_alert=True)
 # 🟧  ▓▓▓▒▒▒░░░ 
 
 
+# 🟦 ▓▓▓▒▒▒░░░ /nuovo_annuncio > bozze scadute e /riprendi
+# Passi del wizard dopo le foto: campo della bozza, stato, domanda da ripetere
+PASSI_BOZZA = (
+    ('description', DESCRIZIONE, "Ora, per favore, invia la **descrizione** del tuo annuncio."),
+    ('location', LOCALITA, "Ora, per favore, indica la **località** (es. Roma, Milano)."),
+    ('price', PREZZO, "Infine, per favore, invia il **prezzo** del tuo articolo (solo il numero, es. 25.50)."),
+)
+
+
+def archivia_bozza(dati: dict, adesso: float) -> bool:
+    """Sposta la bozza in corso in `bozza_scaduta`, da dove /riprendi può recuperarla.
+
+    Le bozze ancora vuote (nessuna foto e nessun testo) vengono solo eliminate.
+    """
+    bozza = {campo: dati.pop(campo) for campo in CAMPI_BOZZA if campo in dati}
+    bozza.pop('bozza_il', None)
+    if not (bozza.get('photos') or 'title' in bozza):
+        return False
+    dati['bozza_scaduta'] = {'dati': bozza, 'scaduta_il': adesso}
+    return True
+
+
+def testo_scadenza(archiviata: bool) -> str:
+    if archiviata:
+        return ("⌛ La bozza del tuo annuncio è scaduta per inattività. Puoi riprenderla da dove eri "
+                f"rimasto con /riprendi entro {DRAFT_RESUME_GRACE / 3600:g} ore, oppure ricominciare "
+                "con /nuovo_annuncio.")
+    return "⌛ La creazione dell'annuncio è scaduta per inattività. Puoi ricominciare con /nuovo_annuncio."
+
+
+def richiede_bozza(callback):
+    """Avvolge un passo della bozza: se la bozza non c'è più la conversazione si chiude.
+
+    Succede quando pulizia_bozze archivia una bozza rimasta ferma oltre un riavvio:
+    user_data viene svuotato, ma lo stato della conversazione resta nella persistenza.
+    """
+    @wraps(callback)
+    async def con_bozza(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if 'bozza_il' in context.user_data:
+            return await callback(update, context)
+        logger.info(f"Utente {update.effective_user.id} in un passo della bozza senza bozza: conversazione chiusa")
+        if update.callback_query is not None:
+            await update.callback_query.answer()
+        await update.effective_message.reply_text(
+            testo_scadenza('bozza_scaduta' in context.user_data), reply_markup=ReplyKeyboardRemove())
+        return ConversationHandler.END
+    return con_bozza
+
+
+async def bozza_scaduta(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Chiamata dal ConversationHandler quando l'utente non risponde per DRAFT_TIMEOUT secondi."""
+    user_id = update.effective_user.id
+    annulla_conferme_album(update.effective_chat.id)
+    annulla_bozza_in_attesa(update.effective_chat.id)
+    scheda = context.user_data.get('scheda_bozza')
+    testo = testo_scadenza(archivia_bozza(context.user_data, time.time()))
+    logger.info(f"Bozza dell'utente {user_id} scaduta per inattività")
+    try:
+        if scheda is not None:
+            # L'avviso prende il posto della scheda della bozza
+            await outbox.invia(
+                user_id, PRIORITA_UTENTE, context.bot.edit_message_text,
+                testo, chat_id=user_id, message_id=scheda)
+        else:
+            await outbox.invia(
+                user_id, PRIORITA_UTENTE, context.bot.send_message,
+                user_id, testo, reply_markup=ReplyKeyboardRemove())
+    except Exception as e:
+        logger.error(f"Impossibile avvisare l'utente {user_id} della bozza scaduta: {e}")
+
+
+async def riprendi(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Riprende una bozza scaduta dal passo in cui era stata lasciata.
+
+    Con una bozza ancora in corso ripete la domanda del passo a cui è arrivata.
+    """
+    if 'bozza_il' in context.user_data:
+        dati = dict(context.user_data)
+    else:
+        scaduta = context.user_data.pop('bozza_scaduta', None)
+        if scaduta is None or time.time() - scaduta['scaduta_il'] > DRAFT_RESUME_GRACE:
+            await update.message.reply_text(
+                "Non hai bozze da riprendere. Puoi creare un nuovo annuncio con /nuovo_annuncio.")
+            return ConversationHandler.END
+        dati = scaduta['dati']
+        context.user_data.update(dati)
+    context.user_data.setdefault('photos', [])
+    context.user_data['bozza_il'] = time.time()
+    if WIZARD_MODE == 'scheda':
+        # La vecchia scheda è ormai lontana nella chat: se ne invia una nuova
+        context.user_data.pop('scheda_bozza', None)
+        return await mostra_bozza(context, update.effective_chat.id, prossimo_passo(context.user_data),
+                                  "👋 Bentornato! Riprendi da dove eri rimasto.")
+    if 'title' not in dati:
+        photos = context.user_data['photos']
+        if photos:
+            await conferma_foto(update.message, f"Bentornato! Hai già caricato {len(photos)} foto.")
+        else:
+            await update.message.reply_text(TESTO_FOTO, parse_mode='HTML')
+        return FOTO
+    for campo, stato, domanda in PASSI_BOZZA:
+        if campo not in dati:
+            await update.message.reply_text(f"Bentornato! {domanda}")
+            return stato
+    await update.message.reply_text(riepilogo_bozza(context.user_data), parse_mode='Markdown')
+    return CONFERMA
+
+
+def dimensione(oggetto) -> int:
+    """Stima dei byte occupati da un oggetto e da quello che contiene (dict, liste, stringhe…)."""
+    totale = sys.getsizeof(oggetto)
+    if isinstance(oggetto, dict):
+        totale += sum(dimensione(chiave) + dimensione(valore) for chiave, valore in oggetto.items())
+    elif isinstance(oggetto, (list, tuple, set, frozenset)):
+        totale += sum(dimensione(valore) for valore in oggetto)
+    return totale
+
+
+def limita_bozza(dati: dict) -> None:
+    """Applica i limiti di foto e di lunghezza dei testi, anche alle bozze salvate prima dei limiti."""
+    photos = dati.get('photos')
+    if photos and len(photos) > DRAFT_MAX_PHOTOS:
+        del photos[DRAFT_MAX_PHOTOS:]
+    for campo, massimo in MAX_LUNGHEZZA.items():
+        testo = dati.get(campo)
+        if isinstance(testo, str) and len(testo) > massimo:
+            dati[campo] = testo[:massimo]
+
+
+async def pulizia_bozze(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Libera user_data e chat_data da bozze abbandonate, bozze non riprese e vecchie liste /coda.
+
+    I timeout delle conversazioni non sopravvivono a un riavvio: le bozze ferme da
+    più del doppio di DRAFT_TIMEOUT vengono archiviate qui, e la conversazione
+    persistita si chiude al messaggio successivo (richiede_bozza). Le voci rimaste vuote
+    vengono eliminate anche dalla persistenza.
+    """
+    application = context.application
+    adesso = time.time()
+    attive = in_grazia = eliminate = liberati = 0
+    for user_id, dati in list(application.user_data.items()):
+        prima = dimensione(dati)
+        if 'bozza_il' in dati and adesso - dati['bozza_il'] > 2 * DRAFT_TIMEOUT:
+            if not archivia_bozza(dati, adesso):
+                eliminate += 1
+        scaduta = dati.get('bozza_scaduta')
+        if scaduta is not None and adesso - scaduta['scaduta_il'] > DRAFT_RESUME_GRACE:
+            del dati['bozza_scaduta']
+            eliminate += 1
+        limita_bozza(dati)
+        if 'bozza_scaduta' in dati:
+            limita_bozza(dati['bozza_scaduta']['dati'])
+            in_grazia += 1
+        if 'bozza_il' in dati:
+            attive += 1
+        if dati:
+            liberati += prima - dimensione(dati)
+        else:
+            application.drop_user_data(user_id)
+            liberati += prima
+    for chat_id, dati in list(application.chat_data.items()):
+        prima = dimensione(dati)
+        code = dati.get('code')
+        if code is not None:
+            for message_id in [m for m, stato in code.items()
+                               if not stato.get('in_corso') and adesso - stato.get('aperta_il', 0) > CODA_SCADENZA]:
+                del code[message_id]
+            if not code:
+                del dati['code']
+        if dati:
+            liberati += prima - dimensione(dati)
+        else:
+            application.drop_chat_data(chat_id)
+            liberati += prima
+    statistiche_bozze['attive'] = attive
+    statistiche_bozze['in_grazia'] = in_grazia
+    statistiche_bozze['eliminate'] += eliminate
+    statistiche_bozze['byte_liberati'] += liberati
+    logger.info(
+        f"Pulizia bozze: {attive} in corso, {in_grazia} riprendibili con /riprendi, "
+        f"{eliminate} eliminate, {liberati / 1024:.1f} KB liberati")
+# 🟧  ▓▓▓▒▒▒░░░ 
+
+
+
+async def ricarica_regole(context: ContextTypes.DEFAULT_TYPE) -> None:
+    filtro_contenuti.ricarica()
+
+
+def duplicati(impronte_bozza: dict, user_id: int, escludi: Optional[int] = None) -> str:
+    """Righe da aggiungere alla scheda di moderazione se le foto sono già comparse in altri annunci.
+
+    Usa solo gli hash già calcolati; `escludi` è la scheda dell'annuncio stesso, già registrata.
+    """
+    trovate: dict[int, tuple[str, Fingerprint]] = {}
+    for file_unique_id, hash in impronte_bozza.items():
+        uguale = impronte.per_file(file_unique_id)
+        if uguale is not None and uguale.message_id != escludi:
+            trovate.setdefault(uguale.message_id, ("identica", uguale))
+        if hash is not None:
+            for distanza, simile in impronte.simili(hash):
+                if simile.message_id != escludi:
+                    trovate.setdefault(simile.message_id, (f"simile ({distanza} bit diversi su 64)", simile))
+    if not trovate:
+        return ""
+    righe = ["", "", "⚠️ <b>Foto già inviate in altri annunci:</b>"]
+    for tipo, impronta in sorted(trovate.values(), key=lambda voce: -voce[1].aggiunta_il)[:MAX_DUPLICATI]:
+        chi = "stesso utente" if impronta.user_id == user_id else "altro utente"
+        quando = datetime.fromtimestamp(impronta.aggiunta_il).strftime('%d/%m %H:%M')
+        righe.append(f"• foto {tipo}: <a href=\"{link_moderazione(impronta.message_id)}\">"
+                     f"scheda del {quando}</a> ({chi})")
+    if len(trovate) > MAX_DUPLICATI:
+        righe.append(f"… e altri {len(trovate) - MAX_DUPLICATI} annunci")
+    logger.info(f"Foto dell'utente {user_id} già inviate in {len(trovate)} annunci")
+    return "\n".join(righe)
+
+
+async def completa_duplicati(context, ad: PendingAd, impronte_bozza: dict, in_calcolo: list,
+                             gia_trovati: str, filtro: str, reply_markup) -> None:
+    """Attende gli hash rimasti in calcolo all'invio della scheda e vi aggiunge i duplicati trovati.
+
+    Gli hash finiti vengono registrati nell'indice. La scheda si modifica solo se
+    l'annuncio è ancora in attesa di una decisione; una decisione arrivata nel
+    frattempo aspetta la modifica, così il suo testo resta l'ultimo.
+    """
+    in_attesa = [f for f in impronte_bozza if f in impronte_in_corso]
+    await asyncio.wait(in_calcolo, timeout=FINGERPRINT_WAIT)
+    trovati = duplicati(impronte_bozza, ad.user_id, escludi=ad.message_id)
+    impronte.aggiungi(Fingerprint(f, impronte_bozza[f], ad.message_id, ad.user_id)
+                      for f in in_attesa if impronte_bozza.get(f) is not None)
+    if trovati == gia_trovati or ad.message_id not in moderazioni or moderazioni.gestito_da(ad.message_id):
+        return
+    modifica = asyncio.create_task(aggiorna_scheda(
+        context, ad, ad.testo(testo_moderazione) + trovati + filtro, reply_markup))
+    duplicati_in_modifica[ad.message_id] = modifica
+    try:
+        await modifica
+    except Exception as e:
+        logger.error(f"Impossibile aggiungere i duplicati alla scheda {ad.message_id}: {e}")
+    finally:
+        duplicati_in_modifica.pop(ad.message_id, None)
+
+
+def link_moderazione(message_id: int) -> str:
+    """Link a un messaggio della chat dei moderatori (supergruppo)."""
+    return f"https://t.me/c/{str(MODERATION_CHAT_ID).removeprefix('-100')}/{message_id}"
+
 
 async def cancel(update: Update, context):
     user = update.effective_user
-    logger.info(f"Utente {user.first_name} ha annullato la conversazione.")
+    logger.info(f"Utente {user.id} ha annullato la conversazione.")
     await update.message.reply_text(
         'Operazione annullata. Puoi riavviare con /nuovo_annuncio.',
         reply_markup=ReplyKeyboardRemove())
@@ -436,77 +1444,529 @@ async def cancel(update: Update, context):
 
 async def button_callback(update: Update, context):
     query = update.callback_query
-    await query.answer()
+    passi = registro_aggiornamenti.passi(update.update_id)
     moderation_message_id = query.message.message_id
-    ad_data = context.bot_data.get(str(moderation_message_id))
-    if not ad_data:
-        await query.edit_message_text(
-            "Errore: Dati dell'annuncio non trovati o già elaborati.",
-            reply_markup=None)
+    moderatore = query.from_user.first_name
+    approva = query.data.startswith('approve_')
+    # In un nuovo tentativo l'annuncio è già stato rivendicato e tolto dallo store:
+    # si usa quello letto allora
+    ad = passi.get('annuncio')
+    if ad is None:
+        ad = moderazioni.get(moderation_message_id)
+        if not moderazioni.rivendica(moderation_message_id, moderatore):
+            gestore = moderazioni.gestito_da(moderation_message_id)
+            if gestore:
+                # Clic concorrente o in ritardo: basta la risposta alla callback
+                await query.answer(f"Annuncio già gestito da {gestore}.", show_alert=True)
+                return
+            await query.answer()
+            await query.edit_message_text(
+                "Errore: Dati dell'annuncio non trovati o già elaborati.",
+                reply_markup=None)
+            return
+    try:
+        await esegui_passo(passi, 'risposta', query.answer)
+    except BaseException:
+        # Nessuna decisione presa: l'annuncio torna disponibile
+        if 'annuncio' not in passi:
+            moderazioni.rilascia(moderation_message_id)
+        raise
+    errori = await chiudi_moderazione(context, ad, approva, moderatore, passi)
+    if errori:
+        # L'aggiornamento risulta fallito: il nuovo tentativo ripete solo i passi mancanti
+        raise errori[0]
+
+
+async def pubblica_annuncio(context, ad: PendingAd):
+    """Pubblica l'annuncio nel topic del gruppo e restituisce il messaggio (o l'album) inviato."""
+    card_text = ad.testo(testo_pubblicazione)
+    if ad.photos:
+        return await invia_foto(
+            context, GROUP_CHAT_ID, PRIORITA_PUBBLICAZIONE, ad.photos,
+            card_text, 'Markdown',
+            message_thread_id=TOPIC_MESSAGE_THREAD_ID)
+    return await outbox.invia(
+        GROUP_CHAT_ID, PRIORITA_PUBBLICAZIONE, context.bot.send_message,
+        chat_id=GROUP_CHAT_ID,
+        text=card_text,
+        parse_mode='Markdown',
+        message_thread_id=TOPIC_MESSAGE_THREAD_ID)
+
+
+def quando(istante: float) -> str:
+    """Orario di pubblicazione previsto, in forma leggibile per gli utenti."""
+    if istante - time.time() < 60:
+        return "a breve"
+    momento = datetime.fromtimestamp(istante, pubblicazioni.fuso_orario)
+    oggi = datetime.now(pubblicazioni.fuso_orario).date()
+    if momento.date() == oggi:
+        return f"alle {momento:%H:%M}"
+    if momento.date() == oggi + timedelta(days=1):
+        return f"domani alle {momento:%H:%M}"
+    return f"il {momento:%d/%m} alle {momento:%H:%M}"
+
+
+async def rilascia_pubblicazioni(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Pubblica l'annuncio in testa alla coda quando arriva il suo turno."""
+    if rilascio_in_corso.locked():
         return
-    action = query.data.split('_')[0]
-    original_user_id = ad_data.get('original_user_id')
-    original_moderation_text = ad_data.get('moderation_card_text',
-                                           "Testo originale non disponibile.")
-    card_text = (f" **Articolo:** {ad_data['title']}\n"
-                 f" **Descrizione:** {ad_data['description']}\n"
-                 f" **Località:** {ad_data['location']}\n"
-                 f" **Prezzo:** €{ad_data['price']:.2f}\n\n"
-                 f"Contatta l'utente per maggiori info!")
-    if action == 'approve':
+    async with rilascio_in_corso:
+        ad = pubblicazioni.prossima()
+        if ad is None:
+            return
+        ritardo = pubblicazioni.statistiche()['ritardo']
+        if ritardo > pubblicazioni.intervallo:
+            logger.warning(f"Pubblicazione dell'annuncio {ad.message_id} in ritardo di {ritardo:.0f}s")
+        # Segnato prima dell'invio: se il processo si ferma prima della conferma,
+        # al riavvio l'annuncio viene sospeso invece di uscire due volte
+        await pubblicazioni.in_invio(ad.message_id)
         try:
-            if ad_data['photos']:
-                media_group = [
-                    InputMediaPhoto(media=file_id,
-                                    caption=card_text if i == 0 else None,
-                                    parse_mode='Markdown')
-                    for i, file_id in enumerate(ad_data['photos'])
-                ]
-                await context.bot.send_media_group(
-                    chat_id=GROUP_CHAT_ID,
-                    media=media_group,
-                    message_thread_id=TOPIC_MESSAGE_THREAD_ID)
-            else:
-                await context.bot.send_message(
-                    chat_id=GROUP_CHAT_ID,
-                    text=card_text,
-                    parse_mode='Markdown',
-                    message_thread_id=TOPIC_MESSAGE_THREAD_ID)
-            if original_user_id:
-                await context.bot.send_message(
-                    original_user_id,
-                    "✅ Il tuo annuncio è stato approvato e pubblicato!")
-            if query.message.photo:
-                await query.edit_message_caption(
-                    caption=
-                    f"✅ Annuncio Approvato da {query.from_user.first_name}\n\n{original_moderation_text}",
-                    parse_mode='HTML',
-                    reply_markup=None)
-            else:
-                await query.edit_message_text(
-                    f"✅ Annuncio Approvato da {query.from_user.first_name}\n\n{original_moderation_text}",
-                    parse_mode='HTML',
-                    reply_markup=None)
+            pubblicato = await pubblica_annuncio(context, ad)
         except Exception as e:
-            logger.error(f"Errore durante l'approvazione e pubblicazione: {e}")
-    elif action == 'reject':
-        if query.message.photo:
-            await query.edit_message_caption(
-                caption=
-                f"❌ Annuncio Rifiutato da {query.from_user.first_name}\n\n{original_moderation_text}",
-                parse_mode='HTML',
-                reply_markup=None)
+            tentativi = pubblicazioni.fallita(ad.message_id)
+            logger.error(f"Errore durante la pubblicazione dell'annuncio {ad.message_id} "
+                         f"(tentativo {tentativi}): {e}")
+            if isinstance(e, TimedOut):
+                # Il messaggio potrebbe essere uscito comunque: nessun nuovo tentativo automatico
+                motivo = f"esito incerto ({e}): verificare se l'annuncio è già nel topic"
+            elif isinstance(e, BadRequest) or tentativi >= PUBLISH_MAX_ATTEMPTS:
+                motivo = f"non riuscita dopo {tentativi} tentativi ({e})"
+            else:
+                return
+            pubblicazioni.sospendi(ad.message_id, motivo)
+            await avvisa_sospensione(context.bot, ad, motivo)
+            return
+        pubblicazioni.pubblicata(ad.message_id)
+        catalogo.aggiungi(CatalogAd(
+            ad.message_id, ad.user_id, ad.user_name, ad.title, ad.description,
+            ad.location, ad.prezzo_centesimi, ad.photos[0] if ad.photos else None))
+        accoda_avvisi(context, ad, pubblicato)
+
+
+async def avvisa_sospensione(bot, ad: PendingAd, motivo: str) -> None:
+    """Chiede ai moderatori di riprovare o scartare una pubblicazione sospesa e avvisa l'autore."""
+    tastiera = InlineKeyboardMarkup([[
+        InlineKeyboardButton("🔁 Riprova", callback_data=f"pubblicazione_riprova_{ad.message_id}"),
+        InlineKeyboardButton("🗑 Scarta", callback_data=f"pubblicazione_scarta_{ad.message_id}"),
+    ]])
+    invii = (
+        outbox.invia(
+            MODERATION_CHAT_ID, PRIORITA_MODERAZIONE, bot.send_message,
+            chat_id=MODERATION_CHAT_ID,
+            text=f"⚠️ Pubblicazione sospesa: {motivo}. Le altre pubblicazioni proseguono.",
+            reply_to_message_id=ad.message_id, allow_sending_without_reply=True,
+            reply_markup=tastiera),
+        outbox.invia(
+            ad.user_id, PRIORITA_UTENTE, bot.send_message,
+            chat_id=ad.user_id,
+            text="⚠️ Il tuo annuncio approvato non è stato ancora pubblicato per un problema tecnico: "
+                 "i moderatori lo stanno verificando."),
+    )
+    for esito in await asyncio.gather(*invii, return_exceptions=True):
+        if isinstance(esito, Exception):
+            logger.error(f"Avviso della pubblicazione sospesa {ad.message_id} non inviato: {esito}")
+
+
+async def avvisa_interrotte(bot) -> None:
+    """All'avvio segnala le pubblicazioni rimaste a metà dell'invio, ora sospese."""
+    for ad in pubblicazioni.interrotte:
+        await avvisa_sospensione(bot, ad, INTERROTTA)
+    pubblicazioni.interrotte = []
+
+
+async def pubblicazione_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Pulsanti dell'avviso di pubblicazione sospesa: la rimette in coda o la scarta."""
+    query = update.callback_query
+    if query.message.chat.id != MODERATION_CHAT_ID:
+        await query.answer()
+        return
+    azione, _, message_id = query.data[len('pubblicazione_'):].partition('_')
+    message_id = int(message_id)
+    moderatore = query.from_user.first_name
+    if azione == 'riprova':
+        previsto = pubblicazioni.riprova(message_id)
+        if previsto is None:
+            await query.answer("Pubblicazione già ripresa o scartata.", show_alert=True)
+            return
+        await query.answer()
+        await query.edit_message_text(f"🔁 Pubblicazione ripresa da {moderatore}: uscirà {quando(previsto)}.")
+        if pubblicazioni.prossima() is not None:
+            context.job_queue.run_once(rilascia_pubblicazioni, 0)
+        return
+    ad = pubblicazioni.scarta(message_id)
+    if ad is None:
+        await query.answer("Pubblicazione già ripresa o scartata.", show_alert=True)
+        return
+    await query.answer()
+    await query.edit_message_text(f"🗑 Pubblicazione scartata da {moderatore}.")
+    await outbox.invia(
+        ad.user_id, PRIORITA_UTENTE, context.bot.send_message,
+        chat_id=ad.user_id,
+        text="❌ Purtroppo il tuo annuncio non può essere pubblicato. "
+             "Puoi inviarne uno nuovo con /nuovo_annuncio.")
+
+
+async def chiudi_moderazione(context, ad: PendingAd, approvato: bool, moderatore: str,
+                             passi: dict) -> list[Exception]:
+    """Registra la decisione su un annuncio rivendicato, aggiorna la scheda e avvisa l'utente.
+
+    Restituisce gli errori degli invii successivi alla decisione, già registrati nel log.
+    """
+    passi['annuncio'] = ad
+    moderazioni.rimuovi(ad.message_id)
+    modifica = duplicati_in_modifica.get(ad.message_id)
+    if modifica is not None:
+        # La scheda con la decisione deve arrivare dopo l'aggiunta dei duplicati già partita
+        await asyncio.wait([modifica])
+    if approvato:
+        if 'previsto' not in passi:
+            passi['previsto'] = pubblicazioni.accoda(ad)
+            if pubblicazioni.prossima() is not None:
+                # Coda libera: si pubblica subito senza aspettare il prossimo giro del job
+                context.job_queue.run_once(rilascia_pubblicazioni, 0)
+        previsto = quando(passi['previsto'])
+        esito = f"✅ Annuncio Approvato da {moderatore} (pubblicazione {previsto})"
+        notifica = f"✅ Il tuo annuncio è stato approvato! Sarà pubblicato nel gruppo {previsto}."
+    else:
+        esito = f"❌ Annuncio Rifiutato da {moderatore}"
+        notifica = "❌ Il tuo annuncio è stato rifiutato dagli amministratori."
+
+    # Scheda e notifica partono insieme: lo scheduler fa uscire prima la scheda
+    risultati = await asyncio.gather(
+        esegui_passo(passi, 'scheda', aggiorna_scheda,
+                     context, ad, f"{esito}\n\n{ad.testo(testo_moderazione)}"),
+        esegui_passo(passi, 'notifica', outbox.invia,
+                     ad.user_id, PRIORITA_UTENTE, context.bot.send_message,
+                     ad.user_id, notifica),
+        return_exceptions=True)
+    errori = [r for r in risultati if isinstance(r, Exception)]
+    for errore in errori:
+        logger.error(f"Errore dopo la decisione sull'annuncio {ad.message_id}: {errore}")
+    return errori
+
+
+async def aggiorna_scheda(context, ad: PendingAd, testo: str, reply_markup=None) -> None:
+    """Sostituisce il testo della scheda di moderazione; senza `reply_markup` ne rimuove i pulsanti."""
+    if ad.photos:
+        # Scheda con foto: il testo è la didascalia della (prima) foto
+        await outbox.invia(
+            MODERATION_CHAT_ID, PRIORITA_MODERAZIONE, context.bot.edit_message_caption,
+            chat_id=MODERATION_CHAT_ID,
+            message_id=ad.message_id,
+            caption=testo,
+            parse_mode='HTML',
+            reply_markup=reply_markup)
+    else:
+        await outbox.invia(
+            MODERATION_CHAT_ID, PRIORITA_MODERAZIONE, context.bot.edit_message_text,
+            chat_id=MODERATION_CHAT_ID,
+            message_id=ad.message_id,
+            text=testo,
+            parse_mode='HTML',
+            reply_markup=reply_markup)
+
+
+async def ricerca_inline(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Cerca nel catalogo degli annunci approvati con una query inline (@bot libri @milano <50)."""
+    query = update.inline_query
+    try:
+        da = int(query.offset or 0)
+    except ValueError:
+        da = 0
+    annunci, prossima = catalogo.cerca(query.query, limite=INLINE_RESULTS, da=da)
+    risultati = []
+    for ad in annunci:
+        dettagli = f"{formatta_prezzo(ad.prezzo_centesimi)} · {ad.location}"
+        if ad.photo:
+            risultati.append(InlineQueryResultCachedPhoto(
+                id=str(ad.id), photo_file_id=ad.photo, title=ad.title, description=dettagli,
+                caption=testo_pubblicazione(ad), parse_mode='Markdown'))
         else:
-            await query.edit_message_text(
-                f"❌ Annuncio Rifiutato da {query.from_user.first_name}\n\n{original_moderation_text}",
-                parse_mode='HTML',
-                reply_markup=None)
-        if original_user_id:
-            await context.bot.send_message(
-                original_user_id,
-                "❌ Il tuo annuncio è stato rifiutato dagli amministratori.")
-    if str(moderation_message_id) in context.bot_data:
-        del context.bot_data[str(moderation_message_id)]
+            risultati.append(InlineQueryResultArticle(
+                id=str(ad.id), title=ad.title, description=dettagli,
+                input_message_content=InputTextMessageContent(
+                    testo_pubblicazione(ad), parse_mode='Markdown')))
+    await query.answer(
+        risultati, cache_time=INLINE_CACHE_TIME,
+        next_offset=str(prossima) if prossima is not None else '')
+
+
+# 🟦 ▓▓▓▒▒▒░░░ /profila (moderatori)
+async def profila(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Campiona per qualche secondo cosa esegue il loop e riporta le funzioni più presenti."""
+    if update.effective_chat.id != MODERATION_CHAT_ID:
+        await update.message.reply_text("Questo comando è riservato alla chat dei moderatori.")
+        return
+    secondi = PROFILO_SECONDI
+    if context.args and context.args[0].isdigit():
+        secondi = max(1, min(int(context.args[0]), PROFILO_MAX_SECONDI))
+    if profiler.attivo:
+        await update.message.reply_text("Una profilazione è già in corso, riprova tra poco.")
+        return
+    await update.message.reply_text(f"⏱ Profilo il bot per {secondi} secondi…")
+    # L'aggiornamento finisce subito: il profilo prosegue in background
+    context.application.create_task(invia_profilo(context, update.effective_chat.id, secondi))
+
+
+async def invia_profilo(context: ContextTypes.DEFAULT_TYPE, chat_id: int, secondi: int) -> None:
+    try:
+        path, campioni, piu_presenti = await profiler.profila(secondi)
+    except RuntimeError:
+        return
+    righe = [f"⏱ <b>Profilo di {secondi} secondi</b> ({campioni} campioni)",
+             f"File: <code>{html.escape(path)}</code>", "", "<b>Dove si trovava il loop:</b>"]
+    for funzione, conteggio in piu_presenti:
+        righe.append(f"{conteggio * 100 / max(campioni, 1):5.1f}% <code>{html.escape(funzione)}</code>")
+    await outbox.invia(chat_id, PRIORITA_MODERAZIONE, context.bot.send_message,
+                       chat_id, "\n".join(righe), parse_mode='HTML')
+
+
+# 🟧  ▓▓▓▒▒▒░░░
+
+
+# 🟦 ▓▓▓▒▒▒░░░ /blocca e /sblocca (moderatori)
+async def blocca(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Mette un utente nella lista dei blocchi temporanei dell'anti-flood."""
+    if update.effective_chat.id != MODERATION_CHAT_ID:
+        await update.message.reply_text("Questo comando è riservato alla chat dei moderatori.")
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Uso: /blocca <id utente> [minuti]")
+        return
+    minuti = BLOCCO_MINUTI
+    if len(context.args) > 1 and context.args[1].isdigit():
+        minuti = max(1, int(context.args[1]))
+    antiflood.blocca(int(context.args[0]), minuti * 60)
+    await update.message.reply_text(
+        f"🚫 Utente {context.args[0]} bloccato per {minuti} minuti: i suoi messaggi vengono ignorati.")
+
+
+async def sblocca(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Toglie un utente dalla lista dei blocchi temporanei."""
+    if update.effective_chat.id != MODERATION_CHAT_ID:
+        await update.message.reply_text("Questo comando è riservato alla chat dei moderatori.")
+        return
+    if not context.args or not context.args[0].isdigit():
+        await update.message.reply_text("Uso: /sblocca <id utente>")
+        return
+    if antiflood.sblocca(int(context.args[0])):
+        await update.message.reply_text(f"✅ Utente {context.args[0]} sbloccato.")
+    else:
+        await update.message.reply_text(f"L'utente {context.args[0]} non era bloccato.")
+
+
+# 🟧  ▓▓▓▒▒▒░░░
+
+
+# 🟦 ▓▓▓▒▒▒░░░ /coda (moderatori)
+def pagina_coda(stato: dict) -> tuple[str, InlineKeyboardMarkup]:
+    """Testo e tastiera di una pagina di /coda, con gli annunci selezionati spuntati."""
+    da = stato['da']
+    annunci = moderazioni.in_sospeso(CODA_PAGINA, da)
+    if not annunci and da:
+        stato['da'] = da = max(0, len(moderazioni) - CODA_PAGINA)
+        annunci = moderazioni.in_sospeso(CODA_PAGINA, da)
+    # Gli annunci decisi nel frattempo (da altri moderatori o scaduti) escono dalla selezione
+    stato['selezionati'] = selezionati = {i for i in stato['selezionati'] if i in moderazioni}
+    righe = [f"📋 <b>Annunci in attesa: {len(moderazioni)}</b>"]
+    if stato.get('esiti'):
+        righe.append("\n<b>Ultimo lotto:</b>")
+        righe += [f"• {html.escape(titolo)}: {esito}" for titolo, esito in stato['esiti']]
+    if not annunci:
+        righe.append("\nNessun annuncio da moderare. 🎉")
+        return "\n".join(righe), InlineKeyboardMarkup([[InlineKeyboardButton("🔄 Aggiorna", callback_data='coda_agg')]])
+    righe.append(f"\nDal {da + 1} al {da + len(annunci)}. Seleziona gli annunci e scegli cosa fare:")
+    adesso = time.time()
+    keyboard = []
+    for posizione, ad in enumerate(annunci, start=da + 1):
+        ore = (adesso - ad.inviato_il) / 3600
+        righe.append(f"{posizione}. <b>{html.escape(ad.title)}</b> — {formatta_prezzo(ad.prezzo_centesimi)} · "
+                     f"{html.escape(ad.location)} · {html.escape(ad.user_name)}, {ore:.0f}h fa")
+        spunta = "☑️" if ad.message_id in selezionati else "⬜"
+        keyboard.append([InlineKeyboardButton(f"{spunta} {posizione}. {ad.title[:40]}",
+                                              callback_data=f"coda_sel_{ad.message_id}")])
+    navigazione = []
+    if da:
+        navigazione.append(InlineKeyboardButton("◀️", callback_data=f"coda_pag_{max(0, da - CODA_PAGINA)}"))
+    navigazione.append(InlineKeyboardButton("Tutti ☑️", callback_data='coda_tutti'))
+    if da + CODA_PAGINA < len(moderazioni):
+        navigazione.append(InlineKeyboardButton("▶️", callback_data=f"coda_pag_{da + CODA_PAGINA}"))
+    keyboard.append(navigazione)
+    keyboard.append([
+        InlineKeyboardButton(f"✅ Approva ({len(selezionati)})", callback_data='coda_ok'),
+        InlineKeyboardButton(f"❌ Rifiuta ({len(selezionati)})", callback_data='coda_no'),
+    ])
+    return "\n".join(righe), InlineKeyboardMarkup(keyboard)
+
+
+async def coda(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Elenca a pagine gli annunci in attesa, con selezione multipla per decidere in blocco."""
+    if update.effective_chat.id != MODERATION_CHAT_ID:
+        await update.message.reply_text("Questo comando è riservato alla chat dei moderatori.")
+        return
+    stato = {'da': 0, 'selezionati': set(), 'aperta_il': time.time()}
+    testo, tastiera = pagina_coda(stato)
+    messaggio = await update.message.reply_html(testo, reply_markup=tastiera)
+    code = context.chat_data.setdefault('code', {})
+    code[messaggio.message_id] = stato
+    # Solo le ultime liste aperte restano interattive
+    for vecchia in list(code)[:-5]:
+        del code[vecchia]
+
+
+async def coda_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    stato = context.chat_data.get('code', {}).get(query.message.message_id)
+    if stato is None:
+        await query.answer("Questa lista è scaduta: usa di nuovo /coda.", show_alert=True)
+        return
+    azione, _, argomento = query.data[len('coda_'):].partition('_')
+    if azione == 'sel':
+        stato['selezionati'] ^= {int(argomento)}
+    elif azione == 'pag':
+        stato['da'] = int(argomento)
+    elif azione == 'tutti':
+        pagina = {ad.message_id for ad in moderazioni.in_sospeso(CODA_PAGINA, stato['da'])}
+        if pagina <= stato['selezionati']:
+            stato['selezionati'] -= pagina
+        else:
+            stato['selezionati'] |= pagina
+    elif azione in ('ok', 'no'):
+        if not stato['selezionati']:
+            await query.answer("Nessun annuncio selezionato.")
+            return
+        if stato.get('in_corso'):
+            await query.answer("Un lotto è già in elaborazione.")
+            return
+        stato['in_corso'] = True
+        ids = sorted(stato['selezionati'])
+        stato['selezionati'] = set()
+        await query.answer(f"Elaborazione di {len(ids)} annunci…")
+        await query.edit_message_text(
+            f"⏳ {'Approvazione' if azione == 'ok' else 'Rifiuto'} di {len(ids)} annunci in corso…")
+        # Il lotto può durare minuti (limiti di invio del gruppo): non blocca l'aggiornamento
+        context.application.create_task(
+            concludi_lotto(context, query.message, stato, ids, azione == 'ok', query.from_user.first_name))
+        return
+    await query.answer()
+    testo, tastiera = pagina_coda(stato)
+    await query.edit_message_text(testo, parse_mode='HTML', reply_markup=tastiera)
+
+
+async def concludi_lotto(context, messaggio, stato: dict, ids: list[int], approva: bool, moderatore: str) -> None:
+    try:
+        stato['esiti'] = await modera_lotto(context, ids, approva, moderatore)
+    finally:
+        stato['in_corso'] = False
+    testo, tastiera = pagina_coda(stato)
+    await outbox.invia(
+        MODERATION_CHAT_ID, PRIORITA_MODERAZIONE, context.bot.edit_message_text,
+        chat_id=messaggio.chat_id, message_id=messaggio.message_id,
+        text=testo, parse_mode='HTML', reply_markup=tastiera)
+
+
+async def modera_lotto(context, ids: list[int], approva: bool, moderatore: str) -> list[tuple[str, str]]:
+    """Approva o rifiuta più annunci insieme e restituisce l'esito di ciascuno.
+
+    Gli annunci procedono in parallelo: schede e notifiche di tutto il lotto entrano
+    subito nello scheduler, che le fa uscire per priorità entro i limiti di invio,
+    invece di aspettare la fine di un annuncio prima di iniziare il successivo. Gli
+    approvati entrano nella coda delle pubblicazioni nell'ordine della selezione.
+    """
+    async def decidi(message_id: int) -> tuple[str, str]:
+        ad = moderazioni.get(message_id)
+        if not moderazioni.rivendica(message_id, moderatore):
+            gestore = moderazioni.gestito_da(message_id)
+            return (ad.title if ad else f"#{message_id}",
+                    f"già gestito da {gestore}" if gestore else "non più in attesa")
+        passi = {}
+        errori = await chiudi_moderazione(context, ad, approva, moderatore, passi)
+        esito = f"✅ approvato, pubblicazione {quando(passi['previsto'])}" if approva else "❌ rifiutato"
+        return ad.title, f"{esito}, ma con errori: {errori[0]}" if errori else esito
+
+    return list(await asyncio.gather(*(decidi(message_id) for message_id in ids)))
+# 🟧  ▓▓▓▒▒▒░░░ 
+
+
+def accoda_avvisi(context: ContextTypes.DEFAULT_TYPE, ad, pubblicato) -> None:
+    """Aggiunge l'annuncio approvato agli avvisi degli utenti con una ricerca salvata che lo soddisfa."""
+    corrispondenze = ricerche_salvate.corrispondenze(ad.title, ad.description, ad.location, ad.price)
+    corrispondenze.pop(ad.user_id, None)
+    if not corrispondenze:
+        return
+    messaggio = pubblicato[0] if isinstance(pubblicato, (list, tuple)) else pubblicato
+    titolo = html.escape(ad.title)
+    riga = f"• <a href=\"{messaggio.link}\">{titolo}</a>" if messaggio.link else f"• <b>{titolo}</b>"
+    riga += f" — {formatta_prezzo(ad.prezzo_centesimi)} · {html.escape(ad.location)}"
+    for user_id in corrispondenze:
+        avvisi_in_attesa.setdefault(user_id, []).append(riga)
+    if not context.job_queue.get_jobs_by_name('avvisi'):
+        context.job_queue.run_once(invia_avvisi, ALERT_BATCH_WINDOW, name='avvisi')
+    logger.info(f"Annuncio {ad.message_id}: {len(corrispondenze)} utenti da avvisare")
+
+
+async def invia_avvisi(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Invia a ogni utente un solo messaggio con gli annunci accumulati, a blocchi e con priorità bassa."""
+    da_inviare = list(avvisi_in_attesa.items())
+    avvisi_in_attesa.clear()
+    for inizio in range(0, len(da_inviare), ALERT_FANOUT_CHUNK):
+        blocco = da_inviare[inizio:inizio + ALERT_FANOUT_CHUNK]
+        risultati = await asyncio.gather(
+            *(outbox.invia(user_id, PRIORITA_AVVISI, context.bot.send_message,
+                           user_id, testo_avviso(righe, context.bot.username), parse_mode='HTML',
+                           link_preview_options=LinkPreviewOptions(is_disabled=True))
+              for user_id, righe in blocco),
+            return_exceptions=True)
+        for (user_id, _), risultato in zip(blocco, risultati):
+            if isinstance(risultato, Forbidden):
+                # L'utente ha bloccato il bot: le sue ricerche non servono più
+                eliminate = ricerche_salvate.rimuovi_utente(user_id)
+                logger.info(f"Utente {user_id} non raggiungibile: eliminate {eliminate} ricerche salvate")
+            elif isinstance(risultato, Exception):
+                logger.error(f"Impossibile inviare l'avviso all'utente {user_id}: {risultato}")
+
+
+def testo_avviso(righe: list[str], bot_username: str, massimo: int = 20) -> str:
+    testo = "🔔 <b>Nuovi annunci per le tue ricerche salvate</b>\n\n" + "\n".join(righe[-massimo:])
+    if len(righe) > massimo:
+        testo += f"\n… e altri {len(righe) - massimo}. Cercali con @{bot_username}."
+    return testo
+
+
+async def scadenza_moderazioni(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Fa scadere gli annunci che nessun moderatore ha esaminato in tempo e avvisa gli utenti."""
+    scadenza = time.time() - MODERATION_TTL_HOURS * 3600
+    for ad in moderazioni.estrai_scaduti(scadenza):
+        logger.info(f"Annuncio {ad.message_id} scaduto senza moderazione")
+        try:
+            await outbox.invia(
+                MODERATION_CHAT_ID, PRIORITA_MODERAZIONE, context.bot.edit_message_reply_markup,
+                chat_id=MODERATION_CHAT_ID, message_id=ad.message_id, reply_markup=None)
+        except Exception as e:
+            logger.error(f"Impossibile rimuovere i pulsanti dall'annuncio scaduto {ad.message_id}: {e}")
+        try:
+            await outbox.invia(
+                ad.user_id, PRIORITA_UTENTE, context.bot.send_message,
+                ad.user_id,
+                f"⌛ Il tuo annuncio \"{ad.title}\" non è stato esaminato entro {MODERATION_TTL_HOURS:g} ore "
+                "ed è scaduto. Puoi ripubblicarlo con /nuovo_annuncio.")
+        except Exception as e:
+            logger.error(f"Impossibile avvisare l'utente {ad.user_id} della scadenza: {e}")
+    logger.info(
+        f"Moderazioni in sospeso: {len(moderazioni)}, "
+        f"memoria stimata {moderazioni.memoria() / 1024:.1f} KB")
+
+
+async def sincronizza_archivi(context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Porta negli indici in memoria le modifiche agli archivi fatte dagli altri worker."""
+    for archivio in (moderazioni, catalogo, ricerche_salvate, impronte):
+        archivio.sincronizza()
+
+
+async def pota_modifiche(context: ContextTypes.DEFAULT_TYPE) -> None:
+    eliminate = await registro_modifiche.pota(MODIFICHE_CONSERVATE)
+    if eliminate:
+        logger.info(f"Eliminate {eliminate} annotazioni di modifiche già lette dai worker")
 
 
 # --- NUOVA STRUTTURA DI AVVIO CON SERVER AIOHTTP ---
@@ -514,39 +1974,305 @@ async def button_callback(update: Update, context):
 
 async def health_check(request: web.Request) -> web.Response:
     """Endpoint per UptimeRobot. Risponde a richieste GET su /."""
+    if request.app["chiusura"].is_set():
+        return web.Response(text="Draining", status=503)
     return web.Response(text="Bot is alive!", status=200)
 
 
+async def metrics(request: web.Request) -> web.Response:
+    """Metriche nel formato testuale di Prometheus."""
+    return web.Response(text=metriche.esporta(), content_type='text/plain', charset='utf-8',
+                        headers={'Cache-Control': 'no-store'})
+
+
+@web.middleware
+async def misura_richieste(request: web.Request, handler) -> web.StreamResponse:
+    """Tempo di risposta di ogni percorso registrato; i 404 non creano serie."""
+    inizio = time.perf_counter()
+    risposta = await handler(request)
+    risorsa = request.match_info.route.resource
+    if risorsa is not None:
+        metrica_durata_http.osserva((risorsa.canonical, str(risposta.status)), time.perf_counter() - inizio)
+    return risposta
+
+
+async def stato(request: web.Request) -> web.Response:
+    """Statistiche interne in JSON: code, attese e moderazioni in sospeso."""
+    update_queue = request.app.get("update_queue")
+    prefiltro = request.app.get("prefiltro")
+    piu_vecchio = moderazioni.piu_vecchio()
+    return web.json_response({
+        'coda_aggiornamenti': {
+            'in_coda': update_queue.depth,
+            'accettati': update_queue.accettati,
+            'rifiutati': update_queue.rifiutati,
+        } if update_queue is not None else None,
+        'prefiltro': prefiltro.statistiche() if prefiltro is not None else None,
+        'antiflood': antiflood.statistiche(),
+        'invii': outbox.statistiche(),
+        'aggiornamenti': {
+            'registrati': len(registro_aggiornamenti),
+            'duplicati': registro_aggiornamenti.duplicati,
+        },
+        'pubblicazioni': pubblicazioni.statistiche() if PRINCIPALE else None,
+        'filtro_contenuti': filtro_contenuti.statistiche(),
+        'impronte': {
+            'registrate': len(impronte),
+            'in_calcolo': len(impronte_in_corso),
+        },
+        'bozze': statistiche_bozze,
+        'loop': sorveglianza.statistiche(),
+        'log': {'in_coda': gestore_log.queue.qsize(), 'scartati': record_scartati(gestore_log)},
+        'avvio': avvio,
+        'worker': WORKER_INDEX,
+        'catalogo': len(catalogo),
+        'ricerche_salvate': len(ricerche_salvate),
+        'avvisi_in_attesa': len(avvisi_in_attesa),
+        'moderazioni': {
+            'in_sospeso': len(moderazioni),
+            'eta_massima': time.time() - piu_vecchio.inviato_il if piu_vecchio else 0,
+        },
+    })
+
+
+async def errore_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Registra gli errori degli handler e segna l'aggiornamento come fallito."""
+    logger.error(f"Errore durante l'elaborazione di un aggiornamento: {context.error}",
+                 exc_info=context.error)
+    if isinstance(update, Update):
+        registro_aggiornamenti.fallisci(update.update_id)
+
+
+async def processa_payload(application: Application, data: dict,
+                           prefiltro: UpdatePrefilter = None) -> bool:
+    """Converte il payload JSON in un Update e lo passa agli handler.
+
+    Restituisce False se un handler è fallito: l'aggiornamento va ritentato.
+    """
+    update_id = data.get('update_id')
+    traccia = sorveglianza.inizia(update_id, tipo_aggiornamento(data), utente_aggiornamento(data))
+    try:
+        inizio = time.perf_counter()
+        update = Update.de_json(data, application.bot)
+        if prefiltro is not None:
+            prefiltro.registra_parse(time.perf_counter() - inizio)
+        await application.process_update(update)
+    except Exception:
+        registro_aggiornamenti.fallisci(update_id)
+        raise
+    finally:
+        sorveglianza.termina(traccia)
+    if registro_aggiornamenti.stato(update_id) == FALLITO:
+        return False
+    registro_aggiornamenti.completa(update_id)
+    return True
+
+
+async def processa_con_tentativi(application: Application, data: dict,
+                                 prefiltro: UpdatePrefilter = None) -> None:
+    """Elabora un aggiornamento dalla coda, ritentandolo con attesa crescente se fallisce."""
+    update_id = data.get('update_id')
+    for tentativo in range(UPDATE_MAX_RETRIES + 1):
+        if tentativo:
+            await asyncio.sleep(2 ** (tentativo - 1))
+            registro_aggiornamenti.accetta(update_id)
+        try:
+            if await processa_payload(application, data, prefiltro):
+                return
+        except Exception as e:
+            logger.error(f"Errore nell'elaborazione dell'aggiornamento {update_id}: {e}")
+    logger.error(f"Aggiornamento {update_id} abbandonato dopo {UPDATE_MAX_RETRIES + 1} tentativi")
+
+
 async def telegram_webhook_handler(request: web.Request) -> web.Response:
     """Gestisce gli aggiornamenti in arrivo da Telegram su /webhook."""
+    if not request.app["pronto"].is_set():
+        metrica_aggiornamenti.inc(('sconosciuto', 'in_avvio'))
+        return web.Response(status=503)
+    if request.app["chiusura"].is_set():
+        # Telegram lo reinvierà, su una nuova connessione: alla nuova istanza, se c'è già
+        metrica_aggiornamenti.inc(('sconosciuto', 'in_chiusura'))
+        risposta = web.Response(status=503)
+        risposta.force_close()
+        return risposta
+    richieste = request.app["richieste"]
+    richieste['in_volo'] += 1
+    try:
+        # elabora_webhook, o nel supervisore inoltra_webhook
+        return await request.app["elabora"](request)
+    finally:
+        richieste['in_volo'] -= 1
+
+
+async def elabora_webhook(request: web.Request) -> web.Response:
     application = request.app["bot_application"]
+    update_queue = request.app.get("update_queue")
+    prefiltro = request.app.get("prefiltro")
+    tipo = 'sconosciuto'
     try:
-        data = await request.json()
-        update = Update.de_json(data, application.bot)
-        await application.process_update(update)
+        data = carica_json(await request.read())
+        tipo = tipo_aggiornamento(data)
+        if prefiltro is not None and prefiltro.motivo_scarto(data):
+            # Nessun handler lo gestirebbe: si risponde 200 senza costruire l'Update
+            metrica_aggiornamenti.inc((tipo, 'scartato'))
+            return web.Response()
+        update_id = data.get('update_id')
+        if not registro_aggiornamenti.accetta(update_id):
+            if registro_aggiornamenti.stato(update_id) == IN_CORSO:
+                # L'originale è ancora in elaborazione e potrebbe fallire: Telegram
+                # lo reinvierà più tardi, quando l'esito è noto
+                metrica_aggiornamenti.inc((tipo, 'in_corso'))
+                return web.Response(status=503)
+            # Reinvio di un aggiornamento già elaborato: nessun effetto
+            metrica_aggiornamenti.inc((tipo, 'duplicato'))
+            return web.Response()
+        esito_flood = antiflood.valuta(data)
+        if esito_flood is not None:
+            # Oltre il limite: si risponde 200, Telegram non deve reinviarlo
+            registro_aggiornamenti.completa(update_id)
+            metrica_aggiornamenti.inc((tipo, esito_flood))
+            if esito_flood == AVVISATO:
+                application.create_task(avvisa_flood(application.bot, data))
+            return web.Response()
+        if update_queue is not None:
+            # Risponde subito: l'elaborazione avviene nei worker della coda.
+            # Se la coda è piena un 503 chiede a Telegram di riprovare più tardi.
+            if not await update_queue.submit(data):
+                registro_aggiornamenti.fallisci(update_id)
+                metrica_aggiornamenti.inc((tipo, 'rifiutato'))
+                return web.Response(status=503)
+            metrica_aggiornamenti.inc((tipo, 'accodato'))
+            return web.Response()
+        if not await processa_payload(application, data, prefiltro):
+            # Un handler è fallito: Telegram reinvierà l'aggiornamento
+            metrica_aggiornamenti.inc((tipo, 'fallito'))
+            return web.Response(status=500)
+        metrica_aggiornamenti.inc((tipo, 'elaborato'))
         return web.Response()  # Risponde 200 OK a Telegram
     except Exception as e:
         logger.error(
             f"Errore nella gestione dell'aggiornamento da Telegram: {e}")
+        metrica_aggiornamenti.inc((tipo, 'errore'))
         return web.Response(status=500)
 
 
+async def avvisa_flood(bot, data: dict) -> None:
+    """Chiede di rallentare a chi ha superato il limite (al massimo una volta per finestra)."""
+    testo = "⏳ Stai inviando troppi messaggi: attendi qualche secondo e riprova."
+    query = data.get('callback_query')
+    try:
+        if query is not None:
+            await outbox.invia(query['from']['id'], PRIORITA_UTENTE, bot.answer_callback_query,
+                               query['id'], testo)
+        elif 'message' in data:
+            chat_id = data['message']['chat']['id']
+            await outbox.invia(chat_id, PRIORITA_UTENTE, bot.send_message, chat_id, testo)
+    except Exception as e:
+        logger.warning(f"Avviso anti-flood non inviato: {e}")
+
+
+async def configura_webhook(bot, url: str, allowed_updates: list[str]) -> str:
+    """Imposta il webhook solo se quello registrato su Telegram è diverso."""
+    info = await bot.get_webhook_info()
+    if info.url == url and sorted(info.allowed_updates or ()) == sorted(allowed_updates):
+        return 'invariato'
+    await bot.set_webhook(url=url, allowed_updates=allowed_updates)
+    return 'aggiornato'
+
+
+async def configura_comandi(application: Application) -> str:
+    """Imposta i menu dei comandi solo se sono cambiati dall'ultimo avvio.
+
+    L'impronta dei menu impostati resta in bot_data, salvato dalla persistenza.
+    """
+    menu = [(None, COMANDI_MENU), (MODERATION_CHAT_ID, COMANDI_MENU + COMANDI_MODERATORI)]
+    impronta = hashlib.sha256(json.dumps(
+        [application.bot.id] + [(chat_id, [c.to_dict() for c in comandi]) for chat_id, comandi in menu],
+        sort_keys=True).encode()).hexdigest()
+    if application.bot_data.get('impronta_comandi') == impronta:
+        return 'invariati'
+    await asyncio.gather(*(
+        application.bot.set_my_commands(comandi, scope=BotCommandScopeChat(chat_id) if chat_id else None)
+        for chat_id, comandi in menu))
+    application.bot_data['impronta_comandi'] = impronta
+    # Salvata subito: un riavvio ravvicinato non deve reinviare i menu
+    await application.update_persistence()
+    await application.persistence.flush()
+    return 'aggiornati'
+
+
+async def chiudi(application: Application, web_app: web.Application, runner: web.AppRunner,
+                 lock: Optional[InstanceLock]) -> None:
+    """Chiusura ordinata: finiscono gli aggiornamenti in corso, partono gli invii, si salva lo stato.
+
+    Il webhook risponde già 503 a tutto il resto; entro SHUTDOWN_TIMEOUT secondi
+    quello che resta in corso viene abbandonato.
+    """
+    inizio = time.monotonic()
+    scadenza = inizio + SHUTDOWN_TIMEOUT
+
+    def restante() -> float:
+        return max(0.0, scadenza - time.monotonic())
+
+    richieste = web_app["richieste"]
+    logger.info(f"Chiusura: {richieste['in_volo']} aggiornamenti in corso, attesa massima {SHUTDOWN_TIMEOUT:.0f}s")
+    while richieste['in_volo'] and restante():
+        await asyncio.sleep(0.05)
+    update_queue = web_app.get("update_queue")
+    if update_queue is not None:
+        await update_queue.stop(timeout=restante())
+    # Ferma i job e aggiorna la persistenza; gli invii accodati partono prima di chiudere il bot
+    await application.stop()
+    await outbox.stop(timeout=restante())
+    await application.shutdown()
+    # Gli handler sono fermi: le ultime scritture degli archivi vanno sul disco
+    await asyncio.to_thread(scrittore_archivi.chiudi)
+    if pool_impronte is not None:
+        pool_impronte.shutdown(wait=False, cancel_futures=True)
+    await sorveglianza.stop()
+    await runner.cleanup()
+    if lock is not None:
+        lock.rilascia()
+    logger.info(f"Chiusura completata in {time.monotonic() - inizio:.2f}s "
+                f"({richieste['in_volo']} aggiornamenti abbandonati)")
+
+
 async def main() -> None:
     """Configura il bot e avvia il server web."""
+    # Carica l'URL base del server da una variabile d'ambiente
+    BASE_URL = os.environ.get('BASE_URL')
+    if not BASE_URL:
+        raise ValueError("La variabile d'ambiente BASE_URL non è stata impostata.")
+
     # Crea un oggetto di persistenza per memorizzare gli stati della conversazione
-    persistence = DictPersistence()
+    persistence = SQLitePersistence(
+        DATABASE_PATH,
+        update_interval=PERSISTENCE_UPDATE_INTERVAL,
+        flush_interval=PERSISTENCE_FLUSH_INTERVAL)
 
     # Costruisce l'applicazione del bot, aggiungendo la persistenza
-    application = Application.builder().token(TOKEN).persistence(persistence).build()
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .base_url(f"{TELEGRAM_API_BASE_URL}/bot")
+        .base_file_url(f"{TELEGRAM_API_BASE_URL}/file/bot")
+        .persistence(persistence)
+        .request(MeteredRequest(metrica_durata_api, metrica_errori_api))
+        .build()
+    )
 
     # --- Registrazione degli handler ---
-    annuncio_handler = ConversationHandler(
-        entry_points=[CommandHandler('nuovo_annuncio', nuovo_annuncio)],
-        states={
-            ACCETTAZIONE_README: [
-                CallbackQueryHandler(accetta_readme, pattern='^accetta_readme$'),
-                CallbackQueryHandler(mostra_readme_da_accettazione, pattern='^leggi_readme$')
-            ],
+    if WIZARD_MODE == 'scheda':
+        # Ogni passo accetta il testo del campo richiesto e i pulsanti della scheda
+        # (handler distinti per stato: misura_handler avvolge ogni callback una volta sola)
+        stati_bozza = {
+            stato: [MessageHandler(filters.TEXT & ~filters.COMMAND, scrivi_campo),
+                    CallbackQueryHandler(pulsante_bozza, pattern=PATTERN_BOZZA)]
+            for stato in (FOTO, TITOLO, DESCRIZIONE, LOCALITA, PREZZO, CONFERMA)
+        }
+        stati_bozza[FOTO].insert(0, MessageHandler(filters.PHOTO, ricevi_foto))
+    else:
+        stati_bozza = {
             FOTO: [
                 MessageHandler(filters.PHOTO, ricevi_foto),
                 MessageHandler(filters.TEXT & filters.Regex('^✅ Fatto$'), foto_fatto),
@@ -566,9 +2292,32 @@ async def main() -> None:
             CONFERMA: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, conferma_annuncio)
             ],
+        }
+    # Ogni passo verifica che la bozza ci sia ancora (vedi richiede_bozza)
+    for handlers_stato in stati_bozza.values():
+        for handler in handlers_stato:
+            handler.callback = richiede_bozza(handler.callback)
+    annuncio_handler = ConversationHandler(
+        entry_points=[
+            CommandHandler('nuovo_annuncio', nuovo_annuncio),
+            CommandHandler('riprendi', riprendi),
+        ],
+        states={
+            ACCETTAZIONE_README: [
+                CallbackQueryHandler(accetta_readme, pattern='^accetta_readme$'),
+                CallbackQueryHandler(mostra_readme_da_accettazione, pattern='^leggi_readme$')
+            ],
+            **stati_bozza,
+            ConversationHandler.TIMEOUT: [
+                TypeHandler(Update, bozza_scaduta)
+            ],
         },
         fallbacks=[CommandHandler('cancel', cancel)],
-        per_message=False
+        per_message=False,
+        allow_reentry=True,
+        conversation_timeout=DRAFT_TIMEOUT,
+        name='annuncio',
+        persistent=True
     )
 
     tutorial_handler = ConversationHandler(
@@ -590,66 +2339,283 @@ async def main() -> None:
         ],
         per_message=False,
         allow_reentry=True,
-        conversation_timeout=1800
+        conversation_timeout=1800,
+        name='tutorial',
+        persistent=True
     )
 
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("readme", readme))
     application.add_handler(annuncio_handler)
+    application.add_handler(CallbackQueryHandler(bozza_non_attiva, pattern=PATTERN_BOZZA))
     application.add_handler(tutorial_handler) 
     application.add_handler(CallbackQueryHandler(button_callback, pattern=r'^(approve|reject)_\d+$'))
+    application.add_handler(InlineQueryHandler(ricerca_inline))
+    application.add_handler(CommandHandler("avvisami", avvisami))
+    application.add_handler(CommandHandler("coda", coda))
+    application.add_handler(CallbackQueryHandler(coda_callback, pattern=r'^coda_'))
+    application.add_handler(CallbackQueryHandler(
+        pubblicazione_callback, pattern=r'^pubblicazione_(riprova|scarta)_\d+$'))
+    application.add_handler(CommandHandler("profila", profila))
+    application.add_handler(CommandHandler("blocca", blocca))
+    application.add_handler(CommandHandler("sblocca", sblocca))
+    application.add_handler(CallbackQueryHandler(annulla_avviso, pattern=r'^annulla_avviso_\d+$'))
+
+    application.job_queue.run_repeating(
+        ricarica_regole, interval=CONTENT_RULES_RELOAD_INTERVAL, first=CONTENT_RULES_RELOAD_INTERVAL)
+    application.job_queue.run_repeating(
+        pulizia_bozze, interval=DRAFT_SWEEP_INTERVAL, first=DRAFT_SWEEP_INTERVAL)
+    if PRINCIPALE:
+        application.job_queue.run_repeating(
+            scadenza_moderazioni, interval=MODERATION_SWEEP_INTERVAL, first=60)
+        application.job_queue.run_repeating(
+            rilascia_pubblicazioni, interval=min(pubblicazioni.intervallo, 10), first=5)
+    if registro_modifiche is not None:
+        application.job_queue.run_repeating(
+            sincronizza_archivi, interval=SHARED_SYNC_INTERVAL, first=SHARED_SYNC_INTERVAL)
+        if PRINCIPALE:
+            application.job_queue.run_repeating(
+                pota_modifiche, interval=MODERATION_SWEEP_INTERVAL, first=MODERATION_SWEEP_INTERVAL)
+    application.add_error_handler(errore_handler)
+    for handlers in application.handlers.values():
+        misura_handler(handlers, metrica_handler, metrica_durata_handler, NOMI_STATI)
+    metriche.gauge(
+        'bot_conversazioni_attive', "Conversazioni in corso, per conversazione e stato",
+        conversazioni_per_stato(persistence, (annuncio_handler.name, tutorial_handler.name), NOMI_STATI),
+        ('conversazione', 'stato'))
 
 
-    # Questo prepara il bot a ricevere aggiornamenti, ma non avvia la ricezione.
-    await application.initialize()
-
     # --- Impostazione del server web AIOHTTP ---
-    web_app = web.Application()
+    web_app = web.Application(middlewares=[misura_richieste])
     web_app["bot_application"] = application
+    web_app["elabora"] = elabora_webhook
+    # Finché l'avvio non è completo il webhook risponde 503 e Telegram riprova più tardi
+    pronto = asyncio.Event()
+    web_app["pronto"] = pronto
+    # Impostato da SIGTERM/SIGINT: da lì in poi niente nuovi aggiornamenti
+    chiusura = asyncio.Event()
+    web_app["chiusura"] = chiusura
+    web_app["richieste"] = {'in_volo': 0}
+    loop = asyncio.get_running_loop()
+    for segnale in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(segnale, chiusura.set)
+        except NotImplementedError:  # Windows: resta solo KeyboardInterrupt
+            pass
+    allowed_updates = tipi_aggiornamento(application.handlers)
+    prefiltro = UpdatePrefilter(allowed_updates, PREFILTER_IGNORED_CHAT_IDS)
+    web_app["prefiltro"] = prefiltro
+    if WEBHOOK_MODE == 'queue':
+        update_queue = UpdateQueue(
+            lambda data: processa_con_tentativi(application, data, prefiltro),
+            workers=UPDATE_WORKERS,
+            maxsize=UPDATE_QUEUE_SIZE,
+            put_timeout=UPDATE_QUEUE_PUT_TIMEOUT)
+        update_queue.start()
+        web_app["update_queue"] = update_queue
     web_app.router.add_get("/", health_check)
+    web_app.router.add_get("/stato", stato)
+    web_app.router.add_get("/metrics", metrics)
     web_app.router.add_post("/webhook", telegram_webhook_handler)
 
+    # --- Avvio del server ---
+    # Il server si mette in ascolto per primo: il controllo su / risponde già durante l'avvio
+    runner = web.AppRunner(web_app)
+    await runner.setup()
+    if WORKER_SOCKET:
+        # Worker: riceve gli aggiornamenti dal supervisore su un socket Unix
+        site = web.UnixSite(runner, WORKER_SOCKET)
+        indirizzo = f"worker {WORKER_INDEX} su {WORKER_SOCKET}"
+    else:
+        port = int(os.environ.get("PORT", 8080))
+        site = web.TCPSite(runner, '0.0.0.0', port, reuse_port=WEB_REUSE_PORT or None)
+        indirizzo = f"porta {port}"
+    await site.start()
+    avvio['in_ascolto'] = time.perf_counter() - INIZIO_PROCESSO
+    logger.info(f"Server avviato su {indirizzo} dopo {avvio['in_ascolto']:.2f}s, avvio del bot in corso")
+    sorveglianza.start()
+    if PROFILE_ON_START > 0:
+        application.create_task(profiler.profila(PROFILE_ON_START))
+
+    # Durante un deploy la vecchia istanza può essere ancora in chiusura: lo stato si
+    # carica solo dopo che ha finito di scriverlo. I worker non lo prendono: lo tiene il supervisore.
+    lock = None
+    if WORKER_INDEX is None:
+        lock = InstanceLock(f"{DATABASE_PATH}.lock")
+        avvio['attesa_altra_istanza'] = await lock.acquisisci()
+
+    scrittore_archivi.apri(DATABASE_PATH)
+    # Le modifiche degli altri worker si leggono da qui in poi, prima di caricare gli archivi
+    if registro_modifiche is not None:
+        registro_modifiche.apri(DATABASE_PATH)
+    archivi = [moderazioni, catalogo, ricerche_salvate, impronte]
+    if PRINCIPALE:
+        archivi.append(pubblicazioni)
+    # Archivi e regole si caricano nei thread, insieme a getMe e alla persistenza dell'Application
+    await asyncio.gather(
+        *(asyncio.to_thread(archivio.apri, DATABASE_PATH) for archivio in archivi),
+        asyncio.to_thread(filtro_contenuti.ricarica),
+        application.initialize())
+
+    global pool_impronte
+    if PILLOW:
+        # forkserver: i processi non ereditano thread e connessioni del bot
+        contesto = multiprocessing.get_context('forkserver')
+        contesto.set_forkserver_preload(['photo_index', 'PIL.Image'])
+        pool_impronte = ProcessPoolExecutor(FINGERPRINT_WORKERS, mp_context=contesto)
+    else:
+        logger.warning("Pillow non installato: le foto duplicate vengono riconosciute solo se identiche")
 
-    
+    # Avvia i compiti in background dell'Application (salvataggio periodico della persistenza)
+    await application.start()
+    outbox.start()
+    if PRINCIPALE and pubblicazioni.interrotte:
+        application.create_task(avvisa_interrotte(application.bot))
+    pronto.set()
+    avvio['pronto'] = time.perf_counter() - INIZIO_PROCESSO
+
+    # Webhook e menu dei comandi si controllano in parallelo e si reimpostano solo se cambiati
 # 🟦 menù ≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣
-    comandi_menu = [
-        BotCommand("start", "Avvia il bot"),
-        BotCommand("readme", "Istruzioni preliminari"),
-        BotCommand("nuovo_annuncio", "Crea annuncio di Stock oggetti"),
-        BotCommand("cancel", "Annulla la creazione dell'annuncio"),
-        BotCommand("cosa_sono_i_bot", "introduzione ai bot di telegram")
-        
-    ]
-    await application.bot.set_my_commands(comandi_menu)
+    if PRINCIPALE:
+        avvio['webhook'], avvio['comandi'] = await asyncio.gather(
+            configura_webhook(application.bot, f"{BASE_URL}/webhook", allowed_updates),
+            configura_comandi(application))
+    else:
+        avvio['webhook'] = avvio['comandi'] = 'dal worker principale'
 # 🟧 ≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣≣ 
+    avvio['completato'] = time.perf_counter() - INIZIO_PROCESSO
+    logger.info(
+        f"Bot pronto dopo {avvio['pronto']:.2f}s, avvio completato dopo {avvio['completato']:.2f}s "
+        f"(webhook {avvio['webhook']} su {BASE_URL}/webhook, aggiornamenti: {', '.join(allowed_updates)}; "
+        f"comandi {avvio['comandi']})")
 
+    # Resta in esecuzione fino a SIGTERM/SIGINT, poi chiude in ordine
+    await chiusura.wait()
+    await chiudi(application, web_app, runner, lock)
 
-    
-    # Imposta l'URL del webhook con i server di Telegram
-    # Carica l'URL base del server da una variabile d'ambiente
-    BASE_URL = os.environ.get('BASE_URL')
-    if not BASE_URL:
-        raise ValueError("La variabile d'ambiente BASE_URL non è stata impostata.")
 
-    # La riga successiva userà questa variabile
-    await application.bot.set_webhook(url=f"{BASE_URL}/webhook", allowed_updates=Update.ALL_TYPES)
-    logger.info(f"Webhook impostato su {BASE_URL}/webhook")
-    
+# --- SUPERVISORE CON PIÙ WORKER (WORKER_PROCESSES > 1) ---
+
+
+def chiave_instradamento(data: dict):
+    """Chiave con cui il supervisore sceglie il worker: l'utente, o la chat se non c'è.
+
+    La chat dei moderatori va tutta a un solo worker, il principale: le liste di /coda
+    stanno nelle sue chat_data e le decisioni non si contendono gli annunci tra
+    processi. /blocca e /sblocca vanno invece al worker dell'utente indicato, dove
+    vive il suo anti-flood.
+    """
+    if chat_aggiornamento(data) == MODERATION_CHAT_ID:
+        argomenti = ((data.get('message') or {}).get('text') or '').split()
+        if len(argomenti) > 1 and argomenti[0].split('@')[0] in ('/blocca', '/sblocca') and argomenti[1].isdigit():
+            return int(argomenti[1])
+        return MODERATION_CHAT_ID
+    return chiave_ordinamento(data)
+
+
+async def inoltra_webhook(request: web.Request) -> web.Response:
+    """Passa l'aggiornamento al worker del suo utente e risponde a Telegram come lui."""
+    pool = request.app["pool"]
+    corpo = await request.read()
+    try:
+        indice = pool.worker(carica_json(corpo))
+    except Exception as e:
+        logger.error(f"Errore nella gestione dell'aggiornamento da Telegram: {e}")
+        return web.Response(status=500)
+    return web.Response(status=await pool.inoltra(indice, corpo))
+
+
+async def stato_supervisore(request: web.Request) -> web.Response:
+    """Processi worker e statistiche interne di ciascuno."""
+    pool = request.app["pool"]
+    stati = await asyncio.gather(*(pool.richiedi(indice, '/stato') for indice in range(pool.processi)))
+    return web.json_response({
+        'avvio': avvio,
+        'worker': [dict(statistiche, stato=json.loads(stato) if stato is not None else None)
+                   for statistiche, stato in zip(pool.statistiche(), stati)],
+    })
+
+
+async def metriche_supervisore(request: web.Request) -> web.Response:
+    """Metriche di tutti i worker, distinte dall'etichetta `worker`."""
+    pool = request.app["pool"]
+    testi = await asyncio.gather(*(pool.richiedi(indice, '/metrics') for indice in range(pool.processi)))
+    return web.Response(
+        text=unisci_metriche([(indice, testo.decode()) for indice, testo in enumerate(testi) if testo is not None]),
+        content_type='text/plain', charset='utf-8', headers={'Cache-Control': 'no-store'})
+
+
+async def supervisiona() -> None:
+    """Avvia WORKER_PROCESSES worker e smista loro gli aggiornamenti ricevuti sul webhook.
+
+    Il supervisore non elabora aggiornamenti: legge solo l'utente dal JSON e inoltra
+    il corpo della richiesta al worker su un socket Unix, così il lavoro degli
+    handler si divide tra più core.
+    """
+    cartella = tempfile.mkdtemp(prefix='aqbazar-worker-')
+    pool = WorkerPool([sys.executable, os.path.abspath(__file__)], WORKER_PROCESSES, cartella,
+                      dict(os.environ), chiave=chiave_instradamento)
+    web_app = web.Application()
+    web_app["pool"] = pool
+    web_app["elabora"] = inoltra_webhook
+    pronto = asyncio.Event()
+    web_app["pronto"] = pronto
+    chiusura = asyncio.Event()
+    web_app["chiusura"] = chiusura
+    web_app["richieste"] = {'in_volo': 0}
+    loop = asyncio.get_running_loop()
+    for segnale in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(segnale, chiusura.set)
+        except NotImplementedError:
+            pass
+    web_app.router.add_get("/", health_check)
+    web_app.router.add_get("/stato", stato_supervisore)
+    web_app.router.add_get("/metrics", metriche_supervisore)
+    web_app.router.add_post("/webhook", telegram_webhook_handler)
 
-    # --- Avvio del server ---
     port = int(os.environ.get("PORT", 8080))
     runner = web.AppRunner(web_app)
     await runner.setup()
-    site = web.TCPSite(runner, '0.0.0.0', port)
-    await site.start()
-    logger.info(f"Server avviato su porta {port}")
-
-    # Mantiene lo script in esecuzione
-    await asyncio.Event().wait()
+    await web.TCPSite(runner, '0.0.0.0', port, reuse_port=WEB_REUSE_PORT or None).start()
+    avvio['in_ascolto'] = time.perf_counter() - INIZIO_PROCESSO
+    logger.info(f"Supervisore in ascolto sulla porta {port}, avvio di {WORKER_PROCESSES} worker")
+
+    # I worker partono solo quando l'istanza precedente (supervisore e worker) ha chiuso
+    lock = InstanceLock(f"{DATABASE_PATH}.lock")
+    avvio['attesa_altra_istanza'] = await lock.acquisisci()
+    pool.avvia()
+    avvio_worker = asyncio.create_task(pool.attendi_avvio())
+    fine = asyncio.create_task(chiusura.wait())
+    await asyncio.wait((avvio_worker, fine), return_when=asyncio.FIRST_COMPLETED)
+    if avvio_worker.done():
+        pronto.set()
+        avvio['completato'] = time.perf_counter() - INIZIO_PROCESSO
+        logger.info(f"Supervisore pronto dopo {avvio['completato']:.2f}s con {WORKER_PROCESSES} worker")
+    else:
+        avvio_worker.cancel()
+    await fine
+    await chiudi_supervisore(web_app, runner, pool, lock, cartella)
+
+
+async def chiudi_supervisore(web_app: web.Application, runner: web.AppRunner, pool: WorkerPool,
+                             lock: InstanceLock, cartella: str) -> None:
+    """Aspetta le risposte dei worker agli aggiornamenti già inoltrati, poi chiude i worker in ordine."""
+    inizio = time.monotonic()
+    richieste = web_app["richieste"]
+    while richieste['in_volo'] and time.monotonic() - inizio < SHUTDOWN_TIMEOUT:
+        await asyncio.sleep(0.05)
+    # Ogni worker chiude come un'istanza singola, entro SHUTDOWN_TIMEOUT secondi
+    codici = await pool.ferma(SHUTDOWN_TIMEOUT + 5)
+    await runner.cleanup()
+    lock.rilascia()
+    shutil.rmtree(cartella, ignore_errors=True)
+    logger.info(f"Chiusura del supervisore completata in {time.monotonic() - inizio:.2f}s "
+                f"(uscita dei worker: {codici})")
 
 
 if __name__ == '__main__':
     try:
-        asyncio.run(main())
+        asyncio.run(supervisiona() if SUPERVISORE else main())
     except KeyboardInterrupt:
         logger.info("Script interrotto manualmente.")
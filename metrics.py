@@ -0,0 +1,274 @@
+import time
+from bisect import bisect_left
+from functools import wraps
+from typing import Callable, Iterable, Optional
+
+from telegram import Update
+from telegram.ext import BaseHandler, ConversationHandler
+from telegram.request import HTTPXRequest
+
+from diagnostics import traccia_corrente
+
+# Limiti degli istogrammi di durata, in secondi
+LIMITI_DURATA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _etichette(nomi: tuple, valori: tuple, extra: str = '') -> str:
+    coppie = [f'{nome}="{_escape(valore)}"' for nome, valore in zip(nomi, valori)]
+    if extra:
+        coppie.append(extra)
+    return '{' + ','.join(coppie) + '}' if coppie else ''
+
+
+def _escape(valore) -> str:
+    return str(valore).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def _numero(valore: float) -> str:
+    return repr(float(valore)) if isinstance(valore, float) else str(valore)
+
+
+class Counter:
+    """Contatore monotono per combinazione di etichette.
+
+    `inc` fa solo una ricerca in un dict e un'addizione: le chiavi sono tuple di
+    valori, meglio se costruite una volta sola dal chiamante. Tutto gira nel loop
+    degli eventi, quindi non servono lock.
+    """
+
+    __slots__ = ('nome', 'aiuto', 'etichette', '_valori')
+    tipo = 'counter'
+
+    def __init__(self, nome: str, aiuto: str, etichette: tuple = ()):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.etichette = etichette
+        self._valori: dict[tuple, float] = {}
+
+    def inc(self, chiave: tuple = (), quantita: float = 1) -> None:
+        self._valori[chiave] = self._valori.get(chiave, 0) + quantita
+
+    def valore(self, chiave: tuple = ()) -> float:
+        return self._valori.get(chiave, 0)
+
+    def righe(self) -> Iterable[str]:
+        for chiave, valore in self._valori.items():
+            yield f"{self.nome}{_etichette(self.etichette, chiave)} {_numero(valore)}"
+
+
+class Histogram:
+    """Istogramma a secchi fissi per combinazione di etichette.
+
+    Per ogni serie tiene i conteggi dei singoli secchi e la somma; i valori
+    cumulativi del formato Prometheus si calcolano solo all'esportazione.
+    """
+
+    __slots__ = ('nome', 'aiuto', 'etichette', 'limiti', '_serie')
+    tipo = 'histogram'
+
+    def __init__(self, nome: str, aiuto: str, etichette: tuple = (), limiti: tuple = LIMITI_DURATA):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.etichette = etichette
+        self.limiti = tuple(sorted(limiti))
+        self._serie: dict[tuple, list] = {}
+
+    def osserva(self, chiave: tuple, valore: float) -> None:
+        serie = self._serie.get(chiave)
+        if serie is None:
+            # Un secchio per limite, uno per +Inf e in fondo la somma
+            serie = self._serie[chiave] = [0] * (len(self.limiti) + 1) + [0.0]
+        serie[bisect_left(self.limiti, valore)] += 1
+        serie[-1] += valore
+
+    def conteggio(self, chiave: tuple = ()) -> int:
+        serie = self._serie.get(chiave)
+        return sum(serie[:-1]) if serie else 0
+
+    def righe(self) -> Iterable[str]:
+        for chiave, serie in self._serie.items():
+            cumulato = 0
+            for limite, conteggio in zip(self.limiti + (float('inf'),), serie):
+                cumulato += conteggio
+                le = '+Inf' if limite == float('inf') else repr(float(limite))
+                extra = f'le="{le}"'
+                yield f"{self.nome}_bucket{_etichette(self.etichette, chiave, extra)} {cumulato}"
+            yield f"{self.nome}_sum{_etichette(self.etichette, chiave)} {_numero(serie[-1])}"
+            yield f"{self.nome}_count{_etichette(self.etichette, chiave)} {cumulato}"
+
+
+class Gauge:
+    """Valore letto al momento dell'esportazione: `misura()` restituisce (chiave, valore)."""
+
+    __slots__ = ('nome', 'aiuto', 'etichette', 'misura')
+    tipo = 'gauge'
+
+    def __init__(self, nome: str, aiuto: str, misura: Callable[[], Iterable[tuple[tuple, float]]],
+                 etichette: tuple = ()):
+        self.nome = nome
+        self.aiuto = aiuto
+        self.etichette = etichette
+        self.misura = misura
+
+    def righe(self) -> Iterable[str]:
+        for chiave, valore in self.misura():
+            yield f"{self.nome}{_etichette(self.etichette, chiave)} {_numero(valore)}"
+
+
+class MetricsRegistry:
+    """Metriche del bot esportate nel formato testuale di Prometheus su /metrics."""
+
+    def __init__(self):
+        self._metriche: list = []
+
+    def counter(self, nome: str, aiuto: str, etichette: tuple = ()) -> Counter:
+        return self._registra(Counter(nome, aiuto, etichette))
+
+    def histogram(self, nome: str, aiuto: str, etichette: tuple = (), limiti: tuple = LIMITI_DURATA) -> Histogram:
+        return self._registra(Histogram(nome, aiuto, etichette, limiti))
+
+    def gauge(self, nome: str, aiuto: str, misura: Callable, etichette: tuple = ()) -> Gauge:
+        return self._registra(Gauge(nome, aiuto, misura, etichette))
+
+    def _registra(self, metrica):
+        if any(m.nome == metrica.nome for m in self._metriche):
+            raise ValueError(f"metrica già registrata: {metrica.nome}")
+        self._metriche.append(metrica)
+        return metrica
+
+    def esporta(self) -> str:
+        righe = []
+        for metrica in self._metriche:
+            righe.append(f"# HELP {metrica.nome} {metrica.aiuto}")
+            righe.append(f"# TYPE {metrica.nome} {metrica.tipo}")
+            righe.extend(metrica.righe())
+        return '\n'.join(righe) + '\n'
+
+
+def tipo_aggiornamento(data: dict) -> str:
+    """Tipo di un aggiornamento grezzo di Telegram (message, callback_query…)."""
+    for tipo in data:
+        if tipo != 'update_id':
+            return tipo
+    return 'vuoto'
+
+
+def _tipo_update(update) -> str:
+    if isinstance(update, Update):
+        for tipo in Update.ALL_TYPES:
+            if getattr(update, tipo, None) is not None:
+                return tipo
+    return 'altro'
+
+
+def misura_handler(handlers: Iterable[BaseHandler], chiamate: Counter, durata: Histogram,
+                   nomi_stati: Optional[dict] = None, stato: Optional[str] = None) -> None:
+    """Avvolge le callback degli handler (anche dentro le conversazioni) per misurarle.
+
+    Per ogni aggiornamento restano due letture dell'orologio, un conteggio e
+    un'osservazione dell'istogramma. Nella traccia dell'aggiornamento finiscono
+    anche il nome dell'handler e lo stato della conversazione in cui si trova.
+    """
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            nome = handler.name or 'conversazione'
+            nomi = (nomi_stati or {}).get(nome, {})
+            misura_handler(handler.entry_points, chiamate, durata, nomi_stati, f"{nome}:ingresso")
+            for chiave, handlers_stato in handler.states.items():
+                nome_stato = 'timeout' if chiave == ConversationHandler.TIMEOUT else nomi.get(chiave, str(chiave))
+                misura_handler(handlers_stato, chiamate, durata, nomi_stati, f"{nome}:{nome_stato}")
+            misura_handler(handler.fallbacks, chiamate, durata, nomi_stati, f"{nome}:fallback")
+        else:
+            handler.callback = _misurata(handler.callback, chiamate, durata, stato)
+
+
+def _misurata(callback, chiamate: Counter, durata: Histogram, stato: Optional[str]):
+    nome = callback.__name__
+    chiave = (nome,)
+
+    @wraps(callback)
+    async def misurata(update, context):
+        traccia = traccia_corrente.get()
+        if traccia is not None:
+            # Per i log scritti durante l'handler
+            traccia.handler_corrente = nome
+        inizio = time.perf_counter()
+        esito = 'errore'
+        try:
+            risultato = await callback(update, context)
+            esito = 'ok'
+            return risultato
+        finally:
+            trascorso = time.perf_counter() - inizio
+            durata.osserva(chiave, trascorso)
+            chiamate.inc((_tipo_update(update), nome, esito))
+            if traccia is not None:
+                traccia.registra_handler(nome, stato, trascorso)
+
+    return misurata
+
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest che misura durata ed errori di ogni chiamata alla Bot API, per metodo.
+
+    Le chiamate sono POST all'URL del metodo; i download dei file sono GET e
+    finiscono tutti sotto `download`, per non creare una serie per ogni file.
+    L'URL contiene il token e non compare mai nelle etichette.
+    """
+
+    def __init__(self, durata: Histogram, errori: Counter, **kwargs):
+        super().__init__(**kwargs)
+        self._durata = durata
+        self._errori = errori
+        self._metodi: dict[str, tuple] = {}
+
+    async def do_request(self, url: str, method: str, request_data=None,
+                         read_timeout=HTTPXRequest.DEFAULT_NONE, write_timeout=HTTPXRequest.DEFAULT_NONE,
+                         connect_timeout=HTTPXRequest.DEFAULT_NONE, pool_timeout=HTTPXRequest.DEFAULT_NONE):
+        if method == 'GET':
+            chiave = ('download',)
+        else:
+            chiave = self._metodi.get(url)
+            if chiave is None:
+                chiave = self._metodi[url] = (url.rsplit('/', 1)[-1],)
+        inizio = time.perf_counter()
+        esito = 'errore'
+        try:
+            codice, corpo = await super().do_request(
+                url, method, request_data, read_timeout=read_timeout, write_timeout=write_timeout,
+                connect_timeout=connect_timeout, pool_timeout=pool_timeout)
+            esito = str(codice)
+        except Exception as e:
+            esito = type(e).__name__
+            self._errori.inc((chiave[0], esito))
+            raise
+        finally:
+            trascorso = time.perf_counter() - inizio
+            self._durata.osserva(chiave, trascorso)
+            traccia = traccia_corrente.get()
+            if traccia is not None:
+                traccia.registra_chiamata(chiave[0], trascorso, esito)
+        if codice >= 400:
+            self._errori.inc((chiave[0], esito))
+        return codice, corpo
+
+
+def conversazioni_per_stato(persistenza, conversazioni: Iterable[str],
+                            nomi_stati: dict[str, dict]) -> Callable[[], list[tuple[tuple, int]]]:
+    """Misura per Gauge: conversazioni attive per conversazione e stato.
+
+    Gli stati si leggono da `persistenza.stati_conversazione(nome)`, cioè da quello
+    che l'Application salva a ogni update_interval: il valore può restare indietro
+    di qualche secondo rispetto agli handler.
+    """
+    conversazioni = tuple(conversazioni)
+
+    def misura() -> list[tuple[tuple, int]]:
+        conteggi: dict[tuple, int] = {}
+        for nome in conversazioni:
+            nomi = nomi_stati.get(nome, {})
+            for stato in persistenza.stati_conversazione(nome):
+                chiave = (nome, nomi.get(stato, str(stato)))
+                conteggi[chiave] = conteggi.get(chiave, 0) + 1
+        return list(conteggi.items())
+    return misura
@@ -0,0 +1,172 @@
+import logging
+import sqlite3
+import sys
+from collections import OrderedDict
+from itertools import islice, takewhile
+from typing import Iterator, Optional
+
+from ad_record import PendingAd
+from sqlite_persistence import ChangeLog, SQLiteWriter, apri_database
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS moderazioni (
+    message_id INTEGER PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    inviato_il REAL NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS moderazioni_inviato_il ON moderazioni (inviato_il);
+"""
+_ARCHIVIO = 'moderazioni'
+
+
+class ModerationStore:
+    """Annunci in attesa di moderazione, indicizzati in memoria e salvati su SQLite.
+
+    - indice primario per id del messaggio di moderazione;
+    - indice per utente che ha inviato l'annuncio;
+    - ordine di invio, che coincide con l'ordine di inserimento: scadenze ed elenchi
+      dei più vecchi leggono solo la testa dell'indice, senza scandire tutto.
+
+    Ogni decisione passa da `rivendica`: controllo e assegnazione avvengono senza
+    cedere il loop, quindi tra più callback concorrenti sullo stesso annuncio ne
+    vince una sola. Gli autori delle decisioni recenti restano in memoria per
+    rispondere ai clic arrivati in ritardo.
+
+    Con più worker (`modifiche`) gli annunci vengono aggiunti dal worker di chi li
+    invia e decisi da quello della chat dei moderatori: `sincronizza` porta negli
+    indici le modifiche degli altri processi, e `get` la chiama da sé quando non
+    trova un annuncio appena arrivato. Le decisioni avvengono tutte nello stesso
+    processo, quindi le rivendicazioni restano in memoria.
+    """
+
+    def __init__(self, decisioni_ricordate: int = 1000, modifiche: Optional[ChangeLog] = None,
+                 scrittore: Optional[SQLiteWriter] = None):
+        self._conn: Optional[sqlite3.Connection] = None
+        self._scrittore_condiviso = scrittore
+        self._scrittore: Optional[SQLiteWriter] = None
+        self._per_id: OrderedDict[int, PendingAd] = OrderedDict()
+        self._per_utente: dict[int, dict[int, None]] = {}
+        self._in_gestione: dict[int, str] = {}
+        self._decisi: OrderedDict[int, str] = OrderedDict()
+        self._decisioni_ricordate = decisioni_ricordate
+        self._modifiche = modifiche
+
+    def apri(self, path: str) -> None:
+        """Apre il database e ricostruisce gli indici dalle moderazioni salvate."""
+        self._conn = apri_database(path)
+        self._scrittore = self._scrittore_condiviso or SQLiteWriter(self._conn)
+        self._conn.executescript(_SCHEMA)
+        self._per_id.clear()
+        self._per_utente.clear()
+        for (data,) in self._conn.execute("SELECT data FROM moderazioni ORDER BY inviato_il"):
+            self._indicizza(PendingAd.from_bytes(data))
+        logger.info(f"Caricate {len(self)} moderazioni in sospeso")
+
+    def _indicizza(self, ad: PendingAd) -> None:
+        self._per_id[ad.message_id] = ad
+        self._per_utente.setdefault(ad.user_id, {})[ad.message_id] = None
+
+    def _deindicizza(self, ad: PendingAd) -> None:
+        del self._per_id[ad.message_id]
+        annunci_utente = self._per_utente[ad.user_id]
+        del annunci_utente[ad.message_id]
+        if not annunci_utente:
+            del self._per_utente[ad.user_id]
+
+    def __len__(self) -> int:
+        return len(self._per_id)
+
+    def __contains__(self, message_id: int) -> bool:
+        return message_id in self._per_id
+
+    def get(self, message_id: int) -> Optional[PendingAd]:
+        ad = self._per_id.get(message_id)
+        if ad is None and self.sincronizza():
+            ad = self._per_id.get(message_id)
+        return ad
+
+    def aggiungi(self, ad: PendingAd) -> None:
+        if ad.message_id in self._per_id:
+            self._deindicizza(self._per_id[ad.message_id])
+        self._indicizza(ad)
+        if self._conn is not None:
+            self._scrittore.esegui(
+                "INSERT OR REPLACE INTO moderazioni (message_id, user_id, inviato_il, data) "
+                "VALUES (?, ?, ?, ?)",
+                (ad.message_id, ad.user_id, ad.inviato_il, ad.to_bytes()))
+            if self._modifiche is not None:
+                self._modifiche.annota(_ARCHIVIO, (ad.message_id,))
+
+    def rimuovi(self, message_id: int) -> Optional[PendingAd]:
+        ad = self._per_id.get(message_id)
+        if ad is None:
+            return None
+        self._deindicizza(ad)
+        moderatore = self._in_gestione.pop(message_id, None)
+        if moderatore is not None:
+            self._decisi[message_id] = moderatore
+            if len(self._decisi) > self._decisioni_ricordate:
+                self._decisi.popitem(last=False)
+        if self._conn is not None:
+            self._scrittore.esegui("DELETE FROM moderazioni WHERE message_id = ?", (message_id,))
+            if self._modifiche is not None:
+                self._modifiche.annota(_ARCHIVIO, (message_id,))
+        return ad
+
+    def sincronizza(self) -> int:
+        """Ricarica gli annunci aggiunti o tolti dagli altri worker e restituisce quanti erano."""
+        if self._modifiche is None or self._conn is None:
+            return 0
+        message_ids = self._modifiche.nuove(_ARCHIVIO)
+        for message_id in message_ids:
+            riga = self._conn.execute(
+                "SELECT data FROM moderazioni WHERE message_id = ?", (message_id,)).fetchone()
+            if message_id in self._per_id:
+                self._deindicizza(self._per_id[message_id])
+            if riga is not None:
+                self._indicizza(PendingAd.from_bytes(riga[0]))
+        return len(message_ids)
+
+    def rivendica(self, message_id: int, moderatore: str) -> bool:
+        """Riserva a `moderatore` la decisione sull'annuncio. False se è già preso o deciso."""
+        if message_id not in self._per_id or message_id in self._in_gestione:
+            return False
+        self._in_gestione[message_id] = moderatore
+        return True
+
+    def rilascia(self, message_id: int) -> None:
+        """Annulla la rivendicazione: l'annuncio torna disponibile per una nuova decisione."""
+        self._in_gestione.pop(message_id, None)
+
+    def gestito_da(self, message_id: int) -> Optional[str]:
+        """Chi sta decidendo o ha deciso di recente l'annuncio, se qualcuno."""
+        return self._in_gestione.get(message_id) or self._decisi.get(message_id)
+
+    def in_sospeso(self, limite: int, da: int = 0) -> list[PendingAd]:
+        """I `limite` annunci più vecchi a partire dalla posizione `da`, in O(da + limite)."""
+        return list(islice(self._per_id.values(), da, da + limite))
+
+    def per_utente(self, user_id: int) -> list[PendingAd]:
+        return [self._per_id[message_id] for message_id in self._per_utente.get(user_id, ())]
+
+    def piu_vecchio(self) -> Optional[PendingAd]:
+        return next(iter(self._per_id.values()), None)
+
+    def estrai_scaduti(self, scadenza: float) -> Iterator[PendingAd]:
+        """Rimuove e restituisce gli annunci inviati prima di `scadenza`, dal più vecchio."""
+        scaduti = list(takewhile(lambda ad: ad.inviato_il < scadenza, self._per_id.values()))
+        for ad in scaduti:
+            if ad.message_id not in self._per_id or ad.message_id in self._in_gestione:
+                # Deciso nel frattempo, o un moderatore lo sta decidendo proprio ora
+                continue
+            self.rimuovi(ad.message_id)
+            yield ad
+
+    def memoria(self) -> int:
+        """Stima dei byte occupati dagli annunci in sospeso e dagli indici."""
+        totale = sys.getsizeof(self._per_id) + sys.getsizeof(self._per_utente)
+        totale += sum(sys.getsizeof(annunci) for annunci in self._per_utente.values())
+        return totale + sum(ad.memoria() for ad in self._per_id.values())
@@ -0,0 +1,199 @@
+import importlib.util
+import io
+import logging
+import sqlite3
+import time
+from itertools import combinations
+from typing import Iterable, Optional
+
+# Pillow serve solo nei processi che calcolano gli hash: il bot controlla che ci sia
+# senza importarlo. Senza Pillow resta solo il controllo esatto su file_unique_id.
+PILLOW = importlib.util.find_spec('PIL') is not None
+
+from sqlite_persistence import ChangeLog, SQLiteWriter, apri_database
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS impronte (
+    file_unique_id TEXT PRIMARY KEY,
+    hash INTEGER,
+    message_id INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    aggiunta_il REAL NOT NULL
+);
+"""
+_ARCHIVIO = 'impronte'
+_COLONNE = "file_unique_id, hash, message_id, user_id, aggiunta_il"
+
+# L'hash a 64 bit è diviso in 4 blocchi da 16 bit, ognuno con la sua tabella
+_BLOCCHI = 4
+_BITS_BLOCCO = 16
+_MASCHERA_BLOCCO = (1 << _BITS_BLOCCO) - 1
+
+
+def dhash(contenuto: bytes, lato: int = 8) -> int:
+    """Hash percettivo a 64 bit (dHash): confronta la luminosità di pixel adiacenti.
+
+    Resiste a ricompressione, ridimensionamento e piccoli ritagli. Gira nei processi
+    del pool, fuori dal loop degli eventi.
+    """
+    from PIL import Image
+    with Image.open(io.BytesIO(contenuto)) as immagine:
+        # Per i JPEG decodifica direttamente a una frazione della risoluzione
+        immagine.draft('L', (lato * 8, lato * 8))
+        pixel = immagine.convert('L').resize((lato + 1, lato), Image.Resampling.BILINEAR).tobytes()
+    valore = 0
+    for riga in range(lato):
+        base = riga * (lato + 1)
+        for colonna in range(base, base + lato):
+            valore = (valore << 1) | (pixel[colonna] > pixel[colonna + 1])
+    return valore
+
+
+def _con_segno(valore: int) -> int:
+    # SQLite salva interi a 64 bit con segno
+    return valore - (1 << 64) if valore >= 1 << 63 else valore
+
+
+class Fingerprint:
+    """Impronta di una foto già inviata: a quale scheda di moderazione appartiene e di chi è."""
+
+    __slots__ = ('file_unique_id', 'hash', 'message_id', 'user_id', 'aggiunta_il')
+
+    def __init__(self, file_unique_id: str, hash: Optional[int], message_id: int, user_id: int,
+                 aggiunta_il: Optional[float] = None):
+        self.file_unique_id = file_unique_id
+        self.hash = hash
+        self.message_id = message_id
+        self.user_id = user_id
+        self.aggiunta_il = time.time() if aggiunta_il is None else aggiunta_il
+
+
+def _da_riga(riga: tuple) -> Fingerprint:
+    file_unique_id, hash, message_id, user_id, aggiunta_il = riga
+    if hash is not None and hash < 0:
+        hash += 1 << 64
+    return Fingerprint(file_unique_id, hash, message_id, user_id, aggiunta_il)
+
+
+class PhotoIndex:
+    """Impronte delle foto degli annunci, per riconoscere le foto già inviate.
+
+    - controllo esatto per `file_unique_id` (la stessa foto inoltrata o reinviata);
+    - vicini per distanza di Hamming tra hash percettivi (la stessa foto ricompressa
+      o ritagliata), con un indice a più tabelle: l'hash è diviso in 4 blocchi e, se
+      due hash distano al massimo `distanza_massima`, almeno un blocco dista al
+      massimo `distanza_massima // 4`. Per ogni blocco si leggono solo le voci a
+      quella distanza, senza scorrere tutte le impronte.
+
+    Con più worker (`modifiche`) ognuno registra le foto dei propri utenti e porta
+    nel proprio indice quelle degli altri con `sincronizza`.
+    """
+
+    def __init__(self, distanza_massima: int = 8, modifiche: Optional[ChangeLog] = None,
+                 scrittore: Optional[SQLiteWriter] = None):
+        self.distanza_massima = distanza_massima
+        self._conn: Optional[sqlite3.Connection] = None
+        self._scrittore_condiviso = scrittore
+        self._scrittore: Optional[SQLiteWriter] = None
+        self._modifiche = modifiche
+        self._per_file: dict[str, Fingerprint] = {}
+        self._per_hash: dict[int, list[str]] = {}
+        self._tabelle: list[dict[int, list[int]]] = [{} for _ in range(_BLOCCHI)]
+        raggio = distanza_massima // _BLOCCHI
+        self._variazioni = [
+            sum(1 << bit for bit in bits)
+            for r in range(raggio + 1) for bits in combinations(range(_BITS_BLOCCO), r)]
+
+    def apri(self, path: str) -> None:
+        """Apre il database e ricostruisce l'indice dalle impronte salvate."""
+        self._conn = apri_database(path)
+        self._scrittore = self._scrittore_condiviso or SQLiteWriter(self._conn)
+        self._conn.executescript(_SCHEMA)
+        for riga in self._conn.execute(f"SELECT {_COLONNE} FROM impronte"):
+            self._indicizza(_da_riga(riga))
+        logger.info(f"Caricate {len(self)} impronte di foto")
+
+    def __len__(self) -> int:
+        return len(self._per_file)
+
+    def _indicizza(self, impronta: Fingerprint) -> None:
+        self._per_file[impronta.file_unique_id] = impronta
+        if impronta.hash is None:
+            return
+        stessi = self._per_hash.get(impronta.hash)
+        if stessi is None:
+            self._per_hash[impronta.hash] = [impronta.file_unique_id]
+            for i, tabella in enumerate(self._tabelle):
+                tabella.setdefault((impronta.hash >> (i * _BITS_BLOCCO)) & _MASCHERA_BLOCCO, []).append(impronta.hash)
+        else:
+            stessi.append(impronta.file_unique_id)
+
+    def _deindicizza(self, impronta: Fingerprint) -> None:
+        del self._per_file[impronta.file_unique_id]
+        if impronta.hash is None:
+            return
+        stessi = self._per_hash[impronta.hash]
+        stessi.remove(impronta.file_unique_id)
+        if stessi:
+            return
+        del self._per_hash[impronta.hash]
+        for i, tabella in enumerate(self._tabelle):
+            chiave = (impronta.hash >> (i * _BITS_BLOCCO)) & _MASCHERA_BLOCCO
+            hashes = tabella[chiave]
+            hashes.remove(impronta.hash)
+            if not hashes:
+                del tabella[chiave]
+
+    def aggiungi(self, impronte: Iterable[Fingerprint]) -> None:
+        """Registra le foto di una scheda; una foto già nota passa alla scheda più recente."""
+        righe = []
+        for impronta in impronte:
+            precedente = self._per_file.get(impronta.file_unique_id)
+            if precedente is not None:
+                self._deindicizza(precedente)
+            self._indicizza(impronta)
+            righe.append((impronta.file_unique_id,
+                          None if impronta.hash is None else _con_segno(impronta.hash),
+                          impronta.message_id, impronta.user_id, impronta.aggiunta_il))
+        if righe and self._conn is not None:
+            self._scrittore.esegui_molti(
+                f"INSERT OR REPLACE INTO impronte ({_COLONNE}) VALUES (?, ?, ?, ?, ?)", righe)
+            if self._modifiche is not None:
+                self._modifiche.annota(_ARCHIVIO, (riga[0] for riga in righe))
+
+    def sincronizza(self) -> int:
+        """Ricarica le impronte registrate dagli altri worker e restituisce quante erano."""
+        if self._modifiche is None or self._conn is None:
+            return 0
+        file_ids = self._modifiche.nuove(_ARCHIVIO)
+        for file_unique_id in file_ids:
+            riga = self._conn.execute(
+                f"SELECT {_COLONNE} FROM impronte WHERE file_unique_id = ?", (file_unique_id,)).fetchone()
+            if file_unique_id in self._per_file:
+                self._deindicizza(self._per_file[file_unique_id])
+            if riga is not None:
+                self._indicizza(_da_riga(riga))
+        return len(file_ids)
+
+    def per_file(self, file_unique_id: str) -> Optional[Fingerprint]:
+        return self._per_file.get(file_unique_id)
+
+    def simili(self, hash: int, distanza: Optional[int] = None) -> list[tuple[int, Fingerprint]]:
+        """Impronte entro `distanza` (di default `distanza_massima`), dalla più vicina."""
+        distanza = self.distanza_massima if distanza is None else min(distanza, self.distanza_massima)
+        candidati = set()
+        for i, tabella in enumerate(self._tabelle):
+            blocco = (hash >> (i * _BITS_BLOCCO)) & _MASCHERA_BLOCCO
+            for variazione in self._variazioni:
+                hashes = tabella.get(blocco ^ variazione)
+                if hashes:
+                    candidati.update(hashes)
+        risultato = []
+        for candidato in candidati:
+            d = (candidato ^ hash).bit_count()
+            if d <= distanza:
+                risultato.extend((d, self._per_file[f]) for f in self._per_hash[candidato])
+        risultato.sort(key=lambda voce: voce[0])
+        return risultato
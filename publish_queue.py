@@ -0,0 +1,225 @@
+import asyncio
+import logging
+import sqlite3
+import time
+from collections import deque
+from datetime import datetime, timedelta
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from ad_record import PendingAd
+from sqlite_persistence import SQLiteWriter, apri_database
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pubblicazioni (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    message_id INTEGER NOT NULL UNIQUE,
+    previsto_il REAL NOT NULL,
+    data BLOB NOT NULL,
+    stato TEXT NOT NULL DEFAULT 'in_coda',
+    motivo TEXT
+);
+"""
+
+# Stati di una pubblicazione: in attesa del turno, in invio (l'esito si conosce solo
+# dopo la risposta della Bot API) e sospesa, in attesa di una decisione dei moderatori
+IN_CODA = 'in_coda'
+IN_INVIO = 'in_invio'
+SOSPESA = 'sospesa'
+INTERROTTA = "pubblicazione interrotta da un riavvio: verificare se l'annuncio è già nel topic"
+
+
+class _Voce:
+    __slots__ = ('ad', 'previsto_il', 'tentativi', 'motivo')
+
+    def __init__(self, ad: PendingAd, previsto_il: float, motivo: Optional[str] = None):
+        self.ad = ad
+        self.previsto_il = previsto_il
+        self.tentativi = 0
+        self.motivo = motivo
+
+
+class PublishQueue:
+    """Annunci approvati in attesa di essere pubblicati nel topic, in ordine di approvazione.
+
+    Le pubblicazioni escono al massimo `per_minuto` al minuto, distanziate in modo
+    uniforme, e mai durante le ore di silenzio (`silenzio`, es. (23, 7) nel fuso
+    `fuso_orario`). All'accodamento ogni annuncio riceve l'orario previsto, che
+    viene comunicato all'utente. La coda è salvata su SQLite e sopravvive ai riavvii.
+
+    Un annuncio che non si riesce a pubblicare viene sospeso (`sospendi`) e non
+    ferma quelli dopo: resta da parte finché i moderatori non lo riprovano o lo
+    scartano. Prima dell'invio l'annuncio è segnato `in_invio`: se il processo si
+    ferma prima della conferma, al riavvio viene sospeso invece di essere
+    ripubblicato, così ogni annuncio esce al massimo una volta.
+    """
+
+    def __init__(self, per_minuto: float = 4, silenzio: Optional[tuple[int, int]] = None,
+                 fuso_orario: str = 'Europe/Rome',
+                 scrittore: Optional[SQLiteWriter] = None):
+        self.intervallo = 60 / per_minuto
+        self.silenzio = silenzio
+        self.fuso_orario = ZoneInfo(fuso_orario)
+        self._conn: Optional[sqlite3.Connection] = None
+        self._scrittore_condiviso = scrittore
+        self._scrittore: Optional[SQLiteWriter] = None
+        self._coda: deque[_Voce] = deque()
+        self._sospese: dict[int, _Voce] = {}
+        # Annunci sospesi all'apertura perché l'invio era in corso: da segnalare ai moderatori
+        self.interrotte: list[PendingAd] = []
+        self.ultimo_rilascio = 0.0
+        self.pubblicate = 0
+        self.errori = 0
+
+    def apri(self, path: str) -> None:
+        """Apre il database e ricarica la coda nell'ordine in cui era stata accodata."""
+        self._conn = apri_database(path)
+        self._scrittore = self._scrittore_condiviso or SQLiteWriter(self._conn)
+        self._conn.executescript(_SCHEMA)
+        colonne = {riga[1] for riga in self._conn.execute("PRAGMA table_info(pubblicazioni)")}
+        if 'stato' not in colonne:
+            # Database creato prima delle pubblicazioni sospese
+            self._conn.execute("ALTER TABLE pubblicazioni ADD COLUMN stato TEXT NOT NULL DEFAULT 'in_coda'")
+            self._conn.execute("ALTER TABLE pubblicazioni ADD COLUMN motivo TEXT")
+        interrotte = {message_id for message_id, in self._conn.execute(
+            "SELECT message_id FROM pubblicazioni WHERE stato = ?", (IN_INVIO,))}
+        self._conn.execute("UPDATE pubblicazioni SET stato = ?, motivo = ? WHERE stato = ?",
+                           (SOSPESA, INTERROTTA, IN_INVIO))
+        self._coda.clear()
+        self._sospese.clear()
+        self.interrotte = []
+        for previsto_il, data, stato, motivo in self._conn.execute(
+                "SELECT previsto_il, data, stato, motivo FROM pubblicazioni ORDER BY seq"):
+            voce = _Voce(PendingAd.from_bytes(data), previsto_il, motivo)
+            if stato == SOSPESA:
+                self._sospese[voce.ad.message_id] = voce
+                if voce.ad.message_id in interrotte:
+                    self.interrotte.append(voce.ad)
+            else:
+                self._coda.append(voce)
+        if self.interrotte:
+            logger.warning(f"{len(self.interrotte)} pubblicazioni interrotte dal riavvio: sospese")
+        logger.info(f"Pubblicazioni in coda: {len(self)}, sospese: {len(self._sospese)}")
+
+    def __len__(self) -> int:
+        return len(self._coda)
+
+    def __contains__(self, message_id: int) -> bool:
+        return any(voce.ad.message_id == message_id for voce in self._coda)
+
+    def in_silenzio(self, istante: float) -> bool:
+        if self.silenzio is None:
+            return False
+        inizio, fine = self.silenzio
+        ora = datetime.fromtimestamp(istante, self.fuso_orario).hour
+        return inizio <= ora < fine if inizio < fine else ora >= inizio or ora < fine
+
+    def _fuori_dal_silenzio(self, istante: float) -> float:
+        """Il primo istante non di silenzio a partire da `istante`."""
+        if not self.in_silenzio(istante):
+            return istante
+        momento = datetime.fromtimestamp(istante, self.fuso_orario)
+        fine = momento.replace(hour=self.silenzio[1], minute=0, second=0, microsecond=0)
+        if fine <= momento:
+            fine += timedelta(days=1)
+        return fine.timestamp()
+
+    def accoda(self, ad: PendingAd, adesso: Optional[float] = None) -> float:
+        """Mette l'annuncio in fondo alla coda e restituisce l'orario previsto di pubblicazione."""
+        adesso = time.time() if adesso is None else adesso
+        base = self.ultimo_rilascio + self.intervallo
+        if self._coda:
+            base = max(base, self._coda[-1].previsto_il + self.intervallo)
+        previsto = self._fuori_dal_silenzio(max(adesso, base))
+        if self._conn is not None:
+            self._scrittore.esegui(
+                "INSERT OR REPLACE INTO pubblicazioni (message_id, previsto_il, data) VALUES (?, ?, ?)",
+                (ad.message_id, previsto, ad.to_bytes()))
+        self._coda.append(_Voce(ad, previsto))
+        return previsto
+
+    def prossima(self, adesso: Optional[float] = None) -> Optional[PendingAd]:
+        """L'annuncio da pubblicare ora, se il suo turno è arrivato; None altrimenti."""
+        adesso = time.time() if adesso is None else adesso
+        if not self._coda or self.in_silenzio(adesso):
+            return None
+        voce = self._coda[0]
+        if voce.previsto_il > adesso or adesso < self.ultimo_rilascio + self.intervallo:
+            return None
+        return voce.ad
+
+    def pubblicata(self, message_id: int, adesso: Optional[float] = None) -> None:
+        """Toglie dalla testa della coda l'annuncio appena pubblicato."""
+        if self._coda and self._coda[0].ad.message_id == message_id:
+            self._coda.popleft()
+        self.ultimo_rilascio = time.time() if adesso is None else adesso
+        self.pubblicate += 1
+        if self._conn is not None:
+            self._scrittore.esegui("DELETE FROM pubblicazioni WHERE message_id = ?", (message_id,))
+
+    async def in_invio(self, message_id: int) -> None:
+        """Segna l'annuncio in testa come in invio, prima di mandarlo alla Bot API.
+
+        A differenza delle altre scritture questa va attesa: il segno deve essere sul
+        database prima dell'invio, altrimenti dopo un arresto l'annuncio uscirebbe due volte.
+        """
+        if self._conn is not None:
+            await asyncio.wrap_future(self._scrittore.esegui(
+                "UPDATE pubblicazioni SET stato = ? WHERE message_id = ?", (IN_INVIO, message_id)))
+
+    def fallita(self, message_id: int) -> int:
+        """Registra un tentativo fallito: l'annuncio resta in testa. Restituisce i tentativi."""
+        self.errori += 1
+        if self._conn is not None:
+            self._scrittore.esegui("UPDATE pubblicazioni SET stato = ? WHERE message_id = ?", (IN_CODA, message_id))
+        if self._coda and self._coda[0].ad.message_id == message_id:
+            self._coda[0].tentativi += 1
+            return self._coda[0].tentativi
+        return 0
+
+    def sospendi(self, message_id: int, motivo: str) -> None:
+        """Toglie l'annuncio dalla coda e lo mette da parte: le pubblicazioni dopo proseguono."""
+        voce = next((voce for voce in self._coda if voce.ad.message_id == message_id), None)
+        if voce is None:
+            return
+        self._coda.remove(voce)
+        voce.motivo = motivo
+        self._sospese[message_id] = voce
+        if self._conn is not None:
+            self._scrittore.esegui("UPDATE pubblicazioni SET stato = ?, motivo = ? WHERE message_id = ?",
+                                   (SOSPESA, motivo, message_id))
+
+    def sospese(self) -> list[tuple[PendingAd, str]]:
+        return [(voce.ad, voce.motivo) for voce in self._sospese.values()]
+
+    def riprova(self, message_id: int, adesso: Optional[float] = None) -> Optional[float]:
+        """Rimette in fondo alla coda un annuncio sospeso; None se non è (più) sospeso."""
+        voce = self._sospese.pop(message_id, None)
+        if voce is None:
+            return None
+        return self.accoda(voce.ad, adesso)
+
+    def scarta(self, message_id: int) -> Optional[PendingAd]:
+        """Elimina un annuncio sospeso senza pubblicarlo; None se non è (più) sospeso."""
+        voce = self._sospese.pop(message_id, None)
+        if voce is None:
+            return None
+        if self._conn is not None:
+            self._scrittore.esegui("DELETE FROM pubblicazioni WHERE message_id = ?", (message_id,))
+        return voce.ad
+
+    def statistiche(self, adesso: Optional[float] = None) -> dict:
+        adesso = time.time() if adesso is None else adesso
+        testa = self._coda[0] if self._coda else None
+        return {
+            'in_coda': len(self._coda),
+            'prossima_prevista': testa.previsto_il if testa else None,
+            'ritardo': max(0.0, adesso - testa.previsto_il) if testa else 0.0,
+            'ultima_prevista': self._coda[-1].previsto_il if self._coda else None,
+            'in_silenzio': self.in_silenzio(adesso),
+            'sospese': len(self._sospese),
+            'pubblicate': self.pubblicate,
+            'errori': self.errori,
+        }
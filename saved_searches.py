@@ -0,0 +1,215 @@
+import asyncio
+import bisect
+import logging
+import sqlite3
+import time
+from typing import Iterable, Optional
+
+from catalog import Ricerca, interpreta_ricerca, parole
+from sqlite_persistence import ChangeLog, SQLiteWriter, apri_database
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS avvisi (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    testo TEXT NOT NULL,
+    creato_il REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS avvisi_user_id ON avvisi (user_id);
+"""
+_ARCHIVIO = 'avvisi'
+
+
+class SavedSearch:
+    """Ricerca salvata da un utente con /avvisami, già interpretata."""
+
+    __slots__ = ('id', 'user_id', 'testo', 'ricerca', 'creato_il')
+
+    def __init__(self, id: int, user_id: int, testo: str, creato_il: Optional[float] = None):
+        self.id = id
+        self.user_id = user_id
+        self.testo = testo
+        self.ricerca: Ricerca = interpreta_ricerca(testo)
+        self.creato_il = time.time() if creato_il is None else creato_il
+
+    def vuota(self) -> bool:
+        r = self.ricerca
+        return not (r.parole or r.localita or r.prezzo_min is not None or r.prezzo_max is not None)
+
+    def corrisponde(self, parole_testo: set[str], parole_localita: set[str], prezzo) -> bool:
+        """Verifica completa: ogni parola è prefisso di una parola dell'annuncio, prezzo nei limiti."""
+        r = self.ricerca
+        if r.prezzo_min is not None or r.prezzo_max is not None:
+            if prezzo is None:
+                return False
+            if r.prezzo_min is not None and prezzo < r.prezzo_min:
+                return False
+            if r.prezzo_max is not None and prezzo > r.prezzo_max:
+                return False
+        return (all(any(p.startswith(t) for p in parole_testo) for t in r.parole)
+                and all(any(p.startswith(t) for p in parole_localita) for t in r.localita))
+
+
+def _prefissi(parole_annuncio: Iterable[str]) -> set[str]:
+    return {parola[:i] for parola in parole_annuncio for i in range(1, len(parola) + 1)}
+
+
+class SavedSearches:
+    """Ricerche salvate, indicizzate per trovare in un colpo solo quelle che un annuncio soddisfa.
+
+    Ogni ricerca viene agganciata a un solo termine, il più lungo (quindi il più
+    selettivo): una parola libera oppure, se non ce ne sono, una località. Gli
+    agganci stanno in un dict prefisso -> ricerche; per un annuncio nuovo si
+    generano i prefissi delle sue parole e si leggono solo quelle voci, così il
+    costo dipende dalla lunghezza dell'annuncio e non dal numero di ricerche. Le
+    ricerche con il solo filtro di prezzo sono ordinate per prezzo massimo.
+    I candidati trovati passano poi per la verifica completa.
+
+    Con più worker (`modifiche`) le ricerche si salvano nel worker dell'utente e si
+    confrontano con gli annunci in quello che pubblica: `sincronizza` porta negli
+    indici le ricerche aggiunte ed eliminate dagli altri processi.
+    """
+
+    def __init__(self, max_per_utente: int = 10, modifiche: Optional[ChangeLog] = None,
+                 scrittore: Optional[SQLiteWriter] = None):
+        self.max_per_utente = max_per_utente
+        self._conn: Optional[sqlite3.Connection] = None
+        self._scrittore_condiviso = scrittore
+        self._scrittore: Optional[SQLiteWriter] = None
+        self._modifiche = modifiche
+        self._per_id: dict[int, SavedSearch] = {}
+        self._per_utente: dict[int, dict[int, None]] = {}
+        self._per_parola: dict[str, dict[int, SavedSearch]] = {}
+        self._per_localita: dict[str, dict[int, SavedSearch]] = {}
+        self._solo_prezzo: list[tuple[float, int]] = []
+        self._prossimo_id = 1
+
+    def apri(self, path: str) -> None:
+        """Apre il database e ricostruisce gli indici dalle ricerche salvate."""
+        self._conn = apri_database(path)
+        self._scrittore = self._scrittore_condiviso or SQLiteWriter(self._conn)
+        self._conn.executescript(_SCHEMA)
+        for riga in self._conn.execute("SELECT id, user_id, testo, creato_il FROM avvisi ORDER BY id"):
+            self._indicizza(SavedSearch(*riga))
+        logger.info(f"Caricate {len(self)} ricerche salvate")
+
+    def __len__(self) -> int:
+        return len(self._per_id)
+
+    def _aggancio(self, ricerca: SavedSearch) -> tuple[Optional[dict], Optional[str]]:
+        if ricerca.ricerca.parole:
+            return self._per_parola, max(ricerca.ricerca.parole, key=len)
+        if ricerca.ricerca.localita:
+            return self._per_localita, max(ricerca.ricerca.localita, key=len)
+        return None, None
+
+    def _indicizza(self, ricerca: SavedSearch) -> None:
+        self._per_id[ricerca.id] = ricerca
+        self._per_utente.setdefault(ricerca.user_id, {})[ricerca.id] = None
+        self._prossimo_id = max(self._prossimo_id, ricerca.id + 1)
+        indice, termine = self._aggancio(ricerca)
+        if indice is not None:
+            indice.setdefault(termine, {})[ricerca.id] = ricerca
+        else:
+            massimo = ricerca.ricerca.prezzo_max
+            bisect.insort(self._solo_prezzo, (float('inf') if massimo is None else massimo, ricerca.id))
+
+    def _deindicizza(self, ricerca: SavedSearch) -> None:
+        del self._per_id[ricerca.id]
+        ricerche_utente = self._per_utente[ricerca.user_id]
+        del ricerche_utente[ricerca.id]
+        if not ricerche_utente:
+            del self._per_utente[ricerca.user_id]
+        indice, termine = self._aggancio(ricerca)
+        if indice is not None:
+            agganciate = indice[termine]
+            del agganciate[ricerca.id]
+            if not agganciate:
+                del indice[termine]
+        else:
+            massimo = ricerca.ricerca.prezzo_max
+            voce = (float('inf') if massimo is None else massimo, ricerca.id)
+            i = bisect.bisect_left(self._solo_prezzo, voce)
+            if i < len(self._solo_prezzo) and self._solo_prezzo[i] == voce:
+                del self._solo_prezzo[i]
+
+    def per_utente(self, user_id: int) -> list[SavedSearch]:
+        return [self._per_id[id] for id in self._per_utente.get(user_id, ())]
+
+    async def aggiungi(self, user_id: int, testo: str) -> SavedSearch:
+        """Salva una ricerca. ValueError se è vuota o se l'utente ha raggiunto il limite.
+
+        Con il database attende la scrittura, che assegna l'id della ricerca.
+        """
+        ricerca = SavedSearch(self._prossimo_id, user_id, testo.strip())
+        if ricerca.vuota():
+            raise ValueError("ricerca vuota")
+        if len(self._per_utente.get(user_id, ())) >= self.max_per_utente:
+            raise ValueError("troppe ricerche salvate")
+        if self._conn is not None:
+            ricerca.id = await asyncio.wrap_future(self._scrittore.esegui(
+                "INSERT INTO avvisi (user_id, testo, creato_il) VALUES (?, ?, ?)",
+                (user_id, ricerca.testo, ricerca.creato_il)))
+            if self._modifiche is not None:
+                self._modifiche.annota(_ARCHIVIO, (ricerca.id,))
+        self._indicizza(ricerca)
+        return ricerca
+
+    def rimuovi(self, id: int, user_id: Optional[int] = None) -> Optional[SavedSearch]:
+        """Elimina una ricerca; con `user_id` solo se appartiene a quell'utente."""
+        ricerca = self._per_id.get(id)
+        if ricerca is None or (user_id is not None and ricerca.user_id != user_id):
+            return None
+        self._deindicizza(ricerca)
+        if self._conn is not None:
+            self._scrittore.esegui("DELETE FROM avvisi WHERE id = ?", (id,))
+            if self._modifiche is not None:
+                self._modifiche.annota(_ARCHIVIO, (id,))
+        return ricerca
+
+    def rimuovi_utente(self, user_id: int) -> int:
+        """Elimina tutte le ricerche di un utente (es. ha bloccato il bot)."""
+        ricerche = self.per_utente(user_id)
+        for ricerca in ricerche:
+            self._deindicizza(ricerca)
+        if ricerche and self._conn is not None:
+            self._scrittore.esegui("DELETE FROM avvisi WHERE user_id = ?", (user_id,))
+            if self._modifiche is not None:
+                self._modifiche.annota(_ARCHIVIO, (ricerca.id for ricerca in ricerche))
+        return len(ricerche)
+
+    def sincronizza(self) -> int:
+        """Ricarica le ricerche aggiunte o eliminate dagli altri worker e restituisce quante erano."""
+        if self._modifiche is None or self._conn is None:
+            return 0
+        ids = self._modifiche.nuove(_ARCHIVIO)
+        for id in ids:
+            riga = self._conn.execute(
+                "SELECT id, user_id, testo, creato_il FROM avvisi WHERE id = ?", (id,)).fetchone()
+            if id in self._per_id:
+                self._deindicizza(self._per_id[id])
+            if riga is not None:
+                self._indicizza(SavedSearch(*riga))
+        return len(ids)
+
+    def corrispondenze(self, titolo: str, descrizione: str, localita: str, prezzo) -> dict[int, list[SavedSearch]]:
+        """Ricerche soddisfatte da un annuncio, raggruppate per utente."""
+        parole_localita = parole(localita)
+        parole_testo = parole(f"{titolo} {descrizione}") | parole_localita
+        candidati: dict[int, SavedSearch] = {}
+        for indice, parole_annuncio in ((self._per_parola, parole_testo),
+                                        (self._per_localita, parole_localita)):
+            for prefisso in _prefissi(parole_annuncio):
+                agganciate = indice.get(prefisso)
+                if agganciate:
+                    candidati.update(agganciate)
+        if prezzo is not None:
+            for _, id in self._solo_prezzo[bisect.bisect_left(self._solo_prezzo, (prezzo, -1)):]:
+                candidati[id] = self._per_id[id]
+        risultato: dict[int, list[SavedSearch]] = {}
+        for ricerca in candidati.values():
+            if ricerca.corrisponde(parole_testo, parole_localita, prezzo):
+                risultato.setdefault(ricerca.user_id, []).append(ricerca)
+        return risultato
@@ -0,0 +1,257 @@
+import asyncio
+import contextvars
+import heapq
+import logging
+import time
+from collections import deque
+from datetime import timedelta
+from itertools import count
+from typing import Any, Awaitable, Callable, Optional
+
+from telegram.error import NetworkError, RetryAfter, TimedOut
+
+logger = logging.getLogger(__name__)
+
+# Classi di priorità: un numero più basso esce prima
+PRIORITA_MODERAZIONE = 0   # schede e modifiche nell'interfaccia dei moderatori
+PRIORITA_UTENTE = 1        # notifiche agli utenti
+PRIORITA_PUBBLICAZIONE = 2  # post pubblici nel topic
+PRIORITA_AVVISI = 3        # avvisi delle ricerche salvate, possono aspettare
+NOMI_PRIORITA = {PRIORITA_MODERAZIONE: 'moderazione', PRIORITA_UTENTE: 'utente',
+                 PRIORITA_PUBBLICAZIONE: 'pubblicazione', PRIORITA_AVVISI: 'avvisi'}
+
+
+class TokenBucket:
+    """Secchiello di gettoni: `rate` gettoni al secondo, al massimo `capacity` accumulati.
+
+    Un invio può costare più gettoni (un album da 10 foto ne costa 10): il saldo può
+    andare in negativo e gli invii successivi aspettano di ripagare il debito.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'aggiornato', 'bloccato_fino')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.aggiornato = time.monotonic()
+        self.bloccato_fino = 0.0
+
+    def _ricarica(self, adesso: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (adesso - self.aggiornato) * self.rate)
+        self.aggiornato = adesso
+
+    def attesa(self, adesso: float) -> float:
+        """Secondi mancanti prima che sia disponibile almeno un gettone."""
+        self._ricarica(adesso)
+        mancanti = 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+        return max(mancanti, self.bloccato_fino - adesso)
+
+    def consuma(self, costo: float) -> None:
+        self.tokens -= costo
+
+    def blocca(self, secondi: float, adesso: float) -> None:
+        self.bloccato_fino = max(self.bloccato_fino, adesso + secondi)
+
+
+class _Invio:
+    __slots__ = ('priorita', 'seq', 'chat_id', 'costo', 'funzione', 'args', 'kwargs',
+                 'future', 'accodato', 'tentativi', 'contesto')
+
+    def __init__(self, priorita, seq, chat_id, costo, funzione, args, kwargs, future):
+        self.priorita = priorita
+        self.seq = seq
+        self.chat_id = chat_id
+        self.costo = costo
+        self.funzione = funzione
+        self.args = args
+        self.kwargs = kwargs
+        self.future = future
+        self.accodato = time.monotonic()
+        self.tentativi = 0
+        # Le variabili di contesto di chi ha accodato (es. la traccia dell'aggiornamento)
+        self.contesto = contextvars.copy_context()
+
+    def __lt__(self, altro: '_Invio') -> bool:
+        return (self.priorita, self.seq) < (altro.priorita, altro.seq)
+
+
+class SendScheduler:
+    """Coordina tutte le chiamate in uscita verso la Bot API.
+
+    Ogni invio passa da un secchiello globale e da uno per chat di destinazione
+    (più lento per i gruppi, come i limiti di Telegram). Tra gli invii pronti esce
+    prima quello con priorità più alta; per ogni chat c'è al massimo un invio in volo,
+    così l'ordine dei messaggi verso la stessa chat è preservato. Un `RetryAfter`
+    blocca la chat per il tempo indicato e rimette l'invio in coda nella stessa
+    posizione; gli errori di rete vengono ritentati con attesa crescente.
+    """
+
+    def __init__(self, global_rate: float = 30, global_burst: float = 30,
+                 chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate: float = 20 / 60, group_burst: float = 5,
+                 max_tentativi: int = 5):
+        self._globale = TokenBucket(global_rate, global_burst)
+        self._parametri_chat = (chat_rate, chat_burst)
+        self._parametri_gruppo = (group_rate, group_burst)
+        self._chat: dict[Any, TokenBucket] = {}
+        self._max_tentativi = max_tentativi
+        self._coda: list[_Invio] = []
+        self._in_volo: set = set()
+        self._seq = count()
+        self._risveglio = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._invii_attivi: set[asyncio.Task] = set()
+        self._attese: deque[float] = deque(maxlen=1000)
+        self.inviati = 0
+        self.ritentati = 0
+        self.falliti = 0
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._ciclo(), name='send-scheduler')
+
+    async def stop(self, timeout: Optional[float] = None) -> None:
+        """Attende gli invii in coda e in volo (al massimo `timeout` secondi), poi si ferma."""
+        inizio = time.monotonic()
+        while self._coda or self._invii_attivi:
+            if timeout is not None and time.monotonic() - inizio > timeout:
+                logger.warning(f"Invii non completati alla chiusura: {len(self._coda)} in coda")
+                break
+            await asyncio.sleep(0.05)
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chat.get(chat_id)
+        if bucket is None:
+            if len(self._chat) >= 10000:
+                self._pota_bucket()
+            gruppo = isinstance(chat_id, int) and chat_id < 0
+            bucket = TokenBucket(*(self._parametri_gruppo if gruppo else self._parametri_chat))
+            self._chat[chat_id] = bucket
+        return bucket
+
+    def _pota_bucket(self) -> None:
+        """Dimentica i secchielli delle chat inattive: pieni equivalgono a secchielli nuovi."""
+        adesso = time.monotonic()
+        for chat_id in [c for c, b in self._chat.items()
+                        if c not in self._in_volo and b.attesa(adesso) == 0 and b.tokens >= b.capacity]:
+            del self._chat[chat_id]
+
+    async def invia(self, destinazione, priorita: int, funzione: Callable[..., Awaitable], /,
+                    *args, costo: float = 1, **kwargs) -> Any:
+        """Accoda `funzione(*args, **kwargs)` verso la chat `destinazione` e ne restituisce il risultato."""
+        if self._task is None:
+            # Scheduler non avviato (es. script e benchmark): invio diretto
+            return await funzione(*args, **kwargs)
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._coda, _Invio(priorita, next(self._seq), destinazione, costo,
+                                          funzione, args, kwargs, future))
+        self._risveglio.set()
+        return await future
+
+    async def _ciclo(self) -> None:
+        while True:
+            self._risveglio.clear()
+            attesa = self._distribuisci()
+            if attesa is None:
+                await self._risveglio.wait()
+            else:
+                try:
+                    await asyncio.wait_for(self._risveglio.wait(), timeout=attesa)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _distribuisci(self) -> Optional[float]:
+        """Avvia gli invii pronti; restituisce quanto attendere prima di riprovare."""
+        rimandati = []
+        prossima = None
+        adesso = time.monotonic()
+        while self._coda:
+            attesa_globale = self._globale.attesa(adesso)
+            if attesa_globale > 0:
+                prossima = attesa_globale
+                break
+            invio = heapq.heappop(self._coda)
+            if invio.future.done():
+                continue
+            if invio.chat_id in self._in_volo:
+                rimandati.append(invio)
+                continue
+            bucket = self._bucket(invio.chat_id)
+            attesa = bucket.attesa(adesso)
+            if attesa > 0:
+                rimandati.append(invio)
+                prossima = attesa if prossima is None else min(prossima, attesa)
+                continue
+            bucket.consuma(invio.costo)
+            self._globale.consuma(invio.costo)
+            self._in_volo.add(invio.chat_id)
+            self._attese.append(adesso - invio.accodato)
+            task = asyncio.create_task(self._esegui(invio), context=invio.contesto)
+            self._invii_attivi.add(task)
+            task.add_done_callback(self._invii_attivi.discard)
+        for invio in rimandati:
+            heapq.heappush(self._coda, invio)
+        return prossima
+
+    async def _esegui(self, invio: _Invio) -> None:
+        try:
+            risultato = await invio.funzione(*invio.args, **invio.kwargs)
+        except RetryAfter as e:
+            secondi = e.retry_after
+            if isinstance(secondi, timedelta):
+                secondi = secondi.total_seconds()
+            self._bucket(invio.chat_id).blocca(secondi, time.monotonic())
+            self._ritenta(invio, e, f"RetryAfter {secondi}s")
+        except TimedOut as e:
+            # Esito incerto: la richiesta potrebbe essere arrivata, quindi niente ritentativi
+            self._fallito(invio, e)
+        except NetworkError as e:
+            self._bucket(invio.chat_id).blocca(min(2 ** invio.tentativi, 30), time.monotonic())
+            self._ritenta(invio, e, str(e))
+        except Exception as e:
+            self._fallito(invio, e)
+        else:
+            self.inviati += 1
+            if not invio.future.done():
+                invio.future.set_result(risultato)
+        finally:
+            self._in_volo.discard(invio.chat_id)
+            self._risveglio.set()
+
+    def _fallito(self, invio: _Invio, errore: Exception) -> None:
+        self.falliti += 1
+        if not invio.future.done():
+            invio.future.set_exception(errore)
+
+    def _ritenta(self, invio: _Invio, errore: Exception, motivo: str) -> None:
+        invio.tentativi += 1
+        if invio.tentativi > self._max_tentativi:
+            logger.error(f"Invio verso {invio.chat_id} abbandonato dopo {invio.tentativi} tentativi: {motivo}")
+            self._fallito(invio, errore)
+            return
+        self.ritentati += 1
+        logger.warning(f"Invio verso {invio.chat_id} rimesso in coda ({motivo})")
+        heapq.heappush(self._coda, invio)
+
+    def statistiche(self) -> dict:
+        """Profondità della coda per priorità e tempi di attesa recenti."""
+        per_priorita = {nome: 0 for nome in NOMI_PRIORITA.values()}
+        for invio in self._coda:
+            nome = NOMI_PRIORITA.get(invio.priorita, str(invio.priorita))
+            per_priorita[nome] = per_priorita.get(nome, 0) + 1
+        attese = sorted(self._attese)
+        return {
+            'in_coda': len(self._coda),
+            'in_coda_per_priorita': per_priorita,
+            'in_volo': len(self._invii_attivi),
+            'attesa_p50': attese[len(attese) // 2] if attese else 0.0,
+            'attesa_p99': attese[int(len(attese) * 0.99)] if attese else 0.0,
+            'attesa_max': attese[-1] if attese else 0.0,
+            'inviati': self.inviati,
+            'ritentati': self.ritentati,
+            'falliti': self.falliti,
+        }
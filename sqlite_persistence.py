@@ -0,0 +1,435 @@
+import asyncio
+import json
+import logging
+import os
+import pickle
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Iterable, Optional
+
+from telegram.ext import BasePersistence, PersistenceInput
+from telegram.ext._utils.types import ConversationDict, ConversationKey
+
+logger = logging.getLogger(__name__)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL,
+    key TEXT NOT NULL,
+    state BLOB NOT NULL,
+    PRIMARY KEY (name, key)
+);
+CREATE TABLE IF NOT EXISTS callback_data (id INTEGER PRIMARY KEY CHECK (id = 0), data BLOB NOT NULL);
+"""
+
+_SCHEMA_MODIFICHE = """
+CREATE TABLE IF NOT EXISTS modifiche (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    archivio TEXT NOT NULL,
+    chiave NOT NULL,
+    pid INTEGER NOT NULL,
+    il REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS modifiche_archivio ON modifiche (archivio, seq);
+CREATE INDEX IF NOT EXISTS modifiche_il ON modifiche (il);
+"""
+
+
+def _dumps(obj: Any) -> bytes:
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def apri_database(path: str) -> sqlite3.Connection:
+    """Apre il file SQLite in modalità WAL, condivisibile tra thread."""
+    conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA busy_timeout=5000")
+    return conn
+
+
+class SQLiteWriter:
+    """Scrittore unico degli archivi: esegue le loro scritture in un thread dedicato.
+
+    Gli archivi aggiornano gli indici in memoria sul loop e passano qui le istruzioni
+    SQL; il thread le esegue nell'ordine di arrivo, raccogliendo quelle già in coda in
+    un'unica transazione. Il loop non aspetta così il lock di scrittura di SQLite
+    (fino a busy_timeout) mentre il flush della persistenza ha una transazione aperta.
+    Ogni istruzione restituisce un Future con il `lastrowid`: chi deve sapere che la
+    scrittura è sul disco (o leggerne l'id) lo attende con `asyncio.wrap_future`.
+
+    Senza `apri` (archivi usati da soli, es. nei benchmark) le istruzioni vengono
+    eseguite subito sulla connessione passata al costruttore.
+    """
+
+    def __init__(self, conn: Optional[sqlite3.Connection] = None):
+        self._conn = conn
+        self._coda: Optional[queue.SimpleQueue] = None
+        self._thread: Optional[threading.Thread] = None
+        self.transazioni = 0
+        self.errori = 0
+
+    def apri(self, path: str) -> None:
+        self._conn = apri_database(path)
+        self._coda = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._esegui_coda, name='scrittore-archivi', daemon=True)
+        self._thread.start()
+
+    def esegui(self, sql: str, parametri: tuple = ()) -> Future:
+        return self._accoda(sql, parametri, False)
+
+    def esegui_molti(self, sql: str, righe: Iterable) -> Future:
+        return self._accoda(sql, list(righe), True)
+
+    def _accoda(self, sql: str, parametri, molti: bool) -> Future:
+        futuro = Future()
+        if self._coda is None:
+            self._completa(futuro, sql, parametri, molti)
+        else:
+            self._coda.put((futuro, sql, parametri, molti))
+        return futuro
+
+    def _completa(self, futuro: Future, sql: str, parametri, molti: bool) -> None:
+        try:
+            cursore = self._conn.executemany(sql, parametri) if molti else self._conn.execute(sql, parametri)
+        except Exception as e:
+            self.errori += 1
+            logger.error(f"Scrittura degli archivi non riuscita ({sql.split(None, 1)[0]}): {e}")
+            futuro.set_exception(e)
+        else:
+            futuro.set_result(cursore.lastrowid)
+
+    def _esegui_coda(self) -> None:
+        while True:
+            voci = [self._coda.get()]
+            while True:
+                try:
+                    voci.append(self._coda.get_nowait())
+                except queue.Empty:
+                    break
+            fine = None in voci
+            voci = [voce for voce in voci if voce is not None]
+            if len(voci) == 1:
+                self._completa(*voci[0])
+            elif voci:
+                self._applica(voci)
+            if fine:
+                return
+
+    def _applica(self, voci: list) -> None:
+        cur = self._conn.cursor()
+        try:
+            cur.execute("BEGIN")
+            risultati = []
+            for _, sql, parametri, molti in voci:
+                (cur.executemany if molti else cur.execute)(sql, parametri)
+                risultati.append(cur.lastrowid)
+            cur.execute("COMMIT")
+        except Exception as e:
+            if self._conn.in_transaction:
+                cur.execute("ROLLBACK")
+            # Un'istruzione non valida non deve far perdere le altre del blocco
+            logger.warning(f"Blocco di {len(voci)} scritture non riuscito ({e}), le riprovo una alla volta")
+            for voce in voci:
+                self._completa(*voce)
+            return
+        self.transazioni += 1
+        for (futuro, *_), risultato in zip(voci, risultati):
+            futuro.set_result(risultato)
+
+    def chiudi(self) -> None:
+        """Esegue le scritture ancora in coda e ferma il thread (bloccante)."""
+        if self._thread is not None:
+            self._coda.put(None)
+            self._thread.join()
+            self._thread = None
+            self._coda = None
+
+
+class ChangeLog:
+    """Registro delle modifiche agli archivi condivisi tra più processi sullo stesso database.
+
+    Gli archivi (moderazioni, catalogo, ricerche, impronte) tengono gli indici in
+    memoria e scrivono su SQLite. Con più worker ogni scrittura annota anche la
+    chiave modificata; gli altri processi leggono le annotazioni nuove e ricaricano
+    solo quelle voci dalla tabella, che resta la fonte di verità (cancellazioni
+    comprese: una chiave che non c'è più va tolta dagli indici).
+
+    Il punto di partenza si fissa in `apri`, prima che gli archivi carichino le
+    tabelle: una modifica arrivata durante il caricamento viene riletta, mai persa.
+    Le annotazioni passano per lo stesso `scrittore` degli archivi, dopo la scrittura
+    della voce a cui si riferiscono.
+    """
+
+    def __init__(self, scrittore: Optional[SQLiteWriter] = None):
+        self._conn: Optional[sqlite3.Connection] = None
+        self._scrittore = scrittore
+        self._inizio = 0
+        self._ultimo: dict[str, int] = {}
+        self._pid = os.getpid()
+
+    def apri(self, path: str) -> None:
+        self._conn = apri_database(path)
+        self._conn.executescript(_SCHEMA_MODIFICHE)
+        self._inizio = self._conn.execute("SELECT COALESCE(MAX(seq), 0) FROM modifiche").fetchone()[0]
+        if self._scrittore is None:
+            self._scrittore = SQLiteWriter(self._conn)
+
+    def annota(self, archivio: str, chiavi: Iterable) -> None:
+        adesso = time.time()
+        self._scrittore.esegui_molti(
+            "INSERT INTO modifiche (archivio, chiave, pid, il) VALUES (?, ?, ?, ?)",
+            [(archivio, chiave, self._pid, adesso) for chiave in chiavi])
+
+    def nuove(self, archivio: str) -> list:
+        """Chiavi di `archivio` modificate dagli altri processi dall'ultima lettura, senza ripetizioni."""
+        righe = self._conn.execute(
+            "SELECT seq, chiave FROM modifiche WHERE archivio = ? AND seq > ? AND pid != ? ORDER BY seq",
+            (archivio, self._ultimo.get(archivio, self._inizio), self._pid)).fetchall()
+        if not righe:
+            return []
+        self._ultimo[archivio] = righe[-1][0]
+        return list(dict.fromkeys(chiave for _, chiave in righe))
+
+    async def pota(self, eta: float) -> int:
+        """Elimina le annotazioni più vecchie di `eta` secondi, ormai lette da tutti."""
+        limite = time.time() - eta
+        vecchie = self._conn.execute("SELECT COUNT(*) FROM modifiche WHERE il < ?", (limite,)).fetchone()[0]
+        if vecchie:
+            await asyncio.wrap_future(self._scrittore.esegui("DELETE FROM modifiche WHERE il < ?", (limite,)))
+        return vecchie
+
+
+class SQLitePersistence(BasePersistence):
+    """Persistenza su file SQLite con scrittura differita a blocchi.
+
+    - `user_data` e `chat_data` non vengono letti all'avvio: ogni voce viene caricata
+      da `refresh_user_data`/`refresh_chat_data` la prima volta che l'utente o la chat
+      si fanno vivi, così un avvio a freddo non deserializza tutto lo storico.
+    - Le modifiche vengono solo annotate in memoria e scritte in un'unica transazione
+      ogni `flush_interval` secondi (o su `flush()` alla chiusura). Più modifiche alla
+      stessa voce nel frattempo si riducono a una sola scrittura.
+    """
+
+    def __init__(self, path: str, store_data: Optional[PersistenceInput] = None,
+                 update_interval: float = 10, flush_interval: float = 2.0):
+        super().__init__(store_data=store_data, update_interval=update_interval)
+        self.path = path
+        self.flush_interval = flush_interval
+        self._conn = apri_database(path)
+        self._conn.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        # Connessione separata per le letture puntuali dal loop: in WAL non aspetta mai
+        # la transazione di scrittura in corso nel thread del flush
+        self._lettura = apri_database(path)
+        self._bot_data: Optional[dict] = None
+        self._bot_data_scritto: dict[str, bytes] = {}
+        self._conversations: dict[str, ConversationDict] = {}
+        # Voci già caricate in memoria dall'Application
+        self._user_caricati: set[int] = set()
+        self._chat_caricate: set[int] = set()
+        # Scritture in attesa: chiave -> valore da scrivere, oppure None per cancellare.
+        # L'Application passa già copie profonde, quindi la serializzazione può avvenire
+        # nel thread del flush invece che sul loop.
+        self._user_sporchi: dict[int, Optional[Any]] = {}
+        self._chat_sporche: dict[int, Optional[Any]] = {}
+        self._bot_sporchi: dict[str, Optional[bytes]] = {}
+        self._conv_sporche: dict[tuple[str, str], Optional[Any]] = {}
+        self._callback_sporco: Optional[Any] = None
+        self._flush_task: Optional[asyncio.Task] = None
+        self._in_scrittura = False
+
+    # --- Lettura ---
+
+    def _leggi(self, query: str, params: tuple = ()) -> list:
+        with self._lock:
+            return self._conn.execute(query, params).fetchall()
+
+    async def get_user_data(self) -> dict[int, Any]:
+        return {}
+
+    async def get_chat_data(self) -> dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> dict:
+        if self._bot_data is None:
+            righe = self._leggi("SELECT key, data FROM bot_data")
+            self._bot_data_scritto = {key: bytes(data) for key, data in righe}
+            self._bot_data = {key: pickle.loads(data) for key, data in righe}
+        return self._bot_data
+
+    async def get_callback_data(self) -> Optional[Any]:
+        righe = self._leggi("SELECT data FROM callback_data WHERE id = 0")
+        return pickle.loads(righe[0][0]) if righe else None
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        if name not in self._conversations:
+            righe = self._leggi("SELECT key, state FROM conversations WHERE name = ?", (name,))
+            self._conversations[name] = {
+                tuple(json.loads(key)): pickle.loads(state) for key, state in righe
+            }
+        return self._conversations[name].copy()
+
+    def stati_conversazione(self, name: str) -> list:
+        """Stati delle conversazioni `name` in corso, come risultano dall'ultimo aggiornamento."""
+        return list(self._conversations.get(name, {}).values())
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._user_caricati:
+            return
+        self._user_caricati.add(user_id)
+        if user_id in self._user_sporchi:
+            return
+        righe = self._lettura.execute("SELECT data FROM user_data WHERE id = ?", (user_id,)).fetchall()
+        if righe:
+            # Eventuali chiavi scritte prima del caricamento hanno la precedenza
+            for key, value in pickle.loads(righe[0][0]).items():
+                user_data.setdefault(key, value)
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None:
+        if chat_id in self._chat_caricate:
+            return
+        self._chat_caricate.add(chat_id)
+        if chat_id in self._chat_sporche:
+            return
+        righe = self._lettura.execute("SELECT data FROM chat_data WHERE id = ?", (chat_id,)).fetchall()
+        if righe:
+            for key, value in pickle.loads(righe[0][0]).items():
+                chat_data.setdefault(key, value)
+
+    async def refresh_bot_data(self, bot_data: dict) -> None:
+        pass
+
+    # --- Scrittura differita ---
+
+    def _programma_flush(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_ritardato())
+
+    async def _flush_ritardato(self) -> None:
+        await asyncio.sleep(self.flush_interval)
+        await self._scrivi()
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        self._user_caricati.add(user_id)
+        self._user_sporchi[user_id] = data
+        self._programma_flush()
+
+    async def update_chat_data(self, chat_id: int, data: dict) -> None:
+        self._chat_caricate.add(chat_id)
+        self._chat_sporche[chat_id] = data
+        self._programma_flush()
+
+    async def update_bot_data(self, data: dict) -> None:
+        self._bot_data = data
+        for key, value in data.items():
+            serializzato = _dumps(value)
+            if self._bot_data_scritto.get(key) != serializzato:
+                self._bot_data_scritto[key] = serializzato
+                self._bot_sporchi[key] = serializzato
+        for key in set(self._bot_data_scritto) - set(data):
+            del self._bot_data_scritto[key]
+            self._bot_sporchi[key] = None
+        if self._bot_sporchi:
+            self._programma_flush()
+
+    async def update_callback_data(self, data: Any) -> None:
+        self._callback_sporco = data
+        self._programma_flush()
+
+    async def update_conversation(self, name: str, key: ConversationKey,
+                                  new_state: Optional[object]) -> None:
+        conversazioni = self._conversations.setdefault(name, {})
+        if new_state is None:
+            if conversazioni.pop(key, None) is None:
+                return
+        elif conversazioni.get(key) == new_state:
+            return
+        else:
+            conversazioni[key] = new_state
+        self._conv_sporche[(name, json.dumps(list(key)))] = new_state
+        self._programma_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._user_caricati.discard(user_id)
+        self._user_sporchi[user_id] = None
+        self._programma_flush()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._chat_caricate.discard(chat_id)
+        self._chat_sporche[chat_id] = None
+        self._programma_flush()
+
+    def _applica(self, user: dict, chat: dict, bot: dict, conv: dict,
+                 callback: Optional[Any]) -> None:
+        with self._lock:
+            cur = self._conn.cursor()
+            cur.execute("BEGIN")
+            try:
+                for tabella, sporchi in (("user_data", user), ("chat_data", chat)):
+                    cur.executemany(
+                        f"INSERT OR REPLACE INTO {tabella} (id, data) VALUES (?, ?)",
+                        [(k, _dumps(v)) for k, v in sporchi.items() if v is not None])
+                    cur.executemany(
+                        f"DELETE FROM {tabella} WHERE id = ?",
+                        [(k,) for k, v in sporchi.items() if v is None])
+                cur.executemany(
+                    "INSERT OR REPLACE INTO bot_data (key, data) VALUES (?, ?)",
+                    [(k, v) for k, v in bot.items() if v is not None])
+                cur.executemany(
+                    "DELETE FROM bot_data WHERE key = ?",
+                    [(k,) for k, v in bot.items() if v is None])
+                cur.executemany(
+                    "INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)",
+                    [(n, k, _dumps(v)) for (n, k), v in conv.items() if v is not None])
+                cur.executemany(
+                    "DELETE FROM conversations WHERE name = ? AND key = ?",
+                    [(n, k) for (n, k), v in conv.items() if v is None])
+                if callback is not None:
+                    cur.execute(
+                        "INSERT OR REPLACE INTO callback_data (id, data) VALUES (0, ?)",
+                        (_dumps(callback),))
+                cur.execute("COMMIT")
+            except Exception:
+                cur.execute("ROLLBACK")
+                raise
+
+    async def _scrivi(self) -> None:
+        user, self._user_sporchi = self._user_sporchi, {}
+        chat, self._chat_sporche = self._chat_sporche, {}
+        bot, self._bot_sporchi = self._bot_sporchi, {}
+        conv, self._conv_sporche = self._conv_sporche, {}
+        callback, self._callback_sporco = self._callback_sporco, None
+        if not (user or chat or bot or conv or callback is not None):
+            return
+        self._in_scrittura = True
+        try:
+            await asyncio.to_thread(self._applica, user, chat, bot, conv, callback)
+        except Exception as e:
+            logger.error(f"Errore durante la scrittura della persistenza: {e}")
+            # Rimette in coda le scritture non riuscite senza sovrascrivere quelle più recenti
+            for attuali, vecchi in ((self._user_sporchi, user), (self._chat_sporche, chat),
+                                    (self._bot_sporchi, bot), (self._conv_sporche, conv)):
+                for k, v in vecchi.items():
+                    attuali.setdefault(k, v)
+            if self._callback_sporco is None:
+                self._callback_sporco = callback
+            self._programma_flush()
+        finally:
+            self._in_scrittura = False
+
+    async def flush(self) -> None:
+        task = self._flush_task
+        if task is not None and not task.done():
+            if self._in_scrittura:
+                # Lascia terminare la transazione già avviata per non invertire l'ordine
+                await asyncio.gather(task, return_exceptions=True)
+            else:
+                task.cancel()
+        await self._scrivi()
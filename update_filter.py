@@ -0,0 +1,131 @@
+import json
+import logging
+from collections import Counter
+from typing import Iterable, Optional
+
+from telegram import Update
+from telegram.ext import (BaseHandler, CallbackQueryHandler, ChatJoinRequestHandler,
+                          ChatMemberHandler, ChosenInlineResultHandler, CommandHandler,
+                          ConversationHandler, InlineQueryHandler, MessageHandler,
+                          PollAnswerHandler, PollHandler, PreCheckoutQueryHandler,
+                          PrefixHandler, ShippingQueryHandler)
+
+try:
+    import orjson
+except ImportError:  # decoder più veloce opzionale
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+# Tipi di aggiornamento che ogni classe di handler può ricevere. Gli handler di messaggi
+# seguono i filtri di default di PTB (messaggi nuovi e modificati); i post dei canali
+# non interessano al bot e non vengono richiesti.
+_TIPI_PER_HANDLER = (
+    ((CommandHandler, PrefixHandler, MessageHandler), (Update.MESSAGE, Update.EDITED_MESSAGE)),
+    ((CallbackQueryHandler,), (Update.CALLBACK_QUERY,)),
+    ((InlineQueryHandler,), (Update.INLINE_QUERY,)),
+    ((ChosenInlineResultHandler,), (Update.CHOSEN_INLINE_RESULT,)),
+    ((ChatMemberHandler,), (Update.MY_CHAT_MEMBER, Update.CHAT_MEMBER)),
+    ((ChatJoinRequestHandler,), (Update.CHAT_JOIN_REQUEST,)),
+    ((PollHandler,), (Update.POLL,)),
+    ((PollAnswerHandler,), (Update.POLL_ANSWER,)),
+    ((ShippingQueryHandler,), (Update.SHIPPING_QUERY,)),
+    ((PreCheckoutQueryHandler,), (Update.PRE_CHECKOUT_QUERY,)),
+)
+
+_TIPI_MESSAGGIO = frozenset((Update.MESSAGE, Update.EDITED_MESSAGE))
+
+
+def carica_json(corpo: bytes):
+    """Decodifica il corpo della richiesta, con orjson se installato."""
+    if orjson is not None:
+        return orjson.loads(corpo)
+    return json.loads(corpo)
+
+
+def _handler_foglia(handlers: Iterable[BaseHandler]) -> Iterable[BaseHandler]:
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            yield from _handler_foglia(handler.entry_points)
+            for stato, handlers_stato in handler.states.items():
+                # Lo stato TIMEOUT riceve aggiornamenti generati dal bot, non da Telegram
+                if stato != ConversationHandler.TIMEOUT:
+                    yield from _handler_foglia(handlers_stato)
+            yield from _handler_foglia(handler.fallbacks)
+        else:
+            yield handler
+
+
+def tipi_aggiornamento(gruppi: dict[int, list[BaseHandler]]) -> list[str]:
+    """Calcola l'insieme minimo di `allowed_updates` per gli handler registrati."""
+    tipi: set[str] = set()
+    for handlers in gruppi.values():
+        for handler in _handler_foglia(handlers):
+            for classi, tipi_handler in _TIPI_PER_HANDLER:
+                if isinstance(handler, classi):
+                    tipi.update(tipi_handler)
+                    break
+            else:
+                # Handler generico (es. TypeHandler): non si può restringere nulla
+                return list(Update.ALL_TYPES)
+    return sorted(tipi)
+
+
+class UpdatePrefilter:
+    """Scarta gli aggiornamenti irrilevanti guardando solo il payload grezzo.
+
+    Il controllo costa poche ricerche in un dict e avviene prima di `Update.de_json`
+    e del passaggio dagli handler. Scarta i tipi che nessun handler gestisce e i
+    messaggi delle chat ignorate (il gruppo degli annunci), tranne i comandi.
+    """
+
+    def __init__(self, tipi_ammessi: Iterable[str], chat_ignorate: Iterable[int] = ()):
+        self.tipi_ammessi = frozenset(tipi_ammessi)
+        self.chat_ignorate = frozenset(chat_ignorate)
+        self.ricevuti = 0
+        self.scartati: Counter = Counter()
+        self._elaborati = 0
+        self._tempo_parse = 0.0
+
+    def motivo_scarto(self, data: dict) -> Optional[str]:
+        """Restituisce il motivo per cui l'aggiornamento va scartato, oppure None."""
+        self.ricevuti += 1
+        motivo = self._valuta(data)
+        if motivo is not None:
+            self.scartati[motivo] += 1
+            if sum(self.scartati.values()) % 1000 == 0:
+                logger.info(f"Prefiltro aggiornamenti: {self.statistiche()}")
+        return motivo
+
+    def _valuta(self, data: dict) -> Optional[str]:
+        for tipo, contenuto in data.items():
+            if tipo == 'update_id':
+                continue
+            if tipo not in self.tipi_ammessi:
+                return tipo
+            if tipo in _TIPI_MESSAGGIO and self.chat_ignorate:
+                chat_id = contenuto.get('chat', {}).get('id')
+                testo = contenuto.get('text') or ''
+                if chat_id in self.chat_ignorate and not testo.startswith('/'):
+                    return 'chat_ignorata'
+            return None
+        return 'vuoto'
+
+    def registra_parse(self, secondi: float) -> None:
+        """Annota quanto è costato costruire un Update completo per un aggiornamento accettato."""
+        self._elaborati += 1
+        self._tempo_parse += secondi
+
+    def statistiche(self) -> dict:
+        scartati = sum(self.scartati.values())
+        media_parse = self._tempo_parse / self._elaborati if self._elaborati else 0.0
+        return {
+            'ricevuti': self.ricevuti,
+            'scartati': scartati,
+            'scartati_per_motivo': dict(self.scartati),
+            'parse_medio_ms': media_parse * 1000,
+            # Stima: ogni aggiornamento scartato avrebbe richiesto almeno un parse completo
+            'parse_risparmiato_s': scartati * media_parse,
+            'decoder': 'orjson' if orjson is not None else 'json',
+        }
+
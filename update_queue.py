@@ -0,0 +1,116 @@
+import asyncio
+import logging
+from itertools import count
+from typing import Awaitable, Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def chiave_ordinamento(data: dict) -> Optional[int]:
+    """Estrae dal payload grezzo l'id che deve restare ordinato: l'utente, altrimenti la chat."""
+    for campo, valore in data.items():
+        if campo == 'update_id' or not isinstance(valore, dict):
+            continue
+        utente = valore.get('from')
+        if utente and 'id' in utente:
+            return utente['id']
+        chat = valore.get('chat') or (valore.get('message') or {}).get('chat')
+        if chat and 'id' in chat:
+            return chat['id']
+    return None
+
+
+def chat_aggiornamento(data: dict) -> Optional[int]:
+    """Estrae dal payload grezzo la chat dell'aggiornamento (per le callback, quella del messaggio)."""
+    for campo, valore in data.items():
+        if campo == 'update_id' or not isinstance(valore, dict):
+            continue
+        chat = valore.get('chat') or (valore.get('message') or {}).get('chat')
+        return chat.get('id') if chat else None
+    return None
+
+
+def utente_aggiornamento(data: dict) -> Optional[int]:
+    """Estrae dal payload grezzo l'utente che ha generato l'aggiornamento, se c'è."""
+    for campo, valore in data.items():
+        if campo == 'update_id' or not isinstance(valore, dict):
+            continue
+        return (valore.get('from') or {}).get('id')
+    return None
+
+
+class UpdateQueue:
+    """Coda limitata di aggiornamenti smaltita da un pool di worker.
+
+    Ogni worker ha la sua coda: gli aggiornamenti dello stesso utente/chat finiscono
+    sempre nello stesso worker e quindi vengono elaborati in ordine, mentre utenti
+    diversi procedono in parallelo. Quando la coda è piena `submit` attende al massimo
+    `put_timeout` secondi e poi rifiuta l'aggiornamento, così il chiamante può
+    rispondere con un errore e lasciare che Telegram lo reinvii più tardi.
+    """
+
+    def __init__(self, process: Callable[[dict], Awaitable[None]], workers: int = 8,
+                 maxsize: int = 256, put_timeout: float = 2.0):
+        self._process = process
+        self._workers = max(1, workers)
+        self._maxsize = max(self._workers, maxsize)
+        self._put_timeout = put_timeout
+        self._queues: list[asyncio.Queue] = []
+        self._tasks: list[asyncio.Task] = []
+        self._senza_chiave = count()
+        self.accettati = 0
+        self.rifiutati = 0
+
+    def start(self) -> None:
+        per_worker = self._maxsize // self._workers
+        self._queues = [asyncio.Queue(maxsize=per_worker) for _ in range(self._workers)]
+        self._tasks = [
+            asyncio.create_task(self._worker(coda), name=f"update-worker-{i}")
+            for i, coda in enumerate(self._queues)
+        ]
+        logger.info(f"Coda aggiornamenti avviata: {self._workers} worker, capacità {self._maxsize}")
+
+    @property
+    def depth(self) -> int:
+        return sum(coda.qsize() for coda in self._queues)
+
+    async def submit(self, data: dict) -> bool:
+        """Accoda un aggiornamento. Restituisce False se la coda resta piena oltre il timeout."""
+        chiave = chiave_ordinamento(data)
+        indice = (chiave if chiave is not None else next(self._senza_chiave)) % self._workers
+        coda = self._queues[indice]
+        try:
+            coda.put_nowait(data)
+        except asyncio.QueueFull:
+            try:
+                await asyncio.wait_for(coda.put(data), timeout=self._put_timeout)
+            except asyncio.TimeoutError:
+                self.rifiutati += 1
+                logger.warning(
+                    f"Coda aggiornamenti piena (worker {indice}, totale {self.depth}): "
+                    f"aggiornamento {data.get('update_id')} rifiutato")
+                return False
+        self.accettati += 1
+        return True
+
+    async def _worker(self, coda: asyncio.Queue) -> None:
+        while True:
+            data = await coda.get()
+            try:
+                await self._process(data)
+            except Exception as e:
+                logger.error(f"Errore nell'elaborazione dell'aggiornamento {data.get('update_id')}: {e}")
+            finally:
+                coda.task_done()
+
+    async def stop(self, timeout: Optional[float] = None) -> None:
+        """Attende che le code si svuotino (al massimo `timeout` secondi) e ferma i worker."""
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(coda.join() for coda in self._queues)), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Coda aggiornamenti non svuotata in tempo: {self.depth} aggiornamenti persi")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
@@ -0,0 +1,73 @@
+from collections import deque
+from typing import Optional
+
+IN_CORSO = 'in_corso'
+COMPLETATO = 'completato'
+FALLITO = 'fallito'
+
+
+class _Voce:
+    __slots__ = ('stato', 'passi')
+
+    def __init__(self):
+        self.stato = IN_CORSO
+        self.passi: Optional[dict] = None
+
+
+class UpdateRegistry:
+    """Finestra degli ultimi `capacita` update_id visti, con il loro esito.
+
+    Un anello (deque a lunghezza fissa) tiene l'ordine di arrivo e un dict fa da
+    indice: inserimento, ricerca ed espulsione del più vecchio costano O(1).
+    Per ogni aggiornamento gli handler possono annotare i passi già eseguiti
+    (`passi`), così un nuovo tentativo dopo un errore riprende da dove si era
+    fermato invece di ripetere invii già riusciti.
+    """
+
+    def __init__(self, capacita: int = 10000):
+        self._anello: deque[int] = deque()
+        self._capacita = capacita
+        self._voci: dict[int, _Voce] = {}
+        self.duplicati = 0
+
+    def __len__(self) -> int:
+        return len(self._voci)
+
+    def accetta(self, update_id: int) -> bool:
+        """Segna l'aggiornamento come in corso. False se è già completato o in corso."""
+        voce = self._voci.get(update_id)
+        if voce is not None:
+            if voce.stato != FALLITO:
+                self.duplicati += 1
+                return False
+            voce.stato = IN_CORSO
+            return True
+        if len(self._anello) >= self._capacita:
+            del self._voci[self._anello.popleft()]
+        self._anello.append(update_id)
+        self._voci[update_id] = _Voce()
+        return True
+
+    def stato(self, update_id: int) -> Optional[str]:
+        voce = self._voci.get(update_id)
+        return voce.stato if voce is not None else None
+
+    def completa(self, update_id: int) -> None:
+        voce = self._voci.get(update_id)
+        if voce is not None:
+            voce.stato = COMPLETATO
+            voce.passi = None
+
+    def fallisci(self, update_id: int) -> None:
+        voce = self._voci.get(update_id)
+        if voce is not None:
+            voce.stato = FALLITO
+
+    def passi(self, update_id: int) -> dict:
+        """Registro dei passi già eseguiti per l'aggiornamento (vuoto se sconosciuto)."""
+        voce = self._voci.get(update_id)
+        if voce is None:
+            return {}
+        if voce.passi is None:
+            voce.passi = {}
+        return voce.passi
@@ -0,0 +1,189 @@
+import asyncio
+import bisect
+import hashlib
+import json
+import logging
+import os
+import signal
+from typing import Callable, Optional
+
+import aiohttp
+
+from update_queue import chiave_ordinamento
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(testo: str) -> int:
+    return int.from_bytes(hashlib.blake2b(testo.encode(), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """Anello di hashing consistente che assegna ogni chiave a uno dei `nodi` worker.
+
+    Ogni worker occupa `repliche` punti dell'anello e una chiave va al primo punto
+    che segue il suo hash. Cambiando il numero di worker si sposta solo la parte di
+    chiavi dei punti aggiunti o tolti, circa 1/N, invece di quasi tutte come con il
+    modulo.
+    """
+
+    def __init__(self, nodi: int, repliche: int = 1000):
+        punti = sorted((_hash(f"{nodo}-{replica}"), nodo) for nodo in range(nodi) for replica in range(repliche))
+        self._punti = [punto for punto, _ in punti]
+        self._nodi = [nodo for _, nodo in punti]
+
+    def nodo(self, chiave) -> int:
+        i = bisect.bisect(self._punti, _hash(str(chiave)))
+        return self._nodi[i % len(self._nodi)]
+
+
+class WorkerPool:
+    """Processi worker del bot e smistamento degli aggiornamenti tra loro.
+
+    Ogni worker è un processo completo del bot (`comando`) in ascolto su un socket
+    Unix in `cartella`. Il supervisore riceve il webhook e inoltra ogni
+    aggiornamento al worker scelto sull'anello in base a `chiave` (di default
+    l'utente, o la chat se non c'è un utente). Così gli aggiornamenti di un utente
+    arrivano sempre allo stesso processo: conversazioni, bozze, anti-flood e
+    deduplica dei reinvii funzionano come con un processo solo.
+
+    Un worker che esce senza che sia stato chiesto viene riavviato dopo
+    `attesa_riavvio` secondi. Nel frattempo i suoi aggiornamenti ricevono 503 e
+    Telegram li reinvia.
+    """
+
+    def __init__(self, comando: list[str], processi: int, cartella: str, ambiente: dict,
+                 chiave: Callable[[dict], object] = chiave_ordinamento, attesa_riavvio: float = 1.0):
+        self.processi = processi
+        self.anello = HashRing(processi)
+        self._chiave = chiave
+        self._comando = comando
+        self._ambiente = ambiente
+        self._socket = [os.path.join(cartella, f"worker{indice}.sock") for indice in range(processi)]
+        self._attesa_riavvio = attesa_riavvio
+        self._processi: list[Optional[asyncio.subprocess.Process]] = [None] * processi
+        self._sessioni = [aiohttp.ClientSession(connector=aiohttp.UnixConnector(path, limit=0))
+                          for path in self._socket]
+        self._sorveglianza: list[asyncio.Task] = []
+        self._in_chiusura = False
+        self.inoltrati = [0] * processi
+        self.non_raggiungibili = [0] * processi
+        self.riavvii = [0] * processi
+
+    def avvia(self) -> None:
+        self._sorveglianza = [asyncio.create_task(self._sorveglia(indice), name=f"worker-{indice}")
+                              for indice in range(self.processi)]
+        logger.info(f"Avviati {self.processi} worker")
+
+    async def _sorveglia(self, indice: int) -> Optional[int]:
+        """Tiene in vita il worker `indice`; restituisce il suo codice di uscita alla chiusura."""
+        while True:
+            processo = await asyncio.create_subprocess_exec(
+                *self._comando,
+                env=dict(self._ambiente, WORKER_INDEX=str(indice), WORKER_SOCKET=self._socket[indice]))
+            self._processi[indice] = processo
+            if self._in_chiusura:
+                # La chiusura è arrivata mentre il worker partiva
+                processo.send_signal(signal.SIGTERM)
+            codice = await processo.wait()
+            if self._in_chiusura:
+                return codice
+            self.riavvii[indice] += 1
+            logger.error(f"Worker {indice} uscito con codice {codice}: riavvio tra {self._attesa_riavvio:g}s")
+            await asyncio.sleep(self._attesa_riavvio)
+            if self._in_chiusura:
+                return codice
+
+    def worker(self, data: dict) -> int:
+        """Il worker che deve elaborare l'aggiornamento."""
+        chiave = self._chiave(data)
+        return self.anello.nodo(chiave if chiave is not None else data.get('update_id'))
+
+    async def inoltra(self, indice: int, corpo: bytes) -> int:
+        """Passa l'aggiornamento al worker e restituisce lo stato HTTP della sua risposta."""
+        try:
+            async with self._sessioni[indice].post(
+                    'http://worker/webhook', data=corpo, headers={'Content-Type': 'application/json'}) as risposta:
+                self.inoltrati[indice] += 1
+                return risposta.status
+        except aiohttp.ClientError as e:
+            # Worker in riavvio o in chiusura: Telegram reinvierà l'aggiornamento
+            self.non_raggiungibili[indice] += 1
+            logger.warning(f"Worker {indice} non raggiungibile: {e}")
+            return 503
+
+    async def richiedi(self, indice: int, percorso: str) -> Optional[bytes]:
+        """Corpo della risposta del worker a una GET su `percorso`, None se non risponde."""
+        try:
+            async with self._sessioni[indice].get(f"http://worker{percorso}") as risposta:
+                return await risposta.read() if risposta.status == 200 else None
+        except aiohttp.ClientError:
+            return None
+
+    async def attendi_avvio(self, intervallo: float = 0.05) -> None:
+        """Attende che tutti i worker abbiano completato l'avvio."""
+        for indice in range(self.processi):
+            while True:
+                stato = await self.richiedi(indice, '/stato')
+                if stato is not None and 'completato' in json.loads(stato)['avvio']:
+                    break
+                await asyncio.sleep(intervallo)
+
+    async def ferma(self, timeout: float) -> list[Optional[int]]:
+        """Chiede a tutti i worker di chiudere in ordine; dopo `timeout` secondi li termina.
+
+        Restituisce i codici di uscita.
+        """
+        self._in_chiusura = True
+        for processo in self._processi:
+            if processo is not None and processo.returncode is None:
+                processo.send_signal(signal.SIGTERM)
+        _, in_corso = await asyncio.wait(self._sorveglianza, timeout=timeout)
+        if in_corso:
+            logger.warning(f"{len(in_corso)} worker non hanno chiuso in {timeout:g}s: terminati")
+            for processo in self._processi:
+                if processo is not None and processo.returncode is None:
+                    processo.kill()
+            await asyncio.wait(in_corso)
+        await asyncio.gather(*(sessione.close() for sessione in self._sessioni))
+        return [task.result() for task in self._sorveglianza]
+
+    def statistiche(self) -> list[dict]:
+        return [{
+            'pid': processo.pid if processo is not None else None,
+            'attivo': processo is not None and processo.returncode is None,
+            'inoltrati': self.inoltrati[indice],
+            'non_raggiungibili': self.non_raggiungibili[indice],
+            'riavvii': self.riavvii[indice],
+        } for indice, processo in enumerate(self._processi)]
+
+
+def unisci_metriche(testi: list[tuple[int, str]]) -> str:
+    """Unisce le metriche Prometheus dei worker con l'etichetta `worker` su ogni serie.
+
+    Le serie della stessa metrica restano raggruppate sotto un solo HELP/TYPE.
+    """
+    famiglie: dict[str, tuple[list[str], list[str]]] = {}
+    for indice, testo in testi:
+        intestazione, serie = [], []
+        for riga in testo.splitlines():
+            if riga.startswith('# HELP '):
+                nome = riga.split(' ', 3)[2]
+                intestazione, serie = famiglie.setdefault(nome, ([], []))
+                if not intestazione:
+                    intestazione.append(riga)
+            elif riga.startswith('#'):
+                if len(intestazione) < 2:
+                    intestazione.append(riga)
+            elif riga:
+                nome, graffa, resto = riga.partition('{')
+                if graffa:
+                    serie.append(f'{nome}{{worker="{indice}",{resto}')
+                else:
+                    nome, _, valore = riga.partition(' ')
+                    serie.append(f'{nome}{{worker="{indice}"}} {valore}')
+    righe = []
+    for intestazione, serie in famiglie.values():
+        righe.extend(intestazione)
+        righe.extend(serie)
+    return '\n'.join(righe) + '\n'